@@ -0,0 +1,292 @@
+"""Versioned JSON API.
+
+Endpoints live under /api/v1 and return newest-first, cursor-paginated
+lists of messages:
+
+    GET /api/v1/timeline                 the logged-in user's home timeline
+    GET /api/v1/users/<id>/messages      messages written by a user
+    GET /api/v1/users/<id>/likes         messages a user has liked
+
+Query params:
+
+    before   cursor from a previous page's `next_before`
+    limit    page size (default API_PAGE_SIZE, at most MAX_PAGE_SIZE)
+    fields   comma-separated subset of MESSAGE_FIELDS to include
+
+Responses look like `{"messages": [...], "next_before": "..." | null}`.
+Only the requested columns are selected, and rows are serialized one at
+a time as they come off the database cursor, so neither ORM objects nor
+the whole page are held in memory.
+
+The logged-in user can like and unlike messages with
+
+    PUT /api/v1/messages/<id>/like
+    DELETE /api/v1/messages/<id>/like
+
+which are idempotent and respond with `{"liked": ..., "like_count": ...}`,
+and follow and unfollow many users at once with
+
+    POST /api/v1/follows   {"follow": [user ids], "unfollow": [user ids]}
+
+which skips unknown users and follows that already exist (or don't), and
+responds with how many follows were added and removed.
+"""
+
+import json
+from collections import OrderedDict
+from itertools import islice
+
+from flask import Blueprint, Response, g, jsonify, request, stream_with_context
+from werkzeug.exceptions import BadRequest, HTTPException, NotFound, Unauthorized
+
+from models import db, Likes, Message, User
+import follow_graph
+from identity import remember_own_changes
+import likes
+from pagination import decode_cursor, encode_cursor, older_than
+import timeline
+
+API_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Most users one bulk follow request may name.
+MAX_BULK_FOLLOWS = 1000
+
+# How many rows to fetch from the database cursor at a time.
+STREAM_BATCH_SIZE = 100
+
+MESSAGE_FIELDS = OrderedDict([
+    ('id', Message.id),
+    ('text', Message.text),
+    ('timestamp', Message.timestamp),
+    ('user_id', Message.user_id),
+    ('username', User.username),
+    ('user_image_url', User.image_url),
+])
+
+# Always selected, since cursors are built from them.
+KEY_FIELDS = ('id', 'timestamp')
+
+blueprint = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+
+@blueprint.errorhandler(HTTPException)
+def handle_http_error(error):
+    """Report errors as JSON rather than HTML pages."""
+
+    return jsonify(error=error.description), error.code
+
+
+def get_fields():
+    """Return the message fields requested in the querystring."""
+
+    requested = request.args.get('fields')
+
+    if not requested:
+        return list(MESSAGE_FIELDS)
+
+    fields = [field.strip() for field in requested.split(',') if field.strip()]
+    unknown = set(fields) - set(MESSAGE_FIELDS)
+
+    if unknown:
+        raise BadRequest(f"Unknown fields: {', '.join(sorted(unknown))}")
+
+    return fields
+
+
+def get_page_params():
+    """Return `(before, limit)` from the querystring."""
+
+    try:
+        limit = int(request.args.get('limit', API_PAGE_SIZE))
+    except ValueError:
+        raise BadRequest("limit must be an integer")
+
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise BadRequest(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+
+    token = request.args.get('before')
+
+    try:
+        before = decode_cursor(token) if token else None
+    except ValueError:
+        raise BadRequest("Invalid cursor")
+
+    return before, limit
+
+
+def message_query(fields):
+    """Return a query selecting `fields` (plus the key fields) of messages
+    by users who haven't deleted their accounts."""
+
+    columns = [MESSAGE_FIELDS[field].label(field)
+               for field in MESSAGE_FIELDS
+               if field in fields or field in KEY_FIELDS]
+
+    return (db.session
+            .query(*columns)
+            .select_from(Message)
+            .join(User, User.id == Message.user_id)
+            .filter(User.deleted_at.is_(None)))
+
+
+def paged(query, before, limit):
+    """Order `query` newest-first and fetch up to one row past `limit`."""
+
+    if before is not None:
+        query = query.filter(older_than(Message.timestamp, Message.id, before))
+
+    return (query
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(limit + 1)
+            .yield_per(STREAM_BATCH_SIZE))
+
+
+def serialize(row, fields):
+    message = {}
+
+    for field in fields:
+        value = getattr(row, field)
+        message[field] = value.isoformat() if field == 'timestamp' else value
+
+    return json.dumps(message, separators=(',', ':'))
+
+
+def stream_page(rows, fields, limit):
+    """Return a streaming JSON response for one page of `rows`.
+
+    `rows` must be newest-first and may hold up to `limit + 1` rows; the
+    extra row only tells us there's a next page.
+    """
+
+    def generate():
+        yield '{"messages":['
+
+        last = None
+
+        for n, row in enumerate(islice(rows, limit + 1)):
+            if n == limit:
+                next_before = encode_cursor(last.timestamp, last.id)
+                break
+
+            yield (',' if n else '') + serialize(row, fields)
+            last = row
+        else:
+            next_before = None
+
+        yield '],"next_before":' + json.dumps(next_before) + '}'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/json')
+
+
+@blueprint.route('/timeline')
+def timeline_messages():
+    """Stream a page of the logged-in user's home timeline."""
+
+    if not g.user:
+        raise Unauthorized("Log in to see your timeline")
+
+    fields = get_fields()
+    before, limit = get_page_params()
+
+    queries = timeline.timeline_queries(g.user.id, message_query(fields), before)
+    sources = [query.limit(limit + 1).yield_per(STREAM_BATCH_SIZE)
+               for query in queries]
+
+    return stream_page(timeline.merge_timeline(sources), fields, limit)
+
+
+@blueprint.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    """Stream a page of messages written by a user."""
+
+    User.active().filter_by(id=user_id).first_or_404()
+    fields = get_fields()
+    before, limit = get_page_params()
+
+    query = message_query(fields).filter(Message.user_id == user_id)
+    return stream_page(paged(query, before, limit), fields, limit)
+
+
+@blueprint.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    """Stream a page of messages a user has liked."""
+
+    User.active().filter_by(id=user_id).first_or_404()
+    fields = get_fields()
+    before, limit = get_page_params()
+
+    query = (message_query(fields)
+             .join(Likes, Likes.message_id == Message.id)
+             .filter(Likes.user_id == user_id))
+    return stream_page(paged(query, before, limit), fields, limit)
+
+
+@blueprint.route('/messages/<int:message_id>/like', methods=['PUT', 'DELETE'])
+def message_like(message_id):
+    """Like (PUT) or unlike (DELETE) a message as the logged-in user."""
+
+    if not g.user:
+        raise Unauthorized("Log in to like messages")
+
+    if not db.session.query(Message.id).filter(Message.id == message_id).scalar():
+        raise NotFound()
+
+    if request.method == 'PUT':
+        likes.like(g.user.id, message_id)
+    else:
+        likes.unlike(g.user.id, message_id)
+
+    db.session.commit()
+    remember_own_changes()
+
+    return jsonify(message_id=message_id, liked=request.method == 'PUT',
+                   like_count=likes.like_count(message_id))
+
+
+def get_user_ids(body, key):
+    """Return the list of user ids under `key` in a JSON request body."""
+
+    user_ids = body.get(key, [])
+
+    if (not isinstance(user_ids, list) or
+            not all(type(user_id) is int for user_id in user_ids)):
+        raise BadRequest(f"{key} must be a list of user ids")
+
+    return user_ids
+
+
+@blueprint.route('/follows', methods=['POST'])
+def bulk_follow():
+    """Follow and unfollow lists of users as the logged-in user."""
+
+    if not g.user:
+        raise Unauthorized("Log in to follow users")
+
+    body = request.get_json(silent=True)
+
+    if not isinstance(body, dict):
+        raise BadRequest("Expected a JSON object")
+
+    follow_ids = get_user_ids(body, 'follow')
+    unfollow_ids = get_user_ids(body, 'unfollow')
+
+    if set(follow_ids) & set(unfollow_ids):
+        raise BadRequest("Can't follow and unfollow the same user")
+
+    if len(follow_ids) + len(unfollow_ids) > MAX_BULK_FOLLOWS:
+        raise BadRequest(f"At most {MAX_BULK_FOLLOWS} users per request")
+
+    followed, unfollowed = follow_graph.update_many(g.user.id, follow_ids,
+                                                    unfollow_ids)
+    db.session.commit()
+    remember_own_changes()
+
+    following_count = (db.session
+                       .query(User.following_count)
+                       .filter(User.id == g.user.id)
+                       .scalar())
+
+    return jsonify(followed=followed, unfollowed=unfollowed,
+                   following_count=following_count)
@@ -1,11 +1,36 @@
 import os
+from datetime import datetime
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import Flask, render_template, request, flash, redirect, session, g, abort, jsonify
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 from flask_wtf import FlaskForm
 from forms import UserAddForm, LoginForm, MessageForm, EditUserProfileForm
-from models import db, connect_db, User, Message
+from identity import CURR_USER_VERSION_KEY, remember_own_changes
+from models import db, connect_db, Job, User, Message, Likes
+from pagination import decode_cursor, keyset_page
+import api
+import assets
+import conditional
+import counters
+import follow_graph
+import fragment_cache
+import hashtags
+import identity
+import instrumentation
+import jobs
+import likes
+import loader
+import message_search
+import migrations
+import passwords
+import recommendations
+import replicas
+import timeline
+import trending
+import user_search
 
 CURR_USER_KEY = "curr_user"
 
@@ -16,13 +41,44 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
+# Optional read replicas, comma-separated; GET requests read from them
+# (see replicas.py).
+app.config['SQLALCHEMY_REPLICA_URIS'] = [
+    uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if uri]
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Report per-request query counts/timings in response headers, except in
+# production (see instrumentation.py).
+app.config['QUERY_STATS_HEADERS'] = (
+    os.environ.get('FLASK_ENV', 'production') != 'production')
+
+# bcrypt work factor, and how many processes hash passwords off the
+# request thread (0 hashes inline; see passwords.py).
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_HASH_WORKERS'] = int(
+    os.environ.get('PASSWORD_HASH_WORKERS', 2))
+
+# Cache-Control per endpoint; anything not listed must be revalidated
+# before reuse (see conditional.py). Static files set their own: built,
+# fingerprinted assets are immutable (see assets.py), and the rest are
+# cached for SEND_FILE_MAX_AGE_DEFAULT seconds.
+app.config['CACHE_POLICIES'] = {}
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 3600
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+replicas.init_app(app)
+app.register_blueprint(api.blueprint)
+assets.init_app(app)
+conditional.init_app(app)
+instrumentation.init_app(app)
+passwords.init_app(app)
+fragment_cache.init_app(app)
+hashtags.init_app(app)
 
 ##############################################################################
 # User signup/login/logout
@@ -30,19 +86,31 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a slim, cached Identity (see identity.py); routes that
+    need the full User call load_current_user().
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = identity.get_identity(session[CURR_USER_KEY],
+                                       session.get(CURR_USER_VERSION_KEY))
 
     else:
         g.user = None
 
 
+def load_current_user():
+    """Load the full User for the logged-in user."""
+
+    return User.query.get(g.user.id)
+
+
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    session[CURR_USER_VERSION_KEY] = user.version
 
 
 def do_logout():
@@ -51,6 +119,43 @@ def do_logout():
     if CURR_USER_KEY in session:
         del session[CURR_USER_KEY]
 
+    session.pop(CURR_USER_VERSION_KEY, None)
+
+
+def viewer_following_ids(users):
+    """Return the ids among `users` that the logged-in user follows."""
+
+    if not g.user:
+        return set()
+
+    return follow_graph.following_ids_among(g.user.id, [u.id for u in users])
+
+
+def viewer_liked_ids(messages):
+    """Return the ids among `messages` that the logged-in user liked."""
+
+    if not g.user:
+        return set()
+
+    return likes.liked_ids_among(g.user.id, [msg.id for msg in messages])
+
+
+def get_before_cursor():
+    """Decode the `before` pagination cursor from the querystring.
+
+    Returns None for the first page; aborts with a 400 for a bad cursor.
+    """
+
+    token = request.args.get('before')
+
+    if not token:
+        return None
+
+    try:
+        return decode_cursor(token)
+    except ValueError:
+        abort(400)
+
 
 @app.route('/signup', methods=["GET", "POST"])
 def signup():
@@ -80,6 +185,7 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        user_search.remember(user)
         do_login(user)
 
         return redirect("/")
@@ -99,6 +205,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # Saves the upgraded hash if authenticate() rehashed it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -124,34 +232,59 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username
+    (best matches first, limited to user_search.SEARCH_LIMIT).
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        users = User.active().all()
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users = user_search.search_users(search)
+
+    return render_template('users/index.html', users=users,
+                           following_ids=viewer_following_ids(users))
 
-    return render_template('users/index.html', users=users)
+
+@app.route('/users/search')
+def users_autocomplete():
+    """Autocomplete usernames starting with the 'q' param, as JSON."""
+
+    search = request.args.get('q', '').strip()
+
+    if not search:
+        return jsonify(users=[])
+
+    matches = user_search.autocomplete(search)
+    return jsonify(users=[dict(id=user_id, username=username)
+                          for username, user_id in matches])
 
 
 @app.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.active().filter_by(id=user_id).first_or_404()
+
+    # The page only changes when the user's version does: new messages
+    # and counter changes bump it.
+    not_modified = conditional.validate(user.version)
+    if not_modified:
+        return not_modified
 
     # snagging messages in order from the database;
-    # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', curr_user=g.user, user=user, messages=messages)
+    # user.messages won't be in order by default. The template renders
+    # `user` as the author, so there's no need to load `message.user`.
+    messages, next_cursor = keyset_page(
+        Message.query.filter(Message.user_id == user_id),
+        Message.timestamp, Message.id,
+        before=get_before_cursor())
+
+    return render_template('users/show.html', curr_user=g.user, user=user,
+                           messages=messages, next_cursor=next_cursor,
+                           following_ids=viewer_following_ids([user]),
+                           liked_ids=viewer_liked_ids(messages))
 
 
 @app.route('/users/<int:user_id>/following')
@@ -162,8 +295,16 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = (User
+            .active()
+            .options(selectinload(User.following))
+            .filter_by(id=user_id)
+            .first_or_404())
+    # Deleted accounts keep their follows until they're purged.
+    following = [u for u in user.following if u.deleted_at is None]
+    following_ids = viewer_following_ids(following + [user])
+    return render_template('users/following.html', user=user,
+                           following=following, following_ids=following_ids)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -174,36 +315,70 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = (User
+            .active()
+            .options(selectinload(User.followers))
+            .filter_by(id=user_id)
+            .first_or_404())
+    followers = [u for u in user.followers if u.deleted_at is None]
+    following_ids = viewer_following_ids(followers + [user])
+    return render_template('users/followers.html', user=user,
+                           followers=followers, following_ids=following_ids)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
-    """Add a follow for the currently-logged-in user."""
+    """Add a follow for the currently-logged-in user.
+
+    Responds with the new state as JSON if the client asks for JSON;
+    otherwise redirects to the user's following page.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    if not follow_graph.existing_user_ids([follow_id]):
+        abort(404)
+
+    follow_graph.follow(g.user.id, follow_id)
     db.session.commit()
+    remember_own_changes()
 
-    return redirect(f"/users/{g.user.id}/following")
+    return follow_response(follow_id, True)
 
 
 @app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
-    """Have currently-logged-in-user stop following this user."""
+    """Have currently-logged-in-user stop following this user.
+
+    Responds like `add_follow`.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    if not follow_graph.existing_user_ids([follow_id]):
+        abort(404)
+
+    follow_graph.unfollow(g.user.id, follow_id)
     db.session.commit()
+    remember_own_changes()
+
+    return follow_response(follow_id, False)
+
+
+def follow_response(user_id, following):
+    """Respond to a follow or unfollow of `user_id`."""
+
+    if request.accept_mimetypes.best == 'application/json':
+        followers_count = (db.session
+                           .query(User.followers_count)
+                           .filter(User.id == user_id)
+                           .scalar())
+        return jsonify(user_id=user_id, following=following,
+                       followers_count=followers_count)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -220,25 +395,36 @@ def profile():
 
     # If the form is valid, it's being posted
     elif form.validate_on_submit():
+        user = load_current_user()
         # If the passwords don't match...
-        if g.user.password is not form.password.data:
+        if user.password is not form.password.data:
             flash("Incorrect password!")
             return render_template('/users/edit.html', form=form)
         # If the passwords match, update user
-        g.user.username = form.username.data
-        g.user.email = form.email.data
-        g.user.image_url = form.image_url.data
-        g.user.header_image_url = form.header_image_url.data
-        g.user.bio = form.bio.data
+        user_search.forget(user.username)
+        user.username = form.username.data
+        user.email = form.email.data
+        user.image_url = form.image_url.data
+        user.header_image_url = form.header_image_url.data
+        user.bio = form.bio.data
+        identity.bump_version(user.id)
         db.session.commit()
-        return redirect(f'/users/{g.user.id}', code=302)
+        fragment_cache.invalidate('user', user.id)
+        remember_own_changes()
+        user_search.remember(user)
+        return redirect(f'/users/{user.id}', code=302)
     # This is if the form doesn't validate, it's a get request
     else:
         return render_template('/users/edit.html', form=form)
 
 @app.route('/users/delete', methods=["POST"])
 def delete_user():
-    """Delete user."""
+    """Delete user.
+
+    The account, its messages and its place in follow lists disappear at
+    once; the rows themselves (and the counters they feed) are purged in
+    batches by a background job (see jobs.py).
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
@@ -246,16 +432,42 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user = load_current_user()
+    user.deleted_at = datetime.utcnow()
+    user_search.forget(user.username)
+    identity.evict([user.id])
+    jobs.enqueue('delete_user', user_id=user.id)
     db.session.commit()
+    trending.reset()
 
     return redirect("/signup")
 
 @app.route('/users/<int:user_id>/likes', methods=["GET"])
 def display_user_likes(user_id):
-    user = User.query.get_or_404(user_id)
-    messages = user.likes
-    return render_template('users/show_likes.html', curr_user=g.user, user=user, messages=messages)
+    """Show messages this user has liked, newest first."""
+
+    user = User.active().filter_by(id=user_id).first_or_404()
+
+    # The page shows the liked messages' authors too, so a rename or new
+    # picture of any of them changes it. Checked with one aggregate
+    # before the page itself is queried.
+    not_modified = conditional.validate(user.version,
+                                        *likes.liked_authors_stamp(user_id))
+    if not_modified:
+        return not_modified
+
+    messages, next_cursor = keyset_page(
+        (Message
+         .query_with_author()
+         .join(Likes, Likes.message_id == Message.id)
+         .filter(Likes.user_id == user_id)),
+        Message.timestamp, Message.id,
+        before=get_before_cursor())
+
+    return render_template('users/show_likes.html', curr_user=g.user, user=user,
+                           messages=messages, next_cursor=next_cursor,
+                           following_ids=viewer_following_ids([user]),
+                           liked_ids=viewer_liked_ids(messages))
 
 
 
@@ -276,38 +488,97 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        counters.adjust(g.user.id, messages_count=1)
+        timeline.fan_out_message(msg)
+        message_search.index_message(msg)
+        hashtags.index_message(msg)
         db.session.commit()
+        remember_own_changes()
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Search messages by text, best matches first.
+
+    Takes a 'q' param to search for and an optional 'page' number.
+    """
+
+    search = request.args.get('q', '').strip()
+    page = request.args.get('page', 1, type=int)
+
+    if not search or page < 1:
+        messages, has_more = [], False
+    else:
+        messages, has_more = message_search.search_messages(search, page=page)
+
+    return render_template('messages/search.html', search=search, page=page,
+                           messages=messages, has_more=has_more,
+                           liked_ids=viewer_liked_ids(messages))
+
+
+@app.route('/tags/<tag>')
+def tags_show(tag):
+    """Show messages with a hashtag, newest first."""
+
+    messages, next_cursor = hashtags.messages_tagged(
+        tag, before=get_before_cursor())
+
+    return render_template('tags/show.html', tag=tag.lower(), messages=messages,
+                           next_cursor=next_cursor,
+                           liked_ids=viewer_liked_ids(messages))
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', curr_user=g.user, message=msg)
+    msg = Message.query_with_author().filter(Message.id == message_id).first_or_404()
+
+    not_modified = conditional.validate(msg.id, msg.like_count, msg.user.version,
+                                        last_modified=msg.timestamp)
+    if not_modified:
+        return not_modified
+
+    return render_template('messages/show.html', curr_user=g.user, message=msg,
+                           liked_ids=viewer_liked_ids([msg]),
+                           following_ids=viewer_following_ids([msg.user]))
 
 @app.route('/users/add_like/<int:message_id>', methods=["POST"])
 def like_or_unlike_message(message_id):
-    """Likes a message."""
+    """Like or unlike a message.
 
+    Responds with the new state as JSON if the client asks for JSON;
+    otherwise redirects back to the page the like button was on.
+    """
 
-    msg = Message.query.get(message_id)
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    # If message is already in the user.likes list:
-    if msg in g.user.likes:
-        g.user.likes.remove(msg)
+    if not db.session.query(Message.id).filter(Message.id == message_id).scalar():
+        abort(404)
 
-    else:
-        g.user.likes.append(msg)
-    
+    liked = likes.toggle_like(g.user.id, message_id)
     db.session.commit()
-    return redirect('/', code=302)
+    remember_own_changes()
+
+    # Cached message cards show neither like counts nor the viewer's
+    # like state (the like button is outside the cached block), so no
+    # fragments need invalidating here. The message page, which shows
+    # the count, is validated on `like_count` instead.
+
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(message_id=message_id, liked=liked,
+                       like_count=likes.like_count(message_id))
+
+    return redirect(request.referrer or '/')
 
 
 @app.route('/messages/<int:message_id>/delete', methods=["POST"])
@@ -319,8 +590,14 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    counters.message_deleted(msg)
+    timeline.remove_message(msg.id)
+    message_search.unindex_message(msg)
+    hashtags.unindex_message(msg)
     db.session.delete(msg)
     db.session.commit()
+    fragment_cache.invalidate('message', message_id)
+    remember_own_changes()
 
     return redirect(f"/users/{g.user.id}")
 
@@ -335,39 +612,143 @@ def homepage():
 
     - anon users: no messages
     - logged in: 100 most recent messages of followed_users
+      (read from the user's materialized timeline; see timeline.py),
+      with a `before` cursor in the querystring for older pages,
+      who-to-follow suggestions (see recommendations.py) and trending
+      hashtags (see trending.py)
     """
 
     if g.user:
 
-        message_targets = [f.id for f in g.user.following]
-        message_targets.append(g.user.id)
-
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(message_targets))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
+        messages, next_cursor = timeline.home_timeline(
+            g.user.id, before=get_before_cursor())
 
-        return render_template('home.html', messages=messages, user=g.user)
+        return render_template('home.html', messages=messages, user=g.user,
+                               next_cursor=next_cursor,
+                               liked_ids=viewer_liked_ids(messages),
+                               suggestions=recommendations.for_user(g.user.id),
+                               trending_tags=trending.top())
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
\ No newline at end of file
+# Maintenance commands
+
+
+@app.cli.command('reconcile-counters')
+@click.option('--queue', is_flag=True,
+              help="Queue a job to do it in batches instead.")
+def reconcile_counters_command(queue):
+    """Recompute every user's denormalized counters."""
+
+    if queue:
+        job = jobs.enqueue('reconcile_counters')
+        db.session.commit()
+        print(f"Queued job {job.id}.")
+        return
+
+    counters.reconcile_counters()
+    db.session.commit()
+    print("Counters reconciled.")
+
+
+@app.cli.command('recommend-follows')
+@click.option('--queue', is_flag=True,
+              help="Queue a job to do it instead.")
+def recommend_follows_command(queue):
+    """Recompute who-to-follow suggestions for every user."""
+
+    if queue:
+        job = jobs.enqueue('recommend_follows')
+        db.session.commit()
+        print(f"Queued job {job.id}.")
+        return
+
+    for _ in recommendations.rebuild():
+        db.session.commit()
+
+    print("Recommendations rebuilt.")
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Re-index every message for full-text search."""
+
+    message_search.rebuild_index()
+    db.session.commit()
+    print("Search index rebuilt.")
+
+
+@app.cli.command('rebuild-hashtags')
+def rebuild_hashtags_command():
+    """Re-parse every message's hashtags."""
+
+    hashtags.rebuild_tags()
+    db.session.commit()
+    print("Hashtags rebuilt.")
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress static assets into static/dist."""
+
+    manifest = assets.build(app.static_folder)
+    print(f"Built {len(manifest)} assets.")
+
+
+@app.cli.command('load-data')
+@click.argument('directory', default='generator')
+@click.option('--append', is_flag=True,
+              help="Add to the existing data instead of replacing it.")
+@click.option('--batch-size', default=loader.BATCH_SIZE,
+              help="Rows per INSERT on backends without COPY.")
+def load_data_command(directory, append, batch_size):
+    """Bulk load users, messages and follows from CSV files."""
+
+    loader.load(directory, append=append, batch_size=batch_size,
+                report=click.echo)
+
+
+@app.cli.command('migrate')
+@click.option('--status', is_flag=True, help="List pending migrations only.")
+def migrate_command(status):
+    """Apply pending schema migrations."""
+
+    if status:
+        for m in migrations.pending_migrations():
+            click.echo(f"Pending {m.version}: {m.description}")
+        return
+
+    migrations.upgrade(report=click.echo)
+
+
+@app.cli.command('worker')
+@click.option('--processes', default=1, help="Worker processes to run.")
+@click.option('--burst', is_flag=True,
+              help="Exit once there are no jobs left to run.")
+def worker_command(processes, burst):
+    """Run background jobs."""
+
+    if processes > 1:
+        jobs.work_in_processes(app, processes, burst=burst, report=click.echo)
+    else:
+        jobs.work(burst=burst, report=click.echo)
+
+
+@app.cli.command('jobs')
+@click.option('--limit', default=20, help="How many recent jobs to list.")
+def jobs_command(limit):
+    """List recent background jobs and their progress."""
+
+    for job in Job.query.order_by(Job.id.desc()).limit(limit):
+        line = f"{job.id:>6} {job.kind:<20} {job.status:<8} attempts={job.attempts}"
+
+        if job.progress:
+            line += f" progress={job.progress}"
+
+        if job.status != 'done' and job.last_error:
+            line += f" error={job.last_error}"
+
+        click.echo(line)
@@ -0,0 +1,210 @@
+"""Fingerprinted, precompressed static assets.
+
+`build()` (run with `flask build-assets` before deploying) copies every
+file under static/ into static/dist/ with a content hash in its name,
+e.g. stylesheets/style.css -> dist/stylesheets/style.1a2b3c4d5e6f.css,
+and writes a manifest mapping the original paths to the fingerprinted
+ones. References to /static/... inside CSS files are rewritten to the
+fingerprinted URLs, so a changed image also changes the stylesheet's
+hash. Text assets are also written gzip- and (if the `brotli` package
+is installed) brotli-compressed alongside.
+
+Templates link assets with `static_url('stylesheets/style.css')`, which
+returns the fingerprinted URL when the asset has been built and the
+plain /static/ URL otherwise (e.g. in development). Fingerprinted files
+never change, so they're served with long-lived immutable cache headers,
+and precompressed variants are sent to clients that accept them.
+"""
+
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+from flask import request, safe_join, send_from_directory, url_for
+from werkzeug.exceptions import NotFound
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+
+HASH_LENGTH = 12
+
+# Fingerprinted files can be cached forever: new content, new name.
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+COMPRESSIBLE_EXTENSIONS = frozenset(
+    ('.css', '.js', '.json', '.svg', '.txt', '.html', '.ico'))
+
+# Encodings we precompress to, in order of preference.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+CSS_URL_RE = re.compile(r"""url\((['"]?)/static/([^'")]+)\1\)""")
+
+_manifest = {}
+
+
+def fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def fingerprinted_name(path, data):
+    """Return `path` with the hash of `data` before its extension."""
+
+    root, ext = os.path.splitext(path)
+    return f'{root}.{fingerprint(data)}{ext}'
+
+
+def rewrite_css_urls(css, manifest):
+    """Point /static/ URLs in `css` at their fingerprinted versions."""
+
+    def replace(match):
+        quote, path = match.groups()
+        built = manifest.get(path)
+
+        if built is None:
+            return match.group(0)
+
+        return f'url({quote}/static/{built}{quote})'
+
+    return CSS_URL_RE.sub(replace, css)
+
+
+def compress(path, data):
+    """Write precompressed variants of the asset at `path`."""
+
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9))
+
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data))
+
+
+def source_files(static_dir):
+    """Yield static/-relative paths of the assets to build."""
+
+    for dirpath, dirnames, filenames in os.walk(static_dir):
+        rel_dir = os.path.relpath(dirpath, static_dir)
+
+        if rel_dir == DIST_DIR:
+            dirnames[:] = []
+            continue
+
+        for filename in sorted(filenames):
+            yield os.path.normpath(os.path.join(rel_dir, filename)).replace(os.sep, '/')
+
+
+def build(static_dir):
+    """Build fingerprinted assets into `static_dir`/dist; return the manifest.
+
+    The previous build is removed first.
+    """
+
+    dist_dir = os.path.join(static_dir, DIST_DIR)
+    shutil.rmtree(dist_dir, ignore_errors=True)
+
+    # CSS goes last, so the files it references are already in the manifest.
+    paths = sorted(source_files(static_dir), key=lambda p: (p.endswith('.css'), p))
+    manifest = {}
+
+    for path in paths:
+        with open(os.path.join(static_dir, path), 'rb') as f:
+            data = f.read()
+
+        if path.endswith('.css'):
+            data = rewrite_css_urls(data.decode('utf-8'), manifest).encode('utf-8')
+
+        built = f'{DIST_DIR}/{fingerprinted_name(path, data)}'
+        out_path = os.path.join(static_dir, built)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+        with open(out_path, 'wb') as f:
+            f.write(data)
+
+        if os.path.splitext(path)[1] in COMPRESSIBLE_EXTENSIONS:
+            compress(out_path, data)
+
+        manifest[path] = built
+
+    with open(os.path.join(dist_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    _manifest.clear()
+    _manifest.update(manifest)
+    return manifest
+
+
+def load_manifest(static_dir):
+    """Load the manifest of the last build, if there is one."""
+
+    _manifest.clear()
+
+    try:
+        with open(os.path.join(static_dir, DIST_DIR, MANIFEST_NAME)) as f:
+            _manifest.update(json.load(f))
+    except FileNotFoundError:
+        pass
+
+
+def static_url(filename):
+    """Return the URL for the static asset `filename`, fingerprinted if built."""
+
+    return url_for('static', filename=_manifest.get(filename, filename))
+
+
+def accepted_encodings():
+    header = request.headers.get('Accept-Encoding', '')
+    return {part.split(';')[0].strip() for part in header.split(',')}
+
+
+def serve_static(static_dir, filename):
+    """Send a static file; fingerprinted ones precompressed and immutable."""
+
+    if not filename.startswith(DIST_DIR + '/'):
+        return send_from_directory(static_dir, filename)
+
+    mimetype = mimetypes.guess_type(filename)[0]
+    accepted = accepted_encodings()
+
+    for encoding, suffix in ENCODINGS:
+        if encoding not in accepted:
+            continue
+
+        path = safe_join(static_dir, filename + suffix)
+
+        if path is not None and os.path.isfile(path):
+            response = send_from_directory(static_dir, filename + suffix,
+                                           mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(static_dir, filename)
+
+    if os.path.splitext(filename)[1] in COMPRESSIBLE_EXTENSIONS:
+        response.vary.add('Accept-Encoding')
+
+    response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+def init_app(app):
+    """Serve built assets and add `static_url()` to `app`'s templates."""
+
+    load_manifest(app.static_folder)
+
+    def static(filename):
+        if not app.static_folder:
+            raise NotFound()
+
+        return serve_static(app.static_folder, filename)
+
+    app.view_functions['static'] = static
+    app.jinja_env.globals['static_url'] = static_url
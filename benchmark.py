@@ -0,0 +1,294 @@
+"""Route-level benchmarks.
+
+Seeds a dataset at one of several scales (with generator/create_csvs.py
+and the bulk loader, plus random likes), then drives the hot routes through the Flask test
+client as a busy logged-in user, reporting for each route:
+
+    p50/p95/p99     request latency (milliseconds)
+    queries         most SQL queries any one request ran
+    peak            peak memory allocated during a request (KiB)
+
+Results are compared with the baselines stored in BASELINES_FILE: a
+route fails if it runs more queries than its baseline, or its median or
+p95 latency or its peak memory is worse than the baseline by more than
+the allowed tolerance. Run it like:
+
+    python benchmark.py --scale small              # compare with baseline
+    python benchmark.py --scale small --save       # record a new baseline
+
+Without a stored baseline for the scale, the comparison fails.
+
+It uses its own database (BENCHMARK_DATABASE_URL), which it wipes.
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import namedtuple
+
+# Like the tests, pick the database before importing the app.
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCHMARK_DATABASE_URL', 'postgresql:///warbler-bench')
+
+from app import app, CURR_USER_KEY
+from models import db, Likes, User, Message
+from instrumentation import count_queries
+import counters
+import loader
+
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'benchmark_baselines.json')
+
+# Dataset sizes: (users, messages, follows, likes).
+SCALES = {
+    'small': (300, 3000, 6000, 6000),
+    'medium': (3000, 30000, 90000, 60000),
+    'large': (30000, 300000, 1500000, 600000),
+}
+
+WARMUP_REQUESTS = 5
+REQUESTS = 100
+
+# Latencies gated against the baseline; p99 over a hundred-odd requests
+# is too noisy to fail on, so it's only reported.
+GATED_LATENCIES = ('p50', 'p95')
+
+# How much worse than baseline a route may get before it fails.
+LATENCY_TOLERANCE = 0.5
+MEMORY_TOLERANCE = 0.25
+
+# Latency differences below this are noise, whatever the ratio (ms).
+LATENCY_SLACK_MS = 2.0
+
+Dataset = namedtuple('Dataset', 'viewer_id popular_id message_id search_term')
+
+# (name, method, path for a Dataset)
+ROUTES = (
+    ('homepage', 'GET', lambda d: '/'),
+    ('users_show', 'GET', lambda d: f'/users/{d.popular_id}'),
+    ('list_users', 'GET', lambda d: f'/users?q={d.search_term}'),
+    ('messages_show', 'GET', lambda d: f'/messages/{d.message_id}'),
+    ('display_user_likes', 'GET', lambda d: f'/users/{d.viewer_id}/likes'),
+    ('like_toggle', 'POST', lambda d: f'/users/add_like/{d.message_id}'),
+    ('api_timeline', 'GET', lambda d: '/api/v1/timeline'),
+)
+
+
+def seed(scale, random_seed):
+    """Generate and load a dataset at `scale`."""
+
+    users, messages, follows, likes = SCALES[scale]
+    generator = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'generator', 'create_csvs.py')
+
+    with tempfile.TemporaryDirectory() as directory:
+        subprocess.run([sys.executable, generator,
+                        '--users', str(users),
+                        '--messages', str(messages),
+                        '--follows', str(follows),
+                        '--seed', str(random_seed),
+                        '--output-dir', directory],
+                       check=True, stdout=subprocess.DEVNULL)
+        loader.load(directory, report=lambda line: None)
+
+    seed_likes(likes, random_seed)
+
+
+def seed_likes(count, random_seed):
+    """Add `count` random likes, which the generator doesn't make, and
+    recount everyone's likes."""
+
+    rng = random.Random(random_seed)
+    last_user_id = loader.max_id(User)
+    last_message_id = loader.max_id(Message)
+    pairs = set()
+
+    while len(pairs) < count:
+        pairs.add((rng.randint(1, last_user_id), rng.randint(1, last_message_id)))
+
+    rows = [dict(user_id=user_id, message_id=message_id)
+            for user_id, message_id in sorted(pairs)]
+
+    for start in range(0, len(rows), loader.BATCH_SIZE):
+        db.session.execute(Likes.__table__.insert(),
+                           rows[start:start + loader.BATCH_SIZE])
+
+    counters.reconcile_counters()
+    db.session.commit()
+
+
+def pick_dataset():
+    """Choose the users and message the routes are driven with."""
+
+    viewer = User.query.order_by(User.following_count.desc(), User.id).first()
+    popular = User.query.order_by(User.followers_count.desc(), User.id).first()
+    message = (Message
+               .query
+               .filter(Message.user_id == popular.id)
+               .order_by(Message.timestamp.desc())
+               .first())
+
+    return Dataset(viewer.id, popular.id, message.id, viewer.username[:3])
+
+
+def percentile(values, fraction):
+    """Return the `fraction` percentile of `values` (nearest rank)."""
+
+    ordered = sorted(values)
+    rank = max(1, round(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+def measure(client, method, path, requests):
+    """Time `requests` requests to one route; return its results."""
+
+    def request():
+        response = client.open(path, method=method)
+
+        # Streamed responses (the API) only do their work as they're read.
+        response.get_data()
+        response.close()
+
+        if response.status_code >= 400:
+            raise RuntimeError(f"{method} {path} returned {response.status_code}")
+
+    for _ in range(WARMUP_REQUESTS):
+        request()
+
+    latencies = []
+    queries = 0
+
+    for _ in range(requests):
+        with count_queries() as stats:
+            start = time.perf_counter()
+            request()
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        queries = max(queries, stats.count)
+
+    # Tracing allocations slows everything down, so measure memory in a
+    # separate pass.
+    tracemalloc.start()
+    request()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return dict(p50=percentile(latencies, 0.5),
+                p95=percentile(latencies, 0.95),
+                p99=percentile(latencies, 0.99),
+                queries=queries,
+                peak_kib=peak / 1024)
+
+
+def run(dataset, requests):
+    """Benchmark every route in ROUTES; return {route: results}."""
+
+    client = app.test_client()
+
+    with client.session_transaction() as sess:
+        sess[CURR_USER_KEY] = dataset.viewer_id
+
+    return {name: measure(client, method, path(dataset), requests)
+            for name, method, path in ROUTES}
+
+
+def regressions(results, baseline):
+    """Return descriptions of routes that got worse than `baseline`."""
+
+    problems = []
+
+    for name, result in results.items():
+        base = baseline.get(name)
+
+        if base is None:
+            continue
+
+        if result['queries'] > base['queries']:
+            problems.append(f"{name}: {result['queries']} queries, "
+                            f"baseline {base['queries']}")
+
+        for stat in GATED_LATENCIES:
+            limit = max(base[stat] * (1 + LATENCY_TOLERANCE),
+                        base[stat] + LATENCY_SLACK_MS)
+
+            if result[stat] > limit:
+                problems.append(f"{name}: {stat} {result[stat]:.2f}ms, "
+                                f"baseline {base[stat]:.2f}ms")
+
+        if result['peak_kib'] > base['peak_kib'] * (1 + MEMORY_TOLERANCE):
+            problems.append(f"{name}: peak {result['peak_kib']:.0f}KiB, "
+                            f"baseline {base['peak_kib']:.0f}KiB")
+
+    return problems
+
+
+def report(results):
+    print(f"{'route':<20} {'p50':>8} {'p95':>8} {'p99':>8} {'queries':>8} {'peak KiB':>9}")
+
+    for name, r in results.items():
+        print(f"{name:<20} {r['p50']:>8.2f} {r['p95']:>8.2f} {r['p99']:>8.2f} "
+              f"{r['queries']:>8} {r['peak_kib']:>9.0f}")
+
+
+def load_baselines():
+    try:
+        with open(BASELINES_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Warbler's hot routes.")
+    parser.add_argument('--scale', choices=SCALES, default='small')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=REQUESTS,
+                        help="measured requests per route")
+    parser.add_argument('--save', action='store_true',
+                        help="store the results as the new baseline")
+    parser.add_argument('--no-seed', action='store_true',
+                        help="reuse the data already in the database")
+    args = parser.parse_args()
+
+    app.config['WTF_CSRF_ENABLED'] = False
+
+    if not args.no_seed:
+        seed(args.scale, args.seed)
+
+    results = run(pick_dataset(), args.requests)
+    report(results)
+
+    baselines = load_baselines()
+
+    if args.save:
+        baselines[args.scale] = results
+
+        with open(BASELINES_FILE, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+
+        print(f"Saved baseline for {args.scale}.")
+        return
+
+    if args.scale not in baselines:
+        print(f"No baseline for {args.scale}; run with --save to record one.")
+        sys.exit(1)
+
+    problems = regressions(results, baselines[args.scale])
+
+    if problems:
+        print("\nREGRESSIONS:")
+        print('\n'.join(f"  {problem}" for problem in problems))
+        sys.exit(1)
+
+    print("\nNo regressions.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""Conditional GET support and per-route cache policies.
+
+Routes whose output depends only on a few version stamps call
+`validate()` with them before doing any heavy work:
+
+    not_modified = conditional.validate(user.version)
+    if not_modified:
+        return not_modified
+
+This computes an ETag from the stamps plus the viewer's identity (pages
+are personalized: nav bar, like and follow buttons), and returns a 304
+response if the client already has that version; otherwise the ETag
+(and Last-Modified, if given) is added to the eventual response. As
+HTTP requires, a client's If-None-Match takes precedence over its
+If-Modified-Since, so Last-Modified only needs to be a good guess.
+
+Cache-Control is set per endpoint from the CACHE_POLICIES config,
+falling back to DEFAULT_CACHE_POLICY, which lets browsers keep pages
+but makes them revalidate on every use.
+"""
+
+from hashlib import sha1
+
+from flask import current_app, g, request, session
+from werkzeug.http import is_resource_modified
+
+DEFAULT_CACHE_POLICY = 'private, no-cache'
+
+
+def etag_for(*parts):
+    """Return an ETag value for the given version stamps and viewer."""
+
+    viewer = (g.user.id, g.user.version) if g.get('user') else None
+    raw = repr((request.endpoint, viewer, parts)).encode('utf-8')
+    return sha1(raw).hexdigest()
+
+
+def validate(*parts, last_modified=None):
+    """Set validators for this response from version stamps `parts`.
+
+    Returns a 304 response to send instead if the client's copy is
+    current, or None if the page should be rendered.
+    """
+
+    etag = etag_for(*parts)
+    g.etag, g.last_modified = etag, last_modified
+
+    # Don't swallow a pending flash message with a 304.
+    if '_flashes' in session:
+        return None
+
+    if is_resource_modified(request.environ, etag, last_modified=last_modified):
+        return None
+
+    response = current_app.response_class(status=304)
+    apply_validators(response)
+    return response
+
+
+def apply_validators(response):
+    """Add the validators set by `validate()`, if any, to `response`."""
+
+    etag = g.get('etag')
+
+    if etag is not None:
+        response.set_etag(etag)
+
+    last_modified = g.get('last_modified')
+
+    if last_modified is not None:
+        response.last_modified = last_modified
+
+
+def init_app(app):
+    """Apply cache policies and validators to `app`'s responses."""
+
+    app.config.setdefault('CACHE_POLICIES', {})
+
+    @app.after_request
+    def add_cache_headers(response):
+        policy = app.config['CACHE_POLICIES'].get(request.endpoint)
+
+        if policy is not None:
+            response.headers['Cache-Control'] = policy
+        elif 'Cache-Control' not in response.headers:
+            response.headers['Cache-Control'] = DEFAULT_CACHE_POLICY
+
+        if response.status_code == 200:
+            apply_validators(response)
+
+        return response
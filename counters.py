@@ -0,0 +1,132 @@
+"""Denormalized counters.
+
+`User` carries `messages_count`, `following_count`, `followers_count`
+and `likes_count` columns, and `Message` a `like_count`, so pages can
+show totals without loading whole collections. The write paths in app.py adjust them in the
+same transaction as the change they count; `reconcile_counters()`
+recomputes them all in bulk if they ever drift.
+"""
+
+from sqlalchemy import func, select
+
+from models import db, Follows, Likes, Message, User
+import identity
+
+
+def adjust(user_ids, **deltas):
+    """Add `deltas` to counters for one user id or a query of ids.
+
+    Issues a single UPDATE, e.g. `adjust(user.id, likes_count=1)`, which
+    also bumps the users' version stamps (see identity.py).
+    """
+
+    users = User.__table__
+
+    if isinstance(user_ids, int):
+        condition = users.c.id == user_ids
+        identity.evict([user_ids])
+    else:
+        condition = users.c.id.in_(user_ids)
+
+    values = {name: users.c[name] + delta for name, delta in deltas.items()}
+    values['version'] = users.c.version + 1
+    db.session.execute(users.update().where(condition).values(**values))
+
+
+def adjust_like_counts(message_ids, delta):
+    """Add `delta` to `like_count` for a list or query of message ids."""
+
+    messages = Message.__table__
+    db.session.execute(messages
+                       .update()
+                       .where(messages.c.id.in_(message_ids))
+                       .values(like_count=messages.c.like_count + delta))
+
+
+def message_deleted(message):
+    """Adjust counters for a message about to be deleted.
+
+    Covers the author's message count and the like counts of everyone
+    who liked the message (those likes are removed by cascade).
+    """
+
+    adjust(message.user_id, messages_count=-1)
+
+    likers = (select([Likes.user_id])
+              .where(Likes.message_id == message.id))
+    adjust(likers, likes_count=-1)
+
+
+def reconcile_counters():
+    """Recompute every counter from the underlying tables.
+
+    Runs as one UPDATE per table with correlated subqueries; the caller
+    is responsible for committing. For big tables, the `reconcile_counters`
+    job (see jobs.py) does the same in batches of ids.
+    """
+
+    reconcile_user_counters()
+    reconcile_message_counters()
+
+
+def count_where(column, condition):
+    return select([func.count(column)]).where(condition).as_scalar()
+
+
+def in_range(column, id_range):
+    """Return a condition for `column` in the half-open `id_range`, or
+    None for every row."""
+
+    if id_range is None:
+        return None
+
+    low, high = id_range
+    return (column >= low) & (column < high)
+
+
+def reconcile_user_counters(id_range=None):
+    """Recompute users' counters, for ids in `id_range` (low, high) or
+    all users."""
+
+    db.session.execute(user_counters_update(id_range))
+
+
+def user_counters_update(id_range=None):
+    """Return the UPDATE that `reconcile_user_counters()` runs."""
+
+    users = User.__table__
+    update = users.update()
+    condition = in_range(users.c.id, id_range)
+
+    if condition is not None:
+        update = update.where(condition)
+
+    return update.values(
+        messages_count=count_where(
+            Message.id, Message.user_id == users.c.id),
+        following_count=count_where(
+            Follows.user_being_followed_id,
+            Follows.user_following_id == users.c.id),
+        followers_count=count_where(
+            Follows.user_following_id,
+            Follows.user_being_followed_id == users.c.id),
+        likes_count=count_where(
+            Likes.message_id, Likes.user_id == users.c.id),
+    )
+
+
+def reconcile_message_counters(id_range=None):
+    """Recompute messages' like counts, for ids in `id_range` (low, high)
+    or all messages."""
+
+    messages = Message.__table__
+    update = messages.update()
+    condition = in_range(messages.c.id, id_range)
+
+    if condition is not None:
+        update = update.where(condition)
+
+    db.session.execute(update.values(
+        like_count=count_where(
+            Likes.user_id, Likes.message_id == messages.c.id),
+    ))
@@ -0,0 +1,137 @@
+"""Batch membership queries and keyed writes against the follow graph.
+
+These answer "which of these users does A follow?" for a whole page of
+users in a single query against the `follows` table, so templates can
+check membership in a set instead of calling `User.is_following()` (one
+query each) per rendered user.
+
+Follows are written the same way likes are (see likes.py): a follow is
+an INSERT that ignores an existing row and an unfollow a keyed DELETE,
+without loading anyone's `following` collection. Only rows actually
+inserted or deleted move the counters and timelines, and an unfollow
+that brings a high-fanout author back to the fan-out limit queues a
+backfill of their followers' timelines (see timeline.py).
+"""
+
+from models import db, insert_ignoring_conflicts, Follows, User
+import counters
+import jobs
+import timeline
+
+
+def following_ids_among(follower_id, user_ids):
+    """Return the set of `user_ids` that `follower_id` follows."""
+
+    user_ids = list(user_ids)
+
+    if follower_id is None or not user_ids:
+        return set()
+
+    rows = (db.session
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == follower_id,
+                    Follows.user_being_followed_id.in_(user_ids)))
+    return {user_id for (user_id,) in rows}
+
+
+def follow(follower_id, followed_id):
+    """Have `follower_id` follow `followed_id`; returns False if they
+    already did (or are the same user).
+
+    The caller is responsible for committing.
+    """
+
+    added = add_follow(follower_id, followed_id)
+
+    if added:
+        counters.adjust(follower_id, following_count=1)
+
+    return added
+
+
+def unfollow(follower_id, followed_id):
+    """Have `follower_id` stop following `followed_id`; returns False if
+    they weren't following.
+
+    The caller is responsible for committing.
+    """
+
+    removed = remove_follow(follower_id, followed_id)
+
+    if removed:
+        counters.adjust(follower_id, following_count=-1)
+
+    return removed
+
+
+def add_follow(follower_id, followed_id):
+    """Insert a follow, updating everything but the follower's count."""
+
+    if follower_id == followed_id:
+        return False
+
+    insert = insert_ignoring_conflicts(Follows,
+                                       user_being_followed_id=followed_id,
+                                       user_following_id=follower_id)
+
+    if db.session.execute(insert).rowcount != 1:
+        return False
+
+    counters.adjust(followed_id, followers_count=1)
+    timeline.backfill_author(follower_id, followed_id)
+    return True
+
+
+def remove_follow(follower_id, followed_id):
+    """Delete a follow, updating everything but the follower's count."""
+
+    follows = Follows.__table__
+    delete = follows.delete().where(
+        (follows.c.user_being_followed_id == followed_id) &
+        (follows.c.user_following_id == follower_id))
+
+    if db.session.execute(delete).rowcount != 1:
+        return False
+
+    counters.adjust(followed_id, followers_count=-1)
+    timeline.remove_author(follower_id, followed_id)
+
+    if timeline.dropped_to_fanout_limit([followed_id]):
+        jobs.enqueue('fan_out_author', author_id=followed_id)
+
+    return True
+
+
+def existing_user_ids(user_ids):
+    """Return the subset of `user_ids` that belong to active users."""
+
+    user_ids = set(user_ids)
+
+    if not user_ids:
+        return set()
+
+    return {user_id for (user_id,) in (db.session
+                                       .query(User.id)
+                                       .filter(User.id.in_(user_ids),
+                                               User.deleted_at.is_(None)))}
+
+
+def update_many(follower_id, follow_ids=(), unfollow_ids=()):
+    """Follow and unfollow lists of users in one go.
+
+    Unknown user ids are skipped. Returns `(followed, unfollowed)`, the
+    number of follows actually added and removed. The caller is
+    responsible for committing.
+    """
+
+    known = existing_user_ids(set(follow_ids) | set(unfollow_ids))
+
+    followed = sum(add_follow(follower_id, user_id)
+                   for user_id in sorted(known.intersection(follow_ids)))
+    unfollowed = sum(remove_follow(follower_id, user_id)
+                     for user_id in sorted(known.intersection(unfollow_ids)))
+
+    if followed != unfollowed:
+        counters.adjust(follower_id, following_count=followed - unfollowed)
+
+    return followed, unfollowed
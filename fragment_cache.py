@@ -0,0 +1,126 @@
+"""Jinja fragment caching.
+
+Adds a `{% cache %}` tag that stores the rendered HTML of its body in an
+in-process LRU cache, so hot pages mostly stitch together pre-rendered
+fragments:
+
+    {% cache 'message', msg.id, msg.user.profile_version %}
+      ... markup that only depends on msg and its author ...
+    {% endcache %}
+
+The first two key parts name the thing the fragment shows (e.g. a
+message or a user) and are what `invalidate()` takes; the remaining
+parts are version stamps, so a fragment re-renders as soon as any of
+them changes. Key fragments on the narrowest stamp that covers what
+they show: a user's `profile_version` for their name and pictures,
+`version` only where counters are shown too. Keep viewer-specific markup
+(like/follow buttons) outside cached blocks.
+
+Fragments with different markup need different keys, or whichever page
+renders first fills the cache for all of them. Message lists share
+their cards through templates/messages/card.html for that reason.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+
+CACHE_TTL = 3600
+CACHE_SIZE = 20000
+
+_fragments = OrderedDict()
+_generations = {}
+_lock = threading.Lock()
+
+
+def get(key):
+    """Return the cached fragment for `key`, or None."""
+
+    with _lock:
+        cached = _fragments.get(key)
+
+        if cached is None:
+            return None
+
+        html, expires_at = cached
+
+        if expires_at <= time.monotonic():
+            del _fragments[key]
+            return None
+
+        _fragments.move_to_end(key)
+        return html
+
+
+def put(key, html):
+    """Cache the rendered fragment `html` under `key`."""
+
+    with _lock:
+        _fragments[key] = (html, time.monotonic() + CACHE_TTL)
+
+        while len(_fragments) > CACHE_SIZE:
+            _fragments.popitem(last=False)
+
+
+def invalidate(kind, id):
+    """Stop serving every cached fragment for `kind` and `id`.
+
+    Bumps a generation number that is part of the fragments' keys; the
+    stale entries age out of the LRU.
+    """
+
+    with _lock:
+        _generations[kind, id] = _generations.get((kind, id), 0) + 1
+
+
+def clear():
+    """Drop every cached fragment."""
+
+    with _lock:
+        _fragments.clear()
+        _generations.clear()
+
+
+def fragment_key(key_parts):
+    kind, id, *versions = key_parts
+    return (kind, id, _generations.get((kind, id), 0), *versions)
+
+
+class FragmentCacheExtension(Extension):
+    """Jinja extension implementing `{% cache kind, id, version... %}`."""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+
+        key_parts = [parser.parse_expression()]
+
+        while parser.stream.skip_if('comma'):
+            key_parts.append(parser.parse_expression())
+
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+
+        return nodes.CallBlock(
+            self.call_method('_render', [nodes.List(key_parts)]),
+            [], [], body,
+        ).set_lineno(lineno)
+
+    def _render(self, key_parts, caller):
+        key = fragment_key(key_parts)
+        html = get(key)
+
+        if html is None:
+            html = caller()
+            put(key, html)
+
+        return html
+
+
+def init_app(app):
+    """Enable the `{% cache %}` tag in `app`'s templates."""
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
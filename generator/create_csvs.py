@@ -2,15 +2,33 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load testing:
+
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 50000000 --seed 42
+
+Output only depends on the scale parameters, --seed and --end (not on the
+number of workers), and nothing is fetched over the network. Rows are
+generated in chunks by a pool of worker processes, each writing its own
+part file, which are then joined in order; memory use is bounded by the
+chunk size rather than the output size.
+
+Follows are sampled follower by follower, so no list of all possible
+pairs is built. Who gets followed (and who writes messages) follows a
+power law, so a few users are very popular and most have few followers,
+as on a real site. Load the output with `flask load-data`.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import shutil
+from datetime import datetime
+from multiprocessing import Pool
+from random import Random
+
 from faker import Faker
-from helpers import get_random_datetime
+from helpers import get_random_datetime, ZipfSampler
 
 MAX_WARBLER_LENGTH = 140
 
@@ -20,58 +38,207 @@ FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+NUM_FOLLOWS = 5000
+
+CHUNK_SIZE = 100000
+
+# Messages are timestamped within this many years before --end.
+YEAR_GAP = 2
+DEFAULT_END = datetime(2020, 1, 1)
+
+# Power-law exponents for how likely a user is to be followed, and to
+# write a given message.
+FOLLOWED_EXPONENT = 1.0
+AUTHOR_EXPONENT = 0.8
 
-fake = Faker()
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-# Generate random profile image URLs to use for users
+# Profile image URLs to use for users
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
+# Header images to use for users; served by the app itself
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+HEADER_IMAGE_URLS = [
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
+# Set in each worker process by init_worker()
+options = None
+followed_sampler = None
+author_sampler = None
+
+
+def init_worker(worker_options):
+    """Set up per-process state: options and the popularity samplers."""
+
+    global options, followed_sampler, author_sampler
+
+    options = worker_options
+    followed_sampler = ZipfSampler(options.users, FOLLOWED_EXPONENT, options.seed + 1)
+    author_sampler = ZipfSampler(options.users, AUTHOR_EXPONENT, options.seed + 2)
+
+
+def chunk_rng(kind, index):
+    """Return the random generator for one chunk of one kind of row."""
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
+    return Random(f"{options.seed}-{kind}-{index}")
+
+
+def user_rows(index, start, stop):
+    rng = chunk_rng('users', index)
+    fake = Faker()
+    fake.seed_instance(rng.getrandbits(64))
+
+    for n in range(start, stop):
+        # Suffix with the user number so names stay unique at any scale.
+        mailbox, domain = fake.email().split('@')
+
+        yield dict(
+            email=f"{mailbox}+{n}@{domain}",
+            username=f"{fake.user_name()}_{n}",
+            image_url=rng.choice(IMAGE_URLS),
+            password=PASSWORD_HASH,
             bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
+            header_image_url=rng.choice(HEADER_IMAGE_URLS),
             location=fake.city()
-        ))
+        )
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
+def message_rows(index, start, stop):
+    rng = chunk_rng('messages', index)
+    fake = Faker()
+    fake.seed_instance(rng.getrandbits(64))
+
+    for n in range(start, stop):
+        yield dict(
             text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
+            timestamp=get_random_datetime(rng, options.end, YEAR_GAP),
+            user_id=author_sampler.sample(rng)
+        )
+
+
+def follow_rows(index, start, stop, count):
+    """Yield `count` distinct follows by users numbered start..stop-1."""
+
+    rng = chunk_rng('follows', index)
+    seen = set()
+
+    while len(seen) < count:
+        follower = rng.randrange(start, stop)
+        followed = followed_sampler.sample(rng)
+
+        if followed != follower and (followed, follower) not in seen:
+            seen.add((followed, follower))
+            yield dict(user_being_followed_id=followed, user_following_id=follower)
+
+
+GENERATORS = {
+    'users': (user_rows, USERS_CSV_HEADERS),
+    'messages': (message_rows, MESSAGES_CSV_HEADERS),
+    'follows': (follow_rows, FOLLOWS_CSV_HEADERS),
+}
+
+
+def write_chunk(chunk):
+    """Write one chunk of rows to its own part file; return its path."""
+
+    kind, index, *args = chunk
+    rows, headers = GENERATORS[kind]
+    path = os.path.join(options.output_dir, f".{kind}.{index}.part")
+
+    with open(path, 'w', newline='') as f:
+        csv.DictWriter(f, fieldnames=headers).writerows(rows(index, *args))
+
+    return path
+
+
+def chunks(kind, total, chunk_size):
+    """Split rows numbered 1..total into (kind, index, start, stop) chunks."""
+
+    for index, start in enumerate(range(1, total + 1, chunk_size)):
+        yield (kind, index, start, min(start + chunk_size, total + 1))
+
+
+def follow_chunks(users, follows, chunk_size):
+    """Split followers into chunks of about `chunk_size` follows each."""
+
+    followers_per_chunk = max(1, chunk_size * users // max(follows, 1))
+
+    for kind, index, start, stop in chunks('follows', users, followers_per_chunk):
+        # Each chunk's share, rounded so the shares add up to `follows`.
+        count = (follows * (stop - 1) // users) - (follows * (start - 1) // users)
+        yield (kind, index, start, stop, count)
+
+
+def generate(pool, kind, chunk_specs):
+    """Write `kind`.csv from the part files of `chunk_specs`."""
+
+    rows, headers = GENERATORS[kind]
+    path = os.path.join(options.output_dir, f"{kind}.csv")
+    mapper = pool.imap if pool else map
+
+    with open(path, 'w', newline='') as out:
+        csv.DictWriter(out, fieldnames=headers).writeheader()
+
+        for part in mapper(write_chunk, chunk_specs):
+            with open(part, newline='') as f:
+                shutil.copyfileobj(f, out)
+
+            os.remove(part)
+
+    print(f"Wrote {path}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate Warbler sample data.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLOWS)
+    parser.add_argument('--seed', type=int, default=0,
+                        help="random seed; the same seed gives the same data")
+    parser.add_argument('--end', type=datetime.fromisoformat, default=DEFAULT_END,
+                        help="latest message timestamp (ISO format)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="processes to generate rows with")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help="rows per chunk of work")
+    parser.add_argument('--output-dir', default=os.path.dirname(os.path.abspath(__file__)))
+    args = parser.parse_args()
+
+    if args.users < 2:
+        parser.error("need at least 2 users")
+
+    # Each chunk of followers must be able to hold its share of follows.
+    if args.follows / args.users > (args.users - 1) / 2:
+        parser.error("too many follows for this many users")
+
+    return args
+
+
+def main():
+    args = parse_args()
+    init_worker(args)
 
-# Generate follows.csv from random pairings of users
+    work = [
+        ('users', chunks('users', args.users, args.chunk_size)),
+        ('messages', chunks('messages', args.messages, args.chunk_size)),
+        ('follows', follow_chunks(args.users, args.follows, args.chunk_size)),
+    ]
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+    if args.workers > 1:
+        with Pool(args.workers, initializer=init_worker, initargs=(args,)) as pool:
+            for kind, chunk_specs in work:
+                generate(pool, kind, chunk_specs)
+    else:
+        for kind, chunk_specs in work:
+            generate(None, kind, chunk_specs)
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,45 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+from array import array
+from bisect import bisect
+from datetime import timedelta
+from itertools import accumulate
+from math import gcd
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(rng, end, year_gap=2):
+    """Get a random datetime within `year_gap` years before `end`."""
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    span = end - end.replace(year=end.year - year_gap)
+    return end - timedelta(seconds=rng.uniform(0, span.total_seconds()))
 
-    return datetime.fromtimestamp(random_timestamp)
+
+class ZipfSampler:
+    """Draw user ids 1..n with a power-law (Zipf) popularity.
+
+    The k-th most popular user is drawn with probability proportional to
+    1 / k ** exponent. Popularity ranks are scattered over the ids with a
+    fixed bijection, so popular users aren't simply the lowest ids.
+    """
+
+    def __init__(self, n, exponent, shuffle_seed):
+        self.n = n
+        self.cumulative = array('d', accumulate(
+            1 / rank ** exponent for rank in range(1, n + 1)))
+        self.total = self.cumulative[-1]
+
+        # Any multiplier coprime with n makes rank -> id a permutation.
+        self.multiplier = (shuffle_seed * 2654435761 + 40503) % n or 1
+
+        while gcd(self.multiplier, n) != 1:
+            self.multiplier += 1
+
+        # Without an offset, rank 0 (the most popular) would always be id 1.
+        self.offset = (shuffle_seed * 2246822519 + 3266489917) % n
+
+    def id_for_rank(self, rank):
+        return (rank * self.multiplier + self.offset) % self.n + 1
+
+    def sample(self, rng):
+        rank = bisect(self.cumulative, rng.random() * self.total)
+        return self.id_for_rank(min(rank, self.n - 1))
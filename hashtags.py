@@ -0,0 +1,114 @@
+"""Hashtags.
+
+Tags (`#word`, matched case-insensitively and stored lowercase) are
+parsed out of messages when they're written and stored in the
+`hashtags` table with a copy of the message's timestamp, so a tag's
+page is a keyset-paginated range scan of one index. Message texts link
+their tags to those pages with the `hashtag_links` template filter.
+
+Rows are deleted along with their message (see `unindex_message()`);
+the foreign key cascade isn't enforced on every backend. New tags are
+also fed to the in-memory trending counts (see trending.py).
+"""
+
+import re
+
+from markupsafe import Markup, escape
+
+from models import db, Hashtag, Message
+from pagination import keyset_page
+import trending
+
+MAX_TAG_LENGTH = 50
+
+TAG_PATTERN = re.compile(r'(?<![\w#&])#(\w{1,%d})\b' % MAX_TAG_LENGTH)
+
+# Messages per batch when rebuilding the table.
+REBUILD_BATCH_SIZE = 10000
+
+
+def extract_tags(text):
+    """Return the distinct tags in `text`, lowercased, in order of use."""
+
+    tags = (match.lower() for match in TAG_PATTERN.findall(text))
+    return list(dict.fromkeys(tags))
+
+
+def index_message(msg):
+    """Store a new message's tags. It must already be flushed so it has
+    an id; the caller is responsible for committing."""
+
+    tags = extract_tags(msg.text)
+
+    if tags:
+        db.session.execute(Hashtag.__table__.insert(), [
+            dict(tag=tag, message_id=msg.id, timestamp=msg.timestamp)
+            for tag in tags])
+        trending.record(tags, msg.id, msg.timestamp)
+
+
+def unindex_message(msg):
+    """Remove a message's tags before it is deleted."""
+
+    (Hashtag
+     .query
+     .filter(Hashtag.message_id == msg.id)
+     .delete(synchronize_session=False))
+
+
+def messages_tagged(tag, before=None):
+    """Return `(messages, next_cursor)` for one newest-first page of
+    messages tagged `tag`."""
+
+    query = (Message
+             .query_with_author()
+             .join(Hashtag, Hashtag.message_id == Message.id)
+             .filter(Hashtag.tag == tag.lower()))
+
+    return keyset_page(query, Hashtag.timestamp, Hashtag.message_id,
+                       before=before)
+
+
+def rebuild_tags(id_range=None):
+    """Re-parse the tags of messages with ids in `id_range` (low, high),
+    or of every message; the caller is responsible for committing."""
+
+    table = Hashtag.__table__
+    delete = table.delete()
+    messages = db.session.query(Message.id, Message.text, Message.timestamp)
+
+    if id_range is not None:
+        low, high = id_range
+        delete = delete.where((table.c.message_id >= low) & (table.c.message_id < high))
+        messages = messages.filter(Message.id >= low, Message.id < high)
+
+    db.session.execute(delete)
+
+    rows = []
+    messages = messages.yield_per(REBUILD_BATCH_SIZE)
+
+    for message_id, text, timestamp in messages:
+        rows.extend(dict(tag=tag, message_id=message_id, timestamp=timestamp)
+                    for tag in extract_tags(text))
+
+        if len(rows) >= REBUILD_BATCH_SIZE:
+            db.session.execute(table.insert(), rows)
+            rows = []
+
+    if rows:
+        db.session.execute(table.insert(), rows)
+
+    trending.reset()
+
+
+def hashtag_links(text):
+    """Escape `text`, linking each tag in it to its page."""
+
+    def link(match):
+        return f'<a href="/tags/{match.group(1).lower()}">{match.group(0)}</a>'
+
+    return Markup(TAG_PATTERN.sub(link, str(escape(text))))
+
+
+def init_app(app):
+    app.add_template_filter(hashtag_links)
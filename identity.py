@@ -0,0 +1,126 @@
+"""Cached identity of the logged-in user.
+
+Every request needs to know who is logged in, but very few need the full
+ORM `User`. `get_identity()` returns a slim, read-only `Identity` with
+just the columns the page chrome renders, served from an in-process
+TTL/LRU cache so most requests don't query the `users` table at all.
+
+Cache entries are keyed by user id and the user's `version` stamp, which
+is bumped (see `bump_version()`) whenever something the identity shows
+changes: profile edits, follow and counter changes, deletion. The stamp
+the user last saw is kept in their session, so their own changes are
+visible on their next request even if it lands on another process;
+changes made by others are picked up within CACHE_TTL seconds.
+"""
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from flask import g, session
+
+from models import db, User
+
+# Session key for the version stamp of the logged-in user's own latest
+# change (see `remember_own_changes()`).
+CURR_USER_VERSION_KEY = "curr_user_version"
+
+CACHE_TTL = 30
+CACHE_SIZE = 10000
+
+IDENTITY_COLUMNS = (
+    'id', 'username', 'image_url', 'header_image_url', 'version',
+    'messages_count', 'following_count', 'followers_count', 'likes_count',
+)
+
+Identity = namedtuple('Identity', IDENTITY_COLUMNS)
+
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def get_identity(user_id, version=None):
+    """Return the Identity for `user_id`, or None if there's no such user
+    (or they deleted their account).
+
+    A cached identity is used if it's fresh and (when `version` is given)
+    at least that version.
+    """
+
+    now = time.monotonic()
+
+    with _lock:
+        cached = _cache.get(user_id)
+
+        if cached is not None:
+            identity, expires_at = cached
+
+            if expires_at > now and (version is None or identity.version >= version):
+                _cache.move_to_end(user_id)
+                return identity
+
+            del _cache[user_id]
+
+    row = (db.session
+           .query(*(getattr(User, column) for column in IDENTITY_COLUMNS))
+           .filter(User.id == user_id, User.deleted_at.is_(None))
+           .first())
+
+    if row is None:
+        return None
+
+    identity = Identity(*row)
+
+    with _lock:
+        _cache[user_id] = (identity, now + CACHE_TTL)
+
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return identity
+
+
+def current_version(user_id):
+    """Return the stored version stamp for `user_id`."""
+
+    return (db.session
+            .query(User.version)
+            .filter(User.id == user_id)
+            .scalar())
+
+
+def remember_own_changes():
+    """Record the logged-in user's new version in their session.
+
+    Call after committing a change to the logged-in user (from HTML
+    routes and the API alike), so their next request sees it even if
+    another process has them cached.
+    """
+
+    session[CURR_USER_VERSION_KEY] = current_version(g.user.id)
+
+
+def bump_version(user_id):
+    """Bump `user_id`'s version and profile version stamps after a
+    profile edit, and evict their cached identity; the caller is
+    responsible for committing."""
+
+    users = User.__table__
+
+    db.session.execute(users
+                       .update()
+                       .where(users.c.id == user_id)
+                       .values(version=users.c.version + 1,
+                               profile_version=users.c.profile_version + 1))
+    evict([user_id])
+
+
+def evict(user_ids=None):
+    """Drop cached identities for `user_ids` (or everyone, if None)."""
+
+    with _lock:
+        if user_ids is None:
+            _cache.clear()
+        else:
+            for user_id in user_ids:
+                _cache.pop(user_id, None)
@@ -0,0 +1,155 @@
+"""Per-request SQL query instrumentation.
+
+Listens to SQLAlchemy engine events and records, for every request, how
+many queries ran, how long they took, and which statement shapes were
+repeated (the usual sign of an N+1 pattern, e.g. lazy-loading
+`msg.user` once per message in a template).
+
+In non-production mode the totals are sent back as response headers:
+
+    X-Query-Count: 4
+    X-Query-Time: 3.21          (milliseconds)
+    X-Query-Repeats: 1          (statement shapes run N_PLUS_ONE_THRESHOLD+ times)
+
+Tests can measure any block of code, including test-client requests:
+
+    with assert_max_queries(5):
+        client.get('/')
+"""
+
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# A statement shape run at least this many times in one request is
+# reported as a probable N+1 pattern.
+N_PLUS_ONE_THRESHOLD = 3
+
+_local = threading.local()
+
+
+class QueryStats:
+    """Queries recorded while a collector was active."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def __repr__(self):
+        return f"<QueryStats {self.count} queries, {self.duration * 1000:.2f}ms>"
+
+    def record(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.shapes[shape_of(statement)] += 1
+
+    @property
+    def repeated(self):
+        """Statement shapes run often enough to suggest an N+1 pattern."""
+
+        return {shape: count
+                for shape, count in self.shapes.items()
+                if count >= N_PLUS_ONE_THRESHOLD}
+
+
+def shape_of(statement):
+    """Collapse whitespace so equivalent statements compare equal.
+
+    Statements arrive with bound-parameter placeholders, so the same
+    query run for different rows already has the same text.
+    """
+
+    return re.sub(r'\s+', ' ', statement).strip()
+
+
+def _collectors():
+    if not hasattr(_local, 'collectors'):
+        _local.collectors = []
+    return _local.collectors
+
+
+@contextmanager
+def count_queries():
+    """Record queries run inside the block; yields a QueryStats."""
+
+    stats = QueryStats()
+    _collectors().append(stats)
+
+    try:
+        yield stats
+    finally:
+        _collectors().remove(stats)
+
+
+@contextmanager
+def assert_max_queries(budget):
+    """Fail if the block runs more than `budget` queries."""
+
+    with count_queries() as stats:
+        yield stats
+
+    if stats.count > budget:
+        shapes = '\n'.join(f"  {count}x {shape}"
+                           for shape, count in stats.shapes.most_common())
+        raise AssertionError(
+            f"{stats.count} queries run, budget was {budget}:\n{shapes}")
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start_times', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    duration = time.perf_counter() - conn.info['query_start_times'].pop()
+
+    for stats in _collectors():
+        stats.record(statement, duration)
+
+
+def init_app(app):
+    """Collect query stats for every request handled by `app`.
+
+    Stats for the current request are available as `g.query_stats`.
+    Response headers are added when QUERY_STATS_HEADERS is set, and
+    probable N+1 patterns are logged as warnings.
+    """
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+        _collectors().append(g.query_stats)
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.get('query_stats')
+
+        if stats is None:
+            return response
+
+        if app.config.get('QUERY_STATS_HEADERS'):
+            response.headers['X-Query-Count'] = str(stats.count)
+            response.headers['X-Query-Time'] = f"{stats.duration * 1000:.2f}"
+            response.headers['X-Query-Repeats'] = str(len(stats.repeated))
+
+        for shape, count in stats.repeated.items():
+            app.logger.warning("Probable N+1 query (%dx): %s", count, shape)
+
+        return response
+
+    @app.teardown_request
+    def stop_query_stats(exc):
+        stats = g.pop('query_stats', None)
+
+        if stats in _collectors():
+            _collectors().remove(stats)
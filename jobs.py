@@ -0,0 +1,384 @@
+"""Background jobs.
+
+Heavy write side effects (purging a deleted account, recomputing every
+counter) run outside requests, from a queue kept in the `jobs` table:
+
+    jobs.enqueue('delete_user', user_id=user.id)
+
+and are run by worker processes started with `flask worker`.
+
+Handlers are registered with `@handler(kind)` and are generators that
+do their work in bounded batches, yielding a progress dict after each.
+The worker commits each batch together with its progress on the job
+row, so no transaction holds locks for long, and `flask jobs` shows how
+far each job has got.
+
+A handler that raises is retried with exponential backoff, up to
+MAX_ATTEMPTS times, then marked failed. A running job whose worker
+stops reporting in for JOB_TIMEOUT seconds (say, the process died) is
+put back on the queue. Either way the handler starts over, so each batch
+must work out what's left to do rather than rely on earlier progress.
+"""
+
+import json
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+from multiprocessing import Process
+
+from sqlalchemy import and_, func
+
+from models import (db, Follows, Hashtag, Job, Likes, Message,
+                    Recommendation, TimelineEntry, User)
+import counters
+import recommendations
+import timeline
+
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 10
+JOB_TIMEOUT = 300
+POLL_INTERVAL = 1.0
+
+# Rows handled per batch (and so per transaction).
+BATCH_SIZE = 1000
+
+HANDLERS = {}
+
+
+def handler(kind):
+    """Register the decorated generator as the handler for `kind` jobs.
+
+    It is called with the job's payload as keyword arguments.
+    """
+
+    def register(function):
+        HANDLERS[kind] = function
+        return function
+
+    return register
+
+
+def enqueue(kind, **payload):
+    """Queue a job; the caller is responsible for committing."""
+
+    if kind not in HANDLERS:
+        raise ValueError(f"No handler for {kind} jobs")
+
+    job = Job(kind=kind, payload=json.dumps(payload))
+    db.session.add(job)
+    return job
+
+
+def requeue_stale():
+    """Put back running jobs whose worker has stopped reporting in."""
+
+    jobs = Job.__table__
+    cutoff = datetime.utcnow() - timedelta(seconds=JOB_TIMEOUT)
+
+    db.session.execute(jobs
+                       .update()
+                       .where((jobs.c.status == 'running') &
+                              (jobs.c.locked_at < cutoff))
+                       .values(status='queued', locked_by=None))
+    db.session.commit()
+
+
+def claim(worker_id):
+    """Take the oldest runnable job for `worker_id`; return it, or None."""
+
+    jobs = Job.__table__
+    now = datetime.utcnow()
+
+    candidates = (db.session
+                  .query(Job.id)
+                  .filter(Job.status == 'queued', Job.run_after <= now)
+                  .order_by(Job.id)
+                  .limit(10)
+                  .all())
+
+    for (job_id,) in candidates:
+        # Another worker may take it first; only one UPDATE can match.
+        claimed = db.session.execute(jobs
+                                     .update()
+                                     .where((jobs.c.id == job_id) &
+                                            (jobs.c.status == 'queued'))
+                                     .values(status='running',
+                                             locked_by=worker_id,
+                                             locked_at=now,
+                                             attempts=jobs.c.attempts + 1))
+        db.session.commit()
+
+        if claimed.rowcount == 1:
+            return Job.query.get(job_id)
+
+    return None
+
+
+def run(job):
+    """Run a claimed job to completion, or record why it failed."""
+
+    job_id = job.id
+
+    try:
+        for progress in HANDLERS[job.kind](**json.loads(job.payload)):
+            job.progress = json.dumps(progress)
+            job.locked_at = datetime.utcnow()
+            db.session.commit()
+
+        job.status = 'done'
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+
+    except Exception as error:
+        db.session.rollback()
+        failed(Job.query.get(job_id), error)
+        return False
+
+    return True
+
+
+def failed(job, error):
+    """Schedule a retry of `job` after `error`, or give up on it."""
+
+    job.last_error = f"{type(error).__name__}: {error}"
+    job.locked_by = None
+
+    if job.attempts >= MAX_ATTEMPTS:
+        job.status = 'failed'
+        job.finished_at = datetime.utcnow()
+    else:
+        job.status = 'queued'
+        job.run_after = datetime.utcnow() + timedelta(
+            seconds=RETRY_DELAY * 2 ** (job.attempts - 1))
+
+    db.session.commit()
+
+
+def work(burst=False, report=print):
+    """Run jobs as they come in.
+
+    With `burst`, return (the number of jobs run) once the queue has no
+    runnable jobs left, instead of waiting for more.
+    """
+
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    ran = 0
+
+    while True:
+        requeue_stale()
+        job = claim(worker_id)
+
+        if job is None:
+            if burst:
+                return ran
+
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        report(f"Running job {job.id} ({job.kind})")
+        ok = run(job)
+        report(f"Job {job.id} {'done' if ok else 'failed'}")
+        ran += 1
+
+
+def _work_in_app(app, **options):
+    with app.app_context():
+        work(**options)
+
+
+def work_in_processes(app, processes, **options):
+    """Run `processes` workers in child processes until they exit."""
+
+    # Children must open their own connections, not share ours.
+    db.engine.dispose()
+
+    children = [Process(target=_work_in_app, args=(app,), kwargs=options)
+                for _ in range(processes)]
+
+    for child in children:
+        child.start()
+
+    for child in children:
+        child.join()
+
+
+##############################################################################
+# Handlers
+
+
+def key_batch(column, *conditions):
+    """Return up to BATCH_SIZE values of `column` from matching rows."""
+
+    return [key for (key,) in (db.session
+                               .query(column)
+                               .filter(*conditions)
+                               .limit(BATCH_SIZE))]
+
+
+def delete_where(model, *conditions):
+    table = model.__table__
+    db.session.execute(table.delete().where(and_(*conditions)))
+
+
+@handler('delete_user')
+def delete_user(user_id):
+    """Purge a deleted account and everything that references it.
+
+    Everyone else's counters are adjusted batch by batch, in the same
+    transaction as the rows they count.
+    """
+
+    deleted = (db.session
+               .query(User.id)
+               .filter(User.id == user_id, User.deleted_at.isnot(None))
+               .scalar())
+
+    # Never purge an account that hasn't been deleted.
+    if deleted is None:
+        return
+
+    progress = dict(following=0, followers=0, timeline=0, likes=0, messages=0)
+
+    while True:
+        followed_ids = key_batch(Follows.user_being_followed_id,
+                                 Follows.user_following_id == user_id)
+        if not followed_ids:
+            break
+
+        counters.adjust(followed_ids, followers_count=-1)
+        delete_where(Follows, Follows.user_following_id == user_id,
+                     Follows.user_being_followed_id.in_(followed_ids))
+
+        for author_id in timeline.dropped_to_fanout_limit(followed_ids):
+            enqueue('fan_out_author', author_id=author_id)
+
+        progress['following'] += len(followed_ids)
+        yield progress
+
+    while True:
+        follower_ids = key_batch(Follows.user_following_id,
+                                 Follows.user_being_followed_id == user_id)
+        if not follower_ids:
+            break
+
+        counters.adjust(follower_ids, following_count=-1)
+        delete_where(Follows, Follows.user_being_followed_id == user_id,
+                     Follows.user_following_id.in_(follower_ids))
+        progress['followers'] += len(follower_ids)
+        yield progress
+
+    while True:
+        entry_ids = key_batch(TimelineEntry.message_id,
+                              TimelineEntry.user_id == user_id)
+        if not entry_ids:
+            break
+
+        delete_where(TimelineEntry, TimelineEntry.user_id == user_id,
+                     TimelineEntry.message_id.in_(entry_ids))
+        progress['timeline'] += len(entry_ids)
+        yield progress
+
+    while True:
+        liked_ids = key_batch(Likes.message_id, Likes.user_id == user_id)
+        if not liked_ids:
+            break
+
+        counters.adjust_like_counts(liked_ids, -1)
+        delete_where(Likes, Likes.user_id == user_id,
+                     Likes.message_id.in_(liked_ids))
+        progress['likes'] += len(liked_ids)
+        yield progress
+
+    while True:
+        suggested_to = key_batch(Recommendation.user_id,
+                                 Recommendation.recommended_user_id == user_id)
+        if not suggested_to:
+            break
+
+        delete_where(Recommendation, Recommendation.recommended_user_id == user_id,
+                     Recommendation.user_id.in_(suggested_to))
+        yield progress
+
+    while True:
+        message_ids = key_batch(Message.id, Message.user_id == user_id)
+        if not message_ids:
+            break
+
+        delete_messages(message_ids)
+        progress['messages'] += len(message_ids)
+        yield progress
+
+    delete_where(User, User.id == user_id)
+    yield progress
+
+
+def delete_messages(message_ids):
+    """Delete messages along with their likes, timeline entries and
+    hashtags."""
+
+    # One UPDATE per distinct number of likes lost, not per liker.
+    likers_by_count = {}
+
+    for liker_id, count in (db.session
+                            .query(Likes.user_id, func.count())
+                            .filter(Likes.message_id.in_(message_ids))
+                            .group_by(Likes.user_id)):
+        likers_by_count.setdefault(count, []).append(liker_id)
+
+    for count, liker_ids in likers_by_count.items():
+        counters.adjust(liker_ids, likes_count=-count)
+
+    delete_where(Likes, Likes.message_id.in_(message_ids))
+    delete_where(TimelineEntry, TimelineEntry.message_id.in_(message_ids))
+    delete_where(Hashtag, Hashtag.message_id.in_(message_ids))
+    delete_where(Message, Message.id.in_(message_ids))
+
+
+@handler('reconcile_counters')
+def reconcile_counters():
+    """Recompute every counter, BATCH_SIZE ids at a time."""
+
+    progress = {}
+
+    for name, model, reconcile in (
+            ('users', User, counters.reconcile_user_counters),
+            ('messages', Message, counters.reconcile_message_counters)):
+        last_id = db.session.query(func.max(model.id)).scalar() or 0
+
+        for low in range(1, last_id + 1, BATCH_SIZE):
+            high = low + BATCH_SIZE
+            reconcile((low, high))
+            progress[name] = dict(done=min(high - 1, last_id), total=last_id)
+            yield progress
+
+
+@handler('fan_out_author')
+def fan_out_author(author_id):
+    """Copy an author's recent messages into their followers' timelines,
+    once they're no longer high-fanout (see timeline.py)."""
+
+    progress = dict(followers=0)
+    last_id = 0
+
+    while not timeline.is_high_fanout(author_id):
+        follower_ids = [key for (key,) in (db.session
+                                           .query(Follows.user_following_id)
+                                           .filter(Follows.user_being_followed_id == author_id,
+                                                   Follows.user_following_id > last_id)
+                                           .order_by(Follows.user_following_id)
+                                           .limit(BATCH_SIZE))]
+        if not follower_ids:
+            break
+
+        timeline.backfill_followers(author_id, follower_ids)
+        last_id = follower_ids[-1]
+        progress['followers'] += len(follower_ids)
+        yield progress
+
+
+@handler('recommend_follows')
+def recommend_follows():
+    """Recompute who-to-follow suggestions, a block of users at a time."""
+
+    yield from recommendations.rebuild()
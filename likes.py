@@ -0,0 +1,114 @@
+"""Queries against the `likes` table.
+
+Rendering a page of messages needs to know which of them the viewer has
+liked. `liked_ids_among()` answers that for the whole page in one query,
+so templates check membership in a set instead of scanning the viewer's
+entire likes collection once per message.
+
+Likes are keyed by `(user_id, message_id)`, so liking and unliking are
+each a single keyed statement: an INSERT that ignores an existing like,
+and a DELETE. Whether a row was actually inserted or deleted decides
+how the counters move (the liker's `likes_count` and the message's
+`like_count`), so repeated or racing requests can't skew them.
+"""
+
+from sqlalchemy import func
+
+from models import db, insert_ignoring_conflicts, Likes, Message, User
+import counters
+
+
+def liked_ids_among(user_id, message_ids):
+    """Return the set of `message_ids` that `user_id` has liked."""
+
+    message_ids = list(message_ids)
+
+    if user_id is None or not message_ids:
+        return set()
+
+    rows = (db.session
+            .query(Likes.message_id)
+            .filter(Likes.user_id == user_id,
+                    Likes.message_id.in_(message_ids)))
+    return {message_id for (message_id,) in rows}
+
+
+def liked_authors_stamp(user_id):
+    """Return (count, sum of `profile_version`s) of the active authors of
+    the messages `user_id` has liked.
+
+    Stamps only go up, so the sum changes whenever any of those authors
+    edits their profile; the count changes when one deletes their
+    account. (Liking and unliking bump the liker's own `version`.)
+    """
+
+    author_ids = (db.session
+                  .query(Message.user_id)
+                  .join(Likes, Likes.message_id == Message.id)
+                  .filter(Likes.user_id == user_id))
+
+    count, total = (db.session
+                    .query(func.count(User.id), func.sum(User.profile_version))
+                    .filter(User.id.in_(author_ids.subquery()),
+                            User.deleted_at.is_(None))
+                    .one())
+
+    return count, total or 0
+
+
+def adjust_counts(user_id, message_id, delta):
+    counters.adjust(user_id, likes_count=delta)
+    counters.adjust_like_counts([message_id], delta)
+
+
+def like(user_id, message_id):
+    """Like a message; returns False if it was already liked.
+
+    The caller is responsible for committing.
+    """
+
+    insert = insert_ignoring_conflicts(Likes, user_id=user_id, message_id=message_id)
+    added = db.session.execute(insert).rowcount == 1
+
+    if added:
+        adjust_counts(user_id, message_id, 1)
+
+    return added
+
+
+def unlike(user_id, message_id):
+    """Unlike a message; returns False if it wasn't liked.
+
+    The caller is responsible for committing.
+    """
+
+    likes = Likes.__table__
+    removed = db.session.execute(
+        likes.delete().where((likes.c.user_id == user_id) &
+                             (likes.c.message_id == message_id))).rowcount == 1
+
+    if removed:
+        adjust_counts(user_id, message_id, -1)
+
+    return removed
+
+
+def toggle_like(user_id, message_id):
+    """Unlike the message if `user_id` likes it, else like it.
+
+    Returns whether the message is now liked. The caller is responsible
+    for committing.
+    """
+
+    if unlike(user_id, message_id):
+        return False
+
+    like(user_id, message_id)
+    return True
+
+
+def like_count(message_id):
+    return (db.session
+            .query(Message.like_count)
+            .filter(Message.id == message_id)
+            .scalar())
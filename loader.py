@@ -0,0 +1,284 @@
+"""Bulk loading of users, messages and follows from CSV files.
+
+Loads the users.csv, messages.csv and follows.csv files produced by
+generator/create_csvs.py. Rows are streamed from the files rather than
+read into memory: on Postgres they are piped straight into `COPY ...
+FROM STDIN`, and other backends get batched executemany INSERTs.
+
+The CSVs have no id columns: users and messages are numbered from 1 in
+file order, and messages and follows refer to users by those numbers.
+
+A fresh load (the default) drops and recreates every table, loads the
+rows with secondary indexes dropped, then builds the indexes, resets id
+sequences and rebuilds the derived data (timelines, hashtags, counters
+and the search index). An append load keeps existing data and indexes and
+shifts the new rows' ids (and references to them) past the current
+maximum ids, so a second generated data set can be layered on top.
+Appended messages and follows only refer to appended users, so derived
+data is only built for the new id ranges; existing rows' timelines,
+tags, counters and search entries are left as they are.
+
+Run it with `flask load-data [DIRECTORY] [--append]`.
+"""
+
+import csv
+import io
+import os
+import time
+from datetime import datetime
+
+from sqlalchemy import DateTime, Integer, func, text
+
+from models import (db, User, Message, Follows, Hashtag, TimelineEntry,
+                    username_trgm_index, message_search_index)
+from counters import reconcile_message_counters, reconcile_user_counters
+from hashtags import rebuild_tags
+from message_search import rebuild_index
+from timeline import rebuild_timelines
+
+# Rows per INSERT batch, for backends without COPY.
+BATCH_SIZE = 10000
+
+# Report progress every this many rows of a file.
+PROGRESS_EVERY = 100000
+
+# What to load, in order: (table, CSV file, columns referring to users).
+SOURCES = (
+    (User.__table__, 'users.csv', ()),
+    (Message.__table__, 'messages.csv', ('user_id',)),
+    (Follows.__table__, 'follows.csv',
+     ('user_being_followed_id', 'user_following_id')),
+)
+
+# Postgres indexes defined outside the table definitions (see models.py),
+# as (name, DDL that creates it).
+POSTGRES_INDEXES = (
+    ('ix_users_username_trgm', username_trgm_index),
+    ('ix_messages_search_vector', message_search_index),
+)
+
+TIMESTAMP_FORMATS = ('%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S')
+
+
+def uses_copy():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def parse_timestamp(value):
+    for format in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+
+    raise ValueError(f"Invalid timestamp: {value!r}")
+
+
+def max_id(model):
+    return db.session.query(func.max(model.id)).scalar() or 0
+
+
+def numbered_rows(reader, table, user_refs, offsets):
+    """Yield CSV rows as dicts, with ids assigned and references shifted."""
+
+    id_offset = offsets.get(table.name)
+
+    for n, row in enumerate(reader, 1):
+        if id_offset is not None:
+            row['id'] = id_offset + n
+
+        for column in user_refs:
+            row[column] = int(row[column]) + offsets['users']
+
+        yield row
+
+
+def with_progress(rows, name, report):
+    """Pass `rows` through, reporting a running count and rate."""
+
+    start = time.perf_counter()
+    count = 0
+
+    def rate():
+        elapsed = time.perf_counter() - start
+        return f"{name}: {count:,} rows ({count / elapsed if elapsed else 0:,.0f} rows/sec)"
+
+    for row in rows:
+        yield row
+        count += 1
+
+        if count % PROGRESS_EVERY == 0:
+            report(rate())
+
+    report(rate())
+
+
+class CsvStream:
+    """Read-only file object serving `rows` as CSV text, for COPY."""
+
+    def __init__(self, rows, columns):
+        self.rows = rows
+        self.columns = columns
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def read(self, size=-1):
+        while size < 0 or self.buffer.tell() < size:
+            row = next(self.rows, None)
+
+            if row is None:
+                break
+
+            self.writer.writerow([row[column] for column in self.columns])
+
+        data = self.buffer.getvalue()
+
+        if size >= 0:
+            data, rest = data[:size], data[size:]
+        else:
+            rest = ''
+
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        self.buffer.write(rest)
+        return data
+
+
+def copy_rows(connection, table, columns, rows):
+    """Stream `rows` into `table` with Postgres COPY."""
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table.name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)",
+        CsvStream(rows, columns))
+
+
+def insert_rows(connection, table, columns, rows, batch_size):
+    """Insert `rows` into `table` in batches of executemany INSERTs."""
+
+    def converter(column):
+        if isinstance(column.type, Integer):
+            return int
+        if isinstance(column.type, DateTime):
+            return parse_timestamp
+        if column.nullable:
+            return lambda value: value or None
+        return str
+
+    converters = {column: converter(table.c[column]) for column in columns}
+    insert = table.insert()
+    batch = []
+
+    for row in rows:
+        batch.append({column: convert(row[column])
+                      for column, convert in converters.items()})
+
+        if len(batch) == batch_size:
+            connection.execute(insert, batch)
+            batch = []
+
+    if batch:
+        connection.execute(insert, batch)
+
+
+def drop_secondary_indexes(connection, tables):
+    """Drop indexes on `tables` to speed up loading; return them."""
+
+    indexes = [index for table in tables for index in table.indexes]
+
+    for index in indexes:
+        index.drop(connection)
+
+    if uses_copy():
+        for name, ddl in POSTGRES_INDEXES:
+            connection.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+    return indexes
+
+
+def reset_sequences(connection):
+    """Point id sequences past the ids loaded explicitly (Postgres only)."""
+
+    if not uses_copy():
+        return
+
+    for table in (User.__table__, Message.__table__):
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+            f"(SELECT coalesce(max(id), 0) + 1 FROM {table.name}), false)"))
+
+
+def load(directory, append=False, batch_size=BATCH_SIZE, report=print):
+    """Load the CSV files in `directory`, then rebuild derived data.
+
+    Loads into empty, freshly created tables unless `append` is true,
+    in which case derived data is only built for the appended rows.
+    Commits when done.
+    """
+
+    if not append:
+        db.drop_all()
+        db.create_all()
+
+    connection = db.session.connection()
+    derived_tables = [TimelineEntry.__table__, Hashtag.__table__]
+    source_tables = [table for table, filename, user_refs in SOURCES]
+
+    if append:
+        deferred = []
+    else:
+        deferred = drop_secondary_indexes(connection, source_tables + derived_tables)
+
+    offsets = {'users': max_id(User), 'messages': max_id(Message)}
+
+    for table, filename, user_refs in SOURCES:
+        with open(os.path.join(directory, filename), newline='') as f:
+            reader = csv.DictReader(f)
+            columns = reader.fieldnames + (['id'] if table.name in offsets else [])
+            rows = with_progress(numbered_rows(reader, table, user_refs, offsets),
+                                 table.name, report)
+
+            if uses_copy():
+                copy_rows(connection, table, columns, rows)
+            else:
+                insert_rows(connection, table, columns, rows, batch_size)
+
+    reset_sequences(connection)
+
+    # Derived data is only built for the rows just loaded (everything,
+    # on a fresh load).
+    if append:
+        user_range = (offsets['users'] + 1, max_id(User) + 1)
+        message_range = (offsets['messages'] + 1, max_id(Message) + 1)
+    else:
+        user_range = message_range = None
+
+    # Source tables get their indexes back first, since rebuilding
+    # timelines and counters reads them; timelines and hashtags are
+    # built unindexed. Counters come first: which authors are fanned
+    # out depends on their follower counts.
+    for index in deferred:
+        if index.table not in derived_tables:
+            index.create(connection)
+
+    report("Reconciling counters...")
+    reconcile_user_counters(user_range)
+    reconcile_message_counters(message_range)
+
+    report("Rebuilding timelines and hashtags...")
+    rebuild_timelines(message_range)
+    rebuild_tags(message_range)
+
+    for index in deferred:
+        if index.table in derived_tables:
+            index.create(connection)
+
+    report("Rebuilding the search index...")
+    rebuild_index(message_range)
+
+    if not append and uses_copy():
+        for name, ddl in POSTGRES_INDEXES:
+            connection.execute(ddl)
+
+    db.session.commit()
+    report("Done.")
@@ -0,0 +1,225 @@
+"""Full-text search over messages.
+
+On Postgres, each message's text is indexed in a `search_vector`
+tsvector column with a GIN index (see models.py); searches are ranked
+with `ts_rank`.
+
+Other backends (SQLite in development and tests) use an in-process
+inverted index instead, loaded from the database on first use and
+refreshed every INDEX_TTL seconds. Requests change and search it from
+several threads, so every access holds `_lock`.
+
+Either way, `index_message()` and `unindex_message()` are called from
+the write paths in app.py, and `rebuild_index()` re-indexes a range of
+messages or all of them (`flask load-data` calls it for the rows it
+loads). Messages by deleted users are left out of results.
+"""
+
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from itertools import islice
+
+from sqlalchemy import func
+
+from models import db, Message, User
+
+SEARCH_PAGE_SIZE = 20
+
+# Seconds before the in-process index is reloaded from the database, to
+# pick up messages written by other processes.
+INDEX_TTL = 300
+
+# Text search configuration used for Postgres tsvectors and queries.
+TS_CONFIG = 'english'
+
+STOP_WORDS = frozenset("""
+    a an and are as at be but by for from has have i if in is it its me my
+    no not of on or so that the their them then there these they this to
+    was we were what when which who will with you your
+""".split())
+
+
+def tokenize(text):
+    """Split text into lowercase search terms, dropping stop words."""
+
+    return [word for word in re.findall(r"\w+", text.lower())
+            if word not in STOP_WORDS]
+
+
+class InvertedIndex:
+    """In-memory term -> {message id: term frequency} index."""
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.documents = {}
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, message_id, text):
+        self.remove(message_id)
+        terms = Counter(tokenize(text))
+
+        for term, count in terms.items():
+            self.postings[term][message_id] = count
+
+        self.documents[message_id] = terms
+
+    def remove(self, message_id):
+        terms = self.documents.pop(message_id, None)
+
+        for term in terms or ():
+            postings = self.postings[term]
+            del postings[message_id]
+
+            if not postings:
+                del self.postings[term]
+
+    def search(self, query):
+        """Return ids of messages containing every query term, best first.
+
+        Scores are TF-IDF, normalized by message length; ties are broken
+        newest (highest id) first.
+        """
+
+        terms = set(tokenize(query))
+
+        if not terms or any(term not in self.postings for term in terms):
+            return []
+
+        postings = [self.postings[term] for term in terms]
+        matches = set.intersection(*(set(p) for p in postings))
+        total = len(self.documents)
+
+        def score(message_id):
+            length = sum(self.documents[message_id].values())
+            return sum(p[message_id] * math.log(1 + total / len(p))
+                       for p in postings) / math.sqrt(length)
+
+        return sorted(matches, key=lambda id: (score(id), id), reverse=True)
+
+
+_index = None
+_index_loaded_at = 0
+_lock = threading.Lock()
+
+
+def uses_tsvector():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def by_active_authors(query):
+    """Leave messages by deleted users out of `query`."""
+
+    return (query
+            .join(User, User.id == Message.user_id)
+            .filter(User.deleted_at.is_(None)))
+
+
+def get_index():
+    """Return the process-wide inverted index, (re)loading it if stale."""
+
+    global _index, _index_loaded_at
+
+    if _index is None or time.monotonic() - _index_loaded_at > INDEX_TTL:
+        index = InvertedIndex()
+        messages = by_active_authors(db.session.query(Message.id, Message.text))
+
+        for message_id, text in messages.yield_per(1000):
+            index.add(message_id, text)
+
+        with _lock:
+            _index, _index_loaded_at = index, time.monotonic()
+
+    return _index
+
+
+def index_message(msg):
+    """Index a new message. It must already be flushed so it has an id."""
+
+    if uses_tsvector():
+        msg.search_vector = func.to_tsvector(TS_CONFIG, msg.text)
+        return
+
+    with _lock:
+        if _index is not None:
+            _index.add(msg.id, msg.text)
+
+
+def unindex_message(msg):
+    """Drop a message from the index before it is deleted."""
+
+    # On Postgres the tsvector goes away with the row.
+    if uses_tsvector():
+        return
+
+    with _lock:
+        if _index is not None:
+            _index.remove(msg.id)
+
+
+def search_messages(query, page=1, per_page=SEARCH_PAGE_SIZE):
+    """Return `(messages, has_more)` for one page of matches, best first."""
+
+    offset = (page - 1) * per_page
+
+    if uses_tsvector():
+        ts_query = func.plainto_tsquery(TS_CONFIG, query)
+        messages = (Message.query_with_author()
+                    .filter(Message.search_vector.op('@@')(ts_query))
+                    .order_by(func.ts_rank(Message.search_vector, ts_query).desc(),
+                              Message.id.desc())
+                    .offset(offset)
+                    .limit(per_page + 1)
+                    .all())
+    else:
+        index = get_index()
+
+        with _lock:
+            ids = index.search(query)[offset:offset + per_page + 1]
+
+        by_id = {msg.id: msg
+                 for msg in (Message.query_with_author()
+                             .filter(Message.id.in_(ids)))}
+        messages = [by_id[id] for id in ids if id in by_id]
+
+    return messages[:per_page], len(messages) > per_page
+
+
+def rebuild_index(id_range=None):
+    """Re-index messages with ids in `id_range` (low, high), or every
+    message; the caller is responsible for committing."""
+
+    global _index
+
+    messages = Message.__table__
+
+    if uses_tsvector():
+        update = messages.update()
+
+        if id_range is not None:
+            low, high = id_range
+            update = update.where((messages.c.id >= low) & (messages.c.id < high))
+
+        db.session.execute(update.values(
+            search_vector=func.to_tsvector(TS_CONFIG, messages.c.text)))
+    elif id_range is None:
+        with _lock:
+            _index = None
+
+        get_index()
+    elif _index is not None:
+        low, high = id_range
+        index = _index
+        added = iter(by_active_authors(db.session.query(Message.id, Message.text))
+                     .filter(Message.id >= low, Message.id < high)
+                     .yield_per(1000))
+
+        # Lock a batch at a time, so searches aren't held up for long.
+        for batch in iter(lambda: list(islice(added, 1000)), []):
+            with _lock:
+                for message_id, text in batch:
+                    index.add(message_id, text)
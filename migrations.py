@@ -0,0 +1,288 @@
+"""Schema migrations.
+
+`db.create_all()` creates missing tables but never changes existing
+ones, so changes to a live database's schema are made by migrations:
+functions registered below, in order, with `@migration`. `flask migrate`
+runs the ones that haven't been applied yet and records each in the
+`schema_migrations` table.
+
+The models are always the source of truth for new databases (tests,
+`flask load-data`), which get the whole schema from create_all. So write
+migrations to be harmless on a database that already has the change
+(e.g. CREATE INDEX IF NOT EXISTS), and declare the same change in
+models.py.
+
+On Postgres, indexes are built with CREATE INDEX CONCURRENTLY so they
+don't block writes while they build. That can't run in a transaction,
+so migrations that use `create_index()` are registered with
+`transactional=False`.
+"""
+
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, inspect, select, text
+
+from models import db, Hashtag, Job, Likes, Message, Recommendation, TimelineEntry
+from counters import user_counters_update
+from hashtags import extract_tags
+from message_search import TS_CONFIG
+from timeline import timeline_inserts
+
+Migration = namedtuple('Migration', 'version description upgrade transactional')
+
+MIGRATIONS = []
+
+metadata = MetaData()
+
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('version', String(20), primary_key=True),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+def migration(version, description, transactional=True):
+    """Register the decorated function as the migration `version`.
+
+    The function is called with a connection to run its changes on.
+    """
+
+    def register(upgrade):
+        MIGRATIONS.append(Migration(version, description, upgrade, transactional))
+        return upgrade
+
+    return register
+
+
+def is_postgres(connection):
+    return connection.dialect.name == 'postgresql'
+
+
+def create_index(connection, name, table, columns, using=None):
+    """Create an index if it doesn't exist, concurrently on Postgres.
+
+    `columns` is the SQL column list, e.g. "user_id, timestamp DESC";
+    `using` an index method, e.g. "gin".
+    """
+
+    method = f"USING {using} " if using else ''
+
+    if is_postgres(connection):
+        # A failed concurrent build leaves an invalid index behind, which
+        # IF NOT EXISTS would then skip.
+        invalid = connection.execute(text(
+            "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = indexrelid "
+            "WHERE relname = :name AND NOT indisvalid"), name=name).scalar()
+
+        if invalid:
+            connection.execute(text(f"DROP INDEX CONCURRENTLY {name}"))
+
+        connection.execute(text(
+            f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} {method}({columns})"))
+    else:
+        connection.execute(text(
+            f"CREATE INDEX IF NOT EXISTS {name} ON {table} {method}({columns})"))
+
+
+def add_column(connection, table, name, definition):
+    """Add a column if `table` doesn't have it; return whether it was
+    added.
+
+    `definition` is the SQL type and constraints, e.g. "INTEGER NOT NULL
+    DEFAULT 0".
+    """
+
+    if name in {c['name'] for c in inspect(connection).get_columns(table)}:
+        return False
+
+    connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {definition}"))
+    return True
+
+
+def drop_index(connection, name):
+    """Drop an index if it exists, concurrently on Postgres."""
+
+    concurrently = 'CONCURRENTLY ' if is_postgres(connection) else ''
+    connection.execute(text(f"DROP INDEX {concurrently}IF EXISTS {name}"))
+
+
+def applied_versions(connection):
+    return {version for version, in connection.execute(
+        schema_migrations.select().with_only_columns([schema_migrations.c.version]))}
+
+
+def pending_migrations():
+    """Return the migrations not yet applied to the database, in order."""
+
+    metadata.create_all(db.engine)
+
+    with db.engine.connect() as connection:
+        applied = applied_versions(connection)
+
+    return [m for m in MIGRATIONS if m.version not in applied]
+
+
+def apply(m):
+    """Run one migration and record it as applied."""
+
+    record = schema_migrations.insert().values(version=m.version,
+                                               applied_at=datetime.utcnow())
+
+    if m.transactional or db.engine.dialect.name != 'postgresql':
+        with db.engine.begin() as connection:
+            m.upgrade(connection)
+            connection.execute(record)
+    else:
+        with db.engine.connect() as connection:
+            connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+            m.upgrade(connection)
+            connection.execute(record)
+
+
+def upgrade(report=print):
+    """Apply every pending migration, in order."""
+
+    pending = pending_migrations()
+
+    for m in pending:
+        report(f"Applying {m.version}: {m.description}")
+        apply(m)
+
+    report(f"Applied {len(pending)} migrations.")
+
+
+##############################################################################
+# Migrations, oldest first.
+
+@migration('0001', "Index hot message, follow and like lookups",
+           transactional=False)
+def add_hot_query_indexes(connection):
+    create_index(connection, 'ix_messages_user_id_timestamp_id',
+                 'messages', 'user_id, timestamp DESC, id')
+    create_index(connection, 'ix_follows_user_following_id',
+                 'follows', 'user_following_id')
+    create_index(connection, 'ix_likes_user_id_message_id',
+                 'likes', 'user_id, message_id')
+
+
+@migration('0002', "Key likes by (user_id, message_id) and count likes per message")
+def rekey_likes(connection):
+    add_column(connection, 'messages', 'like_count', "INTEGER NOT NULL DEFAULT 0")
+
+    # The old table had a surrogate id and a unique message_id (so only
+    # one user could like a message). Constraints can't be changed in
+    # place on every backend, so copy the likes into a new table.
+    if 'id' in {c['name'] for c in inspect(connection).get_columns('likes')}:
+        connection.execute(text(
+            "CREATE TABLE likes_old AS SELECT user_id, message_id FROM likes"))
+        connection.execute(text("DROP TABLE likes"))
+        Likes.__table__.create(connection)
+        connection.execute(text(
+            "INSERT INTO likes (user_id, message_id) "
+            "SELECT DISTINCT user_id, message_id FROM likes_old "
+            "WHERE user_id IS NOT NULL AND message_id IS NOT NULL"))
+        connection.execute(text("DROP TABLE likes_old"))
+
+    # Covered by the new primary key.
+    connection.execute(text("DROP INDEX IF EXISTS ix_likes_user_id_message_id"))
+
+    connection.execute(text(
+        "UPDATE messages SET like_count = "
+        "(SELECT count(*) FROM likes WHERE likes.message_id = messages.id)"))
+
+
+@migration('0003', "Add the background job queue and soft-deleted users")
+def add_jobs(connection):
+    add_column(connection, 'users', 'deleted_at', "TIMESTAMP")
+    Job.__table__.create(connection, checkfirst=True)
+
+
+@migration('0004', "Add who-to-follow recommendations")
+def add_recommendations(connection):
+    Recommendation.__table__.create(connection, checkfirst=True)
+
+
+@migration('0005', "Index hashtags used in messages")
+def add_hashtags(connection):
+    hashtags = Hashtag.__table__
+    messages = Message.__table__
+
+    hashtags.create(connection, checkfirst=True)
+    connection.execute(hashtags.delete())
+
+    rows = []
+    results = (connection
+               .execution_options(stream_results=True)
+               .execute(select([messages.c.id, messages.c.text, messages.c.timestamp])))
+
+    for message_id, message_text, timestamp in results:
+        rows.extend(dict(tag=tag, message_id=message_id, timestamp=timestamp)
+                    for tag in extract_tags(message_text))
+
+        if len(rows) >= 10000:
+            connection.execute(hashtags.insert(), rows)
+            rows = []
+
+    if rows:
+        connection.execute(hashtags.insert(), rows)
+
+
+@migration('0006', "Denormalize follower, following, message and like counts on users")
+def add_user_counters(connection):
+    added = [add_column(connection, 'users', name, "INTEGER NOT NULL DEFAULT 0")
+             for name in ('messages_count', 'following_count',
+                          'followers_count', 'likes_count')]
+
+    if any(added):
+        connection.execute(user_counters_update())
+
+
+@migration('0007', "Add version stamps to users")
+def add_user_versions(connection):
+    add_column(connection, 'users', 'version', "INTEGER NOT NULL DEFAULT 1")
+
+
+@migration('0008', "Materialize home timelines")
+def add_timelines(connection):
+    # Fills the new table from follows and messages; an existing table
+    # is already kept up to date by the write paths.
+    if 'timelines' in inspect(connection).get_table_names():
+        return
+
+    TimelineEntry.__table__.create(connection)
+
+    # Which authors are fanned out depends on followers_count (0006).
+    for insert in timeline_inserts():
+        connection.execute(insert)
+
+
+@migration('0009', "Index usernames for trigram search", transactional=False)
+def add_username_trigram_index(connection):
+    if not is_postgres(connection):
+        return
+
+    connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    create_index(connection, 'ix_users_username_trgm', 'users',
+                 'lower(username) gin_trgm_ops', using='gin')
+
+
+@migration('0010', "Add full-text search vectors to messages", transactional=False)
+def add_message_search_vectors(connection):
+    if not is_postgres(connection):
+        # Other backends search an in-process index; the column stays empty.
+        add_column(connection, 'messages', 'search_vector', "TEXT")
+        return
+
+    if add_column(connection, 'messages', 'search_vector', "TSVECTOR"):
+        connection.execute(text(
+            "UPDATE messages SET search_vector = to_tsvector(:config, text)"),
+            config=TS_CONFIG)
+
+    create_index(connection, 'ix_messages_search_vector', 'messages',
+                 'search_vector', using='gin')
+
+
+@migration('0011', "Add profile version stamps to users")
+def add_user_profile_versions(connection):
+    add_column(connection, 'users', 'profile_version', "INTEGER NOT NULL DEFAULT 1")
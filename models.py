@@ -2,11 +2,14 @@
 
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import DDL, event
+from sqlalchemy.dialects.postgresql import TSVECTOR, insert as pg_insert
+from sqlalchemy.orm import contains_eager
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+import passwords
+from replicas import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
 
 
 class Follows(db.Model):
@@ -14,6 +17,11 @@ class Follows(db.Model):
 
     __tablename__ = 'follows'
 
+    # The primary key covers "who follows X"; this covers "who does X follow".
+    __table_args__ = (
+        db.Index('ix_follows_user_following_id', 'user_following_id'),
+    )
+
     user_being_followed_id = db.Column(
         db.Integer,
         db.ForeignKey('users.id', ondelete="cascade"),
@@ -30,22 +38,24 @@ class Follows(db.Model):
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
+    __tablename__ = 'likes'
 
-    id = db.Column(
-        db.Integer,
-        primary_key=True
+    # The primary key covers "has X liked this"; this index covers
+    # "who liked this message" (counting, and cascading deletes).
+    __table_args__ = (
+        db.Index('ix_likes_message_id', 'message_id'),
     )
 
     user_id = db.Column(
         db.Integer,
-        db.ForeignKey('users.id', ondelete='cascade')
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
     )
 
     message_id = db.Column(
         db.Integer,
         db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        primary_key=True,
     )
 
 
@@ -94,6 +104,65 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Denormalized counts, maintained by the write paths in app.py
+    # (see counters.py) so pages don't load collections to count them.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever anything shown about this user changes, so caches
+    # keyed on it (see identity.py) know when to refresh.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # Bumped only when the user's profile (username, images, bio)
+    # changes, not their counters, so fragments showing just the
+    # profile (message cards; see fragment_cache.py) stay cached as
+    # followers and likes come and go.
+    profile_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # Set when the account is deleted. The user is hidden from then on,
+    # and their rows are purged in batches by a background job (see
+    # jobs.py).
+    deleted_at = db.Column(
+        db.DateTime,
+        nullable=True,
+    )
+
     messages = db.relationship('Message')
 
     followers = db.relationship(
@@ -101,7 +170,6 @@ class User(db.Model):
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
         secondaryjoin=(Follows.user_following_id == id),
-        lazy='subquery'
     )
 
     following = db.relationship(
@@ -109,7 +177,6 @@ class User(db.Model):
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
         secondaryjoin=(Follows.user_being_followed_id == id),
-        lazy='subquery'
     )
 
     likes = db.relationship(
@@ -123,14 +190,31 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return self._follow_exists(follower=other_user, followed=self)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return self._follow_exists(follower=self, followed=other_user)
+
+    @staticmethod
+    def _follow_exists(follower, followed):
+        """Look up a single follow by primary key, without loading
+        either user's followers/following collections."""
+
+        return db.session.query(
+            Follows
+            .query
+            .filter(Follows.user_being_followed_id == followed.id,
+                    Follows.user_following_id == follower.id)
+            .exists()
+        ).scalar()
+
+    @classmethod
+    def active(cls):
+        """Query users, leaving out deleted accounts."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -139,7 +223,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = passwords.hash_password(password)
 
         user = User(
             username=username,
@@ -160,18 +244,41 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the user's hash was made with a different bcrypt work factor
+        than the configured one, it is replaced with a new hash; the
+        caller is responsible for committing.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.active().filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = passwords.check_password(user.password, password)
             if is_auth:
+                if passwords.needs_rehash(user.password):
+                    user.password = passwords.hash_password(password)
                 return user
 
         return False
 
 
+# Trigram index for username search (see user_search.py). Postgres only;
+# other backends fall back to an in-process prefix trie.
+
+event.listen(
+    User.__table__,
+    'after_create',
+    DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect='postgresql'),
+)
+
+username_trgm_index = DDL(
+    "CREATE INDEX ix_users_username_trgm "
+    "ON users USING gin (lower(username) gin_trgm_ops)"
+).execute_if(dialect='postgresql')
+
+event.listen(User.__table__, 'after_create', username_trgm_index)
+
+
 class Message(db.Model):
     """An individual message ("warble")."""
 
@@ -190,7 +297,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -199,8 +306,248 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Denormalized count of likes, maintained by likes.py.
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Full-text search document (see message_search.py). Only populated
+    # on Postgres; other backends use an in-process index instead.
+    search_vector = db.deferred(db.Column(
+        db.Text().with_variant(TSVECTOR(), 'postgresql'),
+    ))
+
     user = db.relationship('User')
 
+    @classmethod
+    def query_with_author(cls):
+        """Query messages by users who haven't deleted their accounts,
+        eager-loading their authors.
+
+        Joins in just the author columns that message lists render (and
+        the version stamps their fragment cache keys and validators use),
+        so a page of messages doesn't lazy-load `msg.user` once per
+        message. A deleted user's messages stay in the table until the
+        purge job gets to them (see jobs.py), so the join also hides them.
+        """
+
+        return (cls.query
+                .join(cls.user)
+                .options(contains_eager(cls.user)
+                         .load_only('id', 'username', 'image_url',
+                                    'version', 'profile_version'))
+                .filter(User.deleted_at.is_(None)))
+
+
+message_search_index = DDL(
+    "CREATE INDEX ix_messages_search_vector "
+    "ON messages USING gin (search_vector)"
+).execute_if(dialect='postgresql')
+
+event.listen(Message.__table__, 'after_create', message_search_index)
+
+# Profile pages and the API list a user's messages newest-first.
+db.Index('ix_messages_user_id_timestamp_id',
+         Message.user_id, Message.timestamp.desc(), Message.id)
+
+
+class TimelineEntry(db.Model):
+    """A message materialized into a user's home timeline."""
+
+    __tablename__ = 'timelines'
+
+    __table_args__ = (
+        db.Index('ix_timelines_user_id_timestamp', 'user_id', 'timestamp'),
+        db.Index('ix_timelines_message_id', 'message_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class Hashtag(db.Model):
+    """A hashtag used in a message (see hashtags.py)."""
+
+    __tablename__ = 'hashtags'
+
+    # One row per tag per message. The indexes cover a tag's messages
+    # newest-first, loading recent tags for trending counts, and
+    # cascading deletes of messages.
+    __table_args__ = (
+        db.Index('ix_hashtags_tag_timestamp_message_id',
+                 'tag', 'timestamp', 'message_id'),
+        db.Index('ix_hashtags_timestamp', 'timestamp'),
+        db.Index('ix_hashtags_message_id', 'message_id'),
+    )
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # Copied from the message, so a tag's page is read in index order.
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class Recommendation(db.Model):
+    """A suggested account for a user to follow (see recommendations.py)."""
+
+    __tablename__ = 'follow_recommendations'
+
+    # The primary key serves "this user's suggestions, best first"; this
+    # index serves purging a deleted user from everyone's suggestions.
+    __table_args__ = (
+        db.Index('ix_follow_recommendations_recommended_user_id',
+                 'recommended_user_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    recommended_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    # How many of the people `user_id` follows follow this account.
+    score = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+
+class Job(db.Model):
+    """A unit of background work, run by `flask worker` (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_after', 'status', 'run_after'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # JSON arguments for the job's handler.
+    payload = db.Column(
+        db.Text,
+        nullable=False,
+        default='{}',
+    )
+
+    # queued, running, done or failed.
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='queued',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    run_after = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # Which worker is running the job, and when it last reported in.
+    locked_by = db.Column(
+        db.Text,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    # JSON progress reported by the handler after each batch.
+    progress = db.Column(
+        db.Text,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    finished_at = db.Column(
+        db.DateTime,
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.kind}, {self.status}>"
+
+
+def insert_ignoring_conflicts(model, **values):
+    """Return an INSERT of one `model` row that does nothing if a row
+    with the same key already exists.
+
+    Executing it gives a rowcount of 1 if the row was inserted, else 0.
+    """
+
+    table = model.__table__
+
+    if db.engine.dialect.name == 'postgresql':
+        return pg_insert(table).values(**values).on_conflict_do_nothing()
+
+    return table.insert().prefix_with('OR IGNORE').values(**values)
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
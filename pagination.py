@@ -0,0 +1,84 @@
+"""Keyset (cursor) pagination for message lists.
+
+Pages are ordered newest-first by `(timestamp, id)`. Instead of an
+OFFSET, each page hands out an opaque `before` cursor encoding the key
+of its last row; the next page asks for rows strictly older than that
+key, which an index on `(timestamp, id)` answers without scanning the
+rows already shown.
+"""
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+PAGE_SIZE = 100
+
+CURSOR_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(timestamp, id):
+    """Encode a `(timestamp, id)` key as an opaque URL-safe token."""
+
+    raw = f"{timestamp.strftime(CURSOR_TIMESTAMP_FORMAT)}|{id}"
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Decode a token from `encode_cursor` back into `(timestamp, id)`.
+
+    Raises ValueError if the token is malformed.
+    """
+
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        raw = urlsafe_b64decode(padded.encode('ascii')).decode('utf-8')
+        timestamp, id = raw.split('|')
+        return datetime.strptime(timestamp, CURSOR_TIMESTAMP_FORMAT), int(id)
+    except (Base64Error, UnicodeError, ValueError):
+        raise ValueError(f"Invalid cursor: {token!r}")
+
+
+def older_than(timestamp_col, id_col, cursor):
+    """Return a filter for rows strictly older than `cursor`."""
+
+    timestamp, id = cursor
+    return or_(timestamp_col < timestamp,
+               and_(timestamp_col == timestamp, id_col < id))
+
+
+def keyset_page(query, timestamp_col, id_col, before=None, limit=None):
+    """Fetch one newest-first page of `query`.
+
+    `before` is a decoded cursor (or None for the first page); `limit`
+    defaults to PAGE_SIZE. Returns `(rows, next_cursor)`, where
+    `next_cursor` is the token for the following page, or None if this
+    is the last page. Rows must expose `timestamp` and `id` attributes.
+    """
+
+    limit = limit or PAGE_SIZE
+
+    if before is not None:
+        query = query.filter(older_than(timestamp_col, id_col, before))
+
+    rows = (query
+            .order_by(timestamp_col.desc(), id_col.desc())
+            .limit(limit + 1)
+            .all())
+
+    return page_of(rows, limit)
+
+
+def page_of(rows, limit):
+    """Trim a newest-first list fetched with `limit + 1` rows to a page.
+
+    Returns `(rows, next_cursor)` as for `keyset_page`.
+    """
+
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(last.timestamp, last.id)
@@ -0,0 +1,146 @@
+"""Password hashing off the request thread.
+
+bcrypt is deliberately slow, so hashing (on signup) and checking (on
+login) inside the request would let a burst of logins pin every worker
+on CPU. Instead, both run in a small process pool; requests wait on the
+result, and at most MAX_PENDING hashes can be queued before callers
+block, so a burst degrades into waiting rather than piling up work.
+
+Configured from the app (see `init_app`):
+
+    BCRYPT_LOG_ROUNDS       bcrypt work factor (default 12)
+    PASSWORD_HASH_WORKERS   pool size; 0 hashes in the calling process
+
+Hashes made with a different work factor are upgraded transparently on
+the next successful login (see `User.authenticate`).
+"""
+
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+LOG_ROUNDS = 12
+WORKERS = 2
+
+# Most hash jobs queued or running at once, per worker.
+MAX_PENDING_PER_WORKER = 8
+
+_executor = None
+_slots = None
+_lock = threading.Lock()
+
+_metrics = dict(pending=0, completed=0, total_seconds=0.0, max_seconds=0.0)
+
+
+def init_app(app):
+    """Configure the work factor and pool size from `app.config`."""
+
+    global LOG_ROUNDS, WORKERS
+
+    LOG_ROUNDS = app.config.setdefault('BCRYPT_LOG_ROUNDS', LOG_ROUNDS)
+    WORKERS = app.config.setdefault('PASSWORD_HASH_WORKERS', WORKERS)
+    shutdown()
+
+
+def shutdown():
+    """Stop the worker pool; it is recreated on next use."""
+
+    global _executor, _slots
+
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown()
+        _executor = _slots = None
+
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         bcrypt.gensalt(rounds)).decode('utf-8')
+
+
+def _check(pw_hash, password):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+    except ValueError:
+        # Not a bcrypt hash at all
+        return False
+
+
+def _run(fn, *args):
+    """Run `fn(*args)` in the pool (or inline) and record metrics."""
+
+    if not WORKERS:
+        return _timed(fn, *args)
+
+    executor, slots = _pool()
+
+    def submit(*args):
+        with slots:
+            return executor.submit(fn, *args).result()
+
+    return _timed(submit, *args)
+
+
+def _pool():
+    global _executor, _slots
+
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=WORKERS)
+            _slots = threading.BoundedSemaphore(WORKERS * MAX_PENDING_PER_WORKER)
+
+        return _executor, _slots
+
+
+def _timed(fn, *args):
+    """Call `fn(*args)`, counting it as pending until it returns."""
+
+    start = time.perf_counter()
+
+    with _lock:
+        _metrics['pending'] += 1
+
+    try:
+        return fn(*args)
+    finally:
+        elapsed = time.perf_counter() - start
+
+        with _lock:
+            _metrics['pending'] -= 1
+            _metrics['completed'] += 1
+            _metrics['total_seconds'] += elapsed
+            _metrics['max_seconds'] = max(_metrics['max_seconds'], elapsed)
+
+
+def hash_password(password):
+    """Return a bcrypt hash of `password` at the configured work factor."""
+
+    return _run(_hash, password, LOG_ROUNDS)
+
+
+def check_password(pw_hash, password):
+    """Does `password` match the bcrypt hash `pw_hash`?"""
+
+    return _run(_check, pw_hash, password)
+
+
+def needs_rehash(pw_hash):
+    """Was `pw_hash` made with a work factor other than the configured one?"""
+
+    try:
+        return int(pw_hash.split('$')[2]) != LOG_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+
+def metrics():
+    """Return hashing queue depth and latency figures (seconds)."""
+
+    with _lock:
+        stats = dict(_metrics)
+
+    stats['mean_seconds'] = (stats['total_seconds'] / stats['completed']
+                             if stats['completed'] else 0.0)
+    return stats
@@ -0,0 +1,189 @@
+"""Who-to-follow recommendations.
+
+Suggests friends of friends: the accounts followed by the people a user
+follows, scored by how many of them follow it, leaving out accounts the
+user already follows.
+
+`rebuild()` exports the follow graph into compressed sparse row (CSR)
+arrays, where the users that user i follows (i being a position in the
+sorted ids of active users) are `indices[indptr[i]:indptr[i + 1]]`, and
+then scores a block of users at a time, each block with one sparse
+matrix product, A[block] @ A, which counts the two-step paths to every
+candidate. NumPy and SciPy are in requirements.txt; where they can't be
+installed, a pure-Python loop over the same arrays gives the same
+results, only much slower.
+
+The TOP_K best suggestions for each user are stored in the
+`follow_recommendations` table, which the home page reads with one
+indexed query (`for_user()`). Suggestions are only as fresh as the last
+rebuild, so rebuild them periodically, e.g. nightly from cron with
+`flask recommend-follows --queue` and a running worker.
+"""
+
+import heapq
+from array import array
+from collections import Counter, namedtuple
+
+from sqlalchemy import exists
+
+from models import db, Follows, Recommendation, User
+
+try:
+    import numpy
+    from scipy import sparse
+except ImportError:
+    numpy = sparse = None
+
+TOP_K = 10
+BLOCK_SIZE = 1000
+SIDEBAR_SIZE = 5
+
+Graph = namedtuple('Graph', 'user_ids indptr indices')
+
+
+def load_graph():
+    """Export the follows between active users as CSR arrays."""
+
+    user_ids = array('q', (user_id for (user_id,) in (db.session
+                                                     .query(User.id)
+                                                     .filter(User.deleted_at.is_(None))
+                                                     .order_by(User.id)
+                                                     .yield_per(10000))))
+    position = {user_id: i for i, user_id in enumerate(user_ids)}
+
+    counts = array('q', bytes(8 * (len(user_ids) + 1)))
+    indices = array('q')
+
+    # Sorted by follower, so each user's follows are contiguous.
+    edges = (db.session
+             .query(Follows.user_following_id, Follows.user_being_followed_id)
+             .order_by(Follows.user_following_id, Follows.user_being_followed_id)
+             .yield_per(10000))
+
+    for follower_id, followed_id in edges:
+        follower = position.get(follower_id)
+        followed = position.get(followed_id)
+
+        if follower is not None and followed is not None:
+            indices.append(followed)
+            counts[follower + 1] += 1
+
+    for i in range(1, len(counts)):
+        counts[i] += counts[i - 1]
+
+    return Graph(user_ids, counts, indices)
+
+
+def python_scorer(graph):
+    """Return a function scoring blocks of users in pure Python."""
+
+    indptr, indices = graph.indptr, graph.indices
+
+    def score(start, stop, k):
+        for i in range(start, stop):
+            followed = indices[indptr[i]:indptr[i + 1]]
+            paths = Counter()
+
+            for j in followed:
+                paths.update(indices[indptr[j]:indptr[j + 1]])
+
+            excluded = set(followed)
+            excluded.add(i)
+
+            # Best score first, then lowest id.
+            best = heapq.nsmallest(k, ((-count, candidate)
+                                       for candidate, count in paths.items()
+                                       if candidate not in excluded))
+            yield i, [(candidate, -count) for count, candidate in best]
+
+    return score
+
+
+def numpy_scorer(graph):
+    """Return a function scoring blocks of users with sparse matrix products."""
+
+    n = len(graph.user_ids)
+    indices = numpy.frombuffer(graph.indices, dtype=numpy.int64)
+    adjacency = sparse.csr_matrix(
+        (numpy.ones(len(indices), dtype=numpy.int32), indices,
+         numpy.frombuffer(graph.indptr, dtype=numpy.int64)),
+        shape=(n, n))
+
+    def score(start, stop, k):
+        block = adjacency[start:stop]
+        rows = numpy.arange(stop - start)
+        itself = sparse.csr_matrix(
+            (numpy.ones(len(rows), dtype=numpy.int32), (rows, rows + start)),
+            shape=(stop - start, n))
+
+        # Count paths through followed users, then zero out the users
+        # themselves and whoever they already follow.
+        paths = (block @ adjacency).tocsr()
+        paths = (paths - paths.multiply(block + itself)).tocsr()
+        paths.eliminate_zeros()
+
+        for row in rows:
+            begin, end = paths.indptr[row], paths.indptr[row + 1]
+            candidates = paths.indices[begin:end]
+            counts = paths.data[begin:end]
+            best = numpy.lexsort((candidates, -counts))[:k]
+            yield start + row, [(int(candidates[b]), int(counts[b])) for b in best]
+
+    return score
+
+
+def rebuild(k=TOP_K, block_size=BLOCK_SIZE, use_numpy=True):
+    """Recompute every user's top `k` suggestions, a block of users at a
+    time, yielding progress after each block.
+
+    The caller is responsible for committing each block.
+    """
+
+    graph = load_graph()
+    n = len(graph.user_ids)
+
+    if use_numpy and sparse is not None:
+        score = numpy_scorer(graph)
+    else:
+        score = python_scorer(graph)
+
+    table = Recommendation.__table__
+
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        rows = [dict(user_id=graph.user_ids[i],
+                     rank=rank,
+                     recommended_user_id=graph.user_ids[candidate],
+                     score=count)
+                for i, candidates in score(start, stop, k)
+                for rank, (candidate, count) in enumerate(candidates, 1)]
+
+        # Also clears suggestions for deleted users in this id range.
+        db.session.execute(table.delete().where(
+            table.c.user_id.between(graph.user_ids[start], graph.user_ids[stop - 1])))
+
+        if rows:
+            db.session.execute(table.insert(), rows)
+
+        yield dict(users=stop, total=n)
+
+
+def for_user(user_id, limit=SIDEBAR_SIZE):
+    """Return up to `limit` suggested users for `user_id`, best first.
+
+    Skips accounts followed or deleted since the last rebuild.
+    """
+
+    already_following = exists().where(
+        (Follows.user_following_id == user_id) &
+        (Follows.user_being_followed_id == User.id))
+
+    return (User
+            .query
+            .join(Recommendation, Recommendation.recommended_user_id == User.id)
+            .filter(Recommendation.user_id == user_id,
+                    User.deleted_at.is_(None),
+                    ~already_following)
+            .order_by(Recommendation.rank)
+            .limit(limit)
+            .all())
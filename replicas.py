@@ -0,0 +1,138 @@
+"""Read-replica routing.
+
+When SQLALCHEMY_REPLICA_URIS lists one or more replica databases, reads
+made while handling GET and HEAD requests go to a replica, and
+everything else (writes, POSTs, CLI commands) to the primary, which is
+SQLALCHEMY_DATABASE_URI as before:
+
+- Each request reads from one replica, picked round-robin among the
+  healthy ones. A replica whose connection fails is left out for
+  REPLICA_RETRY_SECONDS, then tried again; with none healthy, reads go
+  to the primary.
+- Once a request writes, its later reads go to the primary too, and the
+  client is pinned to the primary for REPLICA_PIN_SECONDS (tracked in
+  their session), so they see their own changes despite replication lag.
+
+Only plain SELECTs are routed; raw SQL text always runs on the primary.
+
+To try it locally with two database files, point DATABASE_URL and
+DATABASE_REPLICA_URLS at two SQLite files and copy the primary's file
+over the replica's to "replicate".
+"""
+
+import itertools
+import threading
+import time
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.expression import Delete, Insert, Select, Update
+
+PIN_KEY = 'primary_until'
+
+REPLICA_PIN_SECONDS = 10
+REPLICA_RETRY_SECONDS = 30
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+class ReplicaSet:
+    """Round-robin selection among replica engines, skipping failed ones."""
+
+    def __init__(self, engines, retry_after=REPLICA_RETRY_SECONDS):
+        self.engines = list(engines)
+        self.retry_after = retry_after
+        self._down_until = {}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self._on_error)
+
+    def _on_error(self, context):
+        # context.connection is None when connecting failed.
+        if context.is_disconnect or context.connection is None:
+            self.mark_down(context.engine)
+
+    def mark_down(self, engine):
+        with self._lock:
+            self._down_until[engine] = time.monotonic() + self.retry_after
+
+    def healthy(self):
+        """Return the engines not currently marked down."""
+
+        now = time.monotonic()
+
+        with self._lock:
+            return [engine for engine in self.engines
+                    if self._down_until.get(engine, 0) <= now]
+
+    def choose(self):
+        """Return the next healthy replica engine, or None."""
+
+        engines = self.healthy()
+
+        if not engines:
+            return None
+
+        return engines[next(self._turn) % len(engines)]
+
+
+class RoutingSession(SignallingSession):
+    """A session that sends the current request's reads to a replica."""
+
+    def get_bind(self, mapper=None, clause=None):
+        replicas = self.app.extensions.get('replicas')
+
+        if replicas is None or not has_request_context():
+            return super().get_bind(mapper, clause)
+
+        if self._flushing or isinstance(clause, (Insert, Update, Delete)):
+            self.info['wrote'] = g.wrote_to_primary = True
+
+        elif (isinstance(clause, Select) and
+              g.get('read_from_replica') and
+              not self.info.get('wrote')):
+            if 'replica' not in self.info:
+                self.info['replica'] = replicas.choose()
+
+            if self.info['replica'] is not None:
+                return self.info['replica']
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, with sessions that can read from replicas."""
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def is_pinned():
+    return session.get(PIN_KEY, 0) > time.time()
+
+
+def init_app(app):
+    """Create engines for the replicas in SQLALCHEMY_REPLICA_URIS."""
+
+    uris = app.config.setdefault('SQLALCHEMY_REPLICA_URIS', [])
+    pin_seconds = app.config.setdefault('REPLICA_PIN_SECONDS', REPLICA_PIN_SECONDS)
+    retry_after = app.config.setdefault('REPLICA_RETRY_SECONDS', REPLICA_RETRY_SECONDS)
+
+    if uris:
+        engines = [create_engine(uri, pool_pre_ping=True) for uri in uris]
+        app.extensions['replicas'] = ReplicaSet(engines, retry_after)
+
+    @app.before_request
+    def choose_database():
+        g.read_from_replica = request.method in READ_METHODS and not is_pinned()
+
+    @app.after_request
+    def pin_writers(response):
+        if g.get('wrote_to_primary'):
+            session[PIN_KEY] = time.time() + pin_seconds
+
+        return response
@@ -0,0 +1,177 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_api.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Message, User, Likes, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import identity
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ApiTestCase(TestCase):
+    """Test the /api/v1 endpoints."""
+
+    def setUp(self):
+        """Make two users; u2 follows u1, who has written three messages."""
+
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        u1 = User.signup(username="testuser",
+                         email="test@test.com",
+                         password="testuser",
+                         image_url=None)
+        u2 = User.signup(username="testuser2",
+                         email="test2@test.com",
+                         password="testuser",
+                         image_url=None)
+        db.session.commit()
+
+        self.u1_id, self.u2_id = u1.id, u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2_id
+
+            c.post(f'/users/follow/{self.u1_id}')
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1_id
+
+            for text in ('first', 'second', 'third'):
+                c.post('/messages/new', data={'text': text})
+
+        self.msg_ids = [id for id, in db.session
+                        .query(Message.id)
+                        .order_by(Message.timestamp, Message.id)]
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_timeline_pages(self):
+        """Does the timeline page newest-first with cursors?"""
+
+        with self.client as c:
+            self.login(c, self.u2_id)
+
+            resp = c.get('/api/v1/timeline?limit=2')
+            page = resp.get_json()
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual([m['text'] for m in page['messages']], ['third', 'second'])
+            self.assertEqual(page['messages'][0]['username'], 'testuser')
+            self.assertIsNotNone(page['next_before'])
+
+            resp = c.get(f'/api/v1/timeline?limit=2&before={page["next_before"]}')
+            page = resp.get_json()
+
+            self.assertEqual([m['text'] for m in page['messages']], ['first'])
+            self.assertIsNone(page['next_before'])
+
+    def test_timeline_requires_login(self):
+        """Is the timeline refused to anonymous users, as JSON?"""
+
+        resp = app.test_client().get('/api/v1/timeline')
+
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn('error', resp.get_json())
+
+    def test_user_messages_fields(self):
+        """Are only the requested fields returned?"""
+
+        resp = self.client.get(f'/api/v1/users/{self.u1_id}/messages?fields=id,text')
+        page = resp.get_json()
+
+        self.assertEqual(page['messages'][0], {'id': self.msg_ids[-1], 'text': 'third'})
+        self.assertEqual(len(page['messages']), 3)
+
+        resp = self.client.get(f'/api/v1/users/{self.u1_id}/messages?fields=password')
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.get(f'/api/v1/users/{self.u1_id}/messages?before=nope')
+        self.assertEqual(resp.status_code, 400)
+
+        resp = self.client.get('/api/v1/users/999999/messages')
+        self.assertEqual(resp.status_code, 404)
+
+    def test_user_likes(self):
+        """Does the likes endpoint list liked messages?"""
+
+        db.session.add(Likes(user_id=self.u2_id, message_id=self.msg_ids[0]))
+        db.session.commit()
+
+        resp = self.client.get(f'/api/v1/users/{self.u2_id}/likes')
+        page = resp.get_json()
+
+        self.assertEqual([m['id'] for m in page['messages']], [self.msg_ids[0]])
+        self.assertEqual(page['messages'][0]['user_id'], self.u1_id)
+
+    def test_bulk_follow(self):
+        """Are follows added and removed in bulk, skipping no-ops?"""
+
+        u3 = User.signup(username="testuser3",
+                         email="test3@test.com",
+                         password="testuser",
+                         image_url=None)
+        db.session.commit()
+        u3_id = u3.id
+
+        with self.client as c:
+            self.login(c, self.u2_id)
+
+            # Already following u1; 999999 doesn't exist.
+            resp = c.post('/api/v1/follows',
+                          json={'follow': [self.u1_id, u3_id, 999999]})
+            self.assertEqual(resp.get_json(),
+                             {'followed': 1, 'unfollowed': 0, 'following_count': 2})
+
+            # The user's own change is remembered, as on HTML routes.
+            with c.session_transaction() as sess:
+                self.assertEqual(sess[identity.CURR_USER_VERSION_KEY],
+                                 identity.current_version(self.u2_id))
+
+            resp = c.post('/api/v1/follows', json={'unfollow': [self.u1_id, u3_id]})
+            self.assertEqual(resp.get_json(),
+                             {'followed': 0, 'unfollowed': 2, 'following_count': 0})
+
+            resp = c.post('/api/v1/follows', json={'follow': 'everyone'})
+            self.assertEqual(resp.status_code, 400)
+
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(User.query.get(self.u1_id).followers_count, 0)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=self.u2_id).count(), 0)
+
+        resp = app.test_client().post('/api/v1/follows', json={'follow': [u3_id]})
+        self.assertEqual(resp.status_code, 401)
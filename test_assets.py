@@ -0,0 +1,109 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+# Now we can import app
+
+from app import app
+import assets
+
+
+class AssetsTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        """Make a scratch static folder with a stylesheet and an image."""
+
+        self.static_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.static_dir, 'images'))
+        os.makedirs(os.path.join(self.static_dir, 'stylesheets'))
+
+        with open(os.path.join(self.static_dir, 'images', 'bg.png'), 'wb') as f:
+            f.write(b'\x89PNG not really')
+
+        with open(os.path.join(self.static_dir, 'stylesheets', 'style.css'), 'w') as f:
+            f.write('body { background: url("/static/images/bg.png"); }\n' * 50)
+
+        self.original_static_folder = app.static_folder
+        app.static_folder = self.static_dir
+        self.client = app.test_client()
+
+    def tearDown(self):
+        app.static_folder = self.original_static_folder
+        assets.load_manifest(app.static_folder)
+        shutil.rmtree(self.static_dir)
+
+    def test_build(self):
+        """Are assets fingerprinted, rewritten and precompressed?"""
+
+        manifest = assets.build(self.static_dir)
+
+        self.assertEqual(set(manifest), {'images/bg.png', 'stylesheets/style.css'})
+        self.assertRegex(manifest['images/bg.png'], r'^dist/images/bg\.[0-9a-f]{12}\.png$')
+
+        css_path = os.path.join(self.static_dir, manifest['stylesheets/style.css'])
+
+        with open(css_path) as f:
+            self.assertIn(f'/static/{manifest["images/bg.png"]}', f.read())
+
+        self.assertTrue(os.path.exists(css_path + '.gz'))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.static_dir, manifest['images/bg.png'] + '.gz')))
+
+        # Rebuilding unchanged files gives the same names.
+        self.assertEqual(assets.build(self.static_dir), manifest)
+
+    def test_static_url(self):
+        """Does static_url() use the fingerprinted name once built?"""
+
+        with app.test_request_context():
+            self.assertEqual(assets.static_url('images/bg.png'), '/static/images/bg.png')
+
+            manifest = assets.build(self.static_dir)
+
+            self.assertEqual(assets.static_url('images/bg.png'),
+                             f'/static/{manifest["images/bg.png"]}')
+
+    def test_serve_fingerprinted(self):
+        """Are built assets served precompressed and immutable?"""
+
+        manifest = assets.build(self.static_dir)
+        url = f'/static/{manifest["stylesheets/style.css"]}'
+
+        resp = self.client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertIn(b'/static/dist/images/bg.', gzip.decompress(resp.get_data()))
+        resp.close()
+
+        resp = self.client.get(url)
+
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(b'/static/dist/images/bg.', resp.get_data())
+        resp.close()
+
+        resp = self.client.get('/static/images/bg.png')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('immutable', resp.headers['Cache-Control'])
+        resp.close()
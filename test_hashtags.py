@@ -0,0 +1,166 @@
+"""Hashtag and trending tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_hashtags.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Hashtag, User, Message, Likes, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import hashtags
+import pagination
+import trending
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class HashtagsTestCase(TestCase):
+    """Test parsing, browsing and counting hashtags."""
+
+    def setUp(self):
+        """Make a user who posts some tagged messages."""
+
+        Hashtag.query.delete()
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="testuser",
+                           image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+        trending.reset()
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+        for text in ('Hello #Warbler', 'more #warbler #news', '#news again'):
+            self.client.post('/messages/new', data={'text': text})
+
+        self.page_size = pagination.PAGE_SIZE
+
+    def tearDown(self):
+        pagination.PAGE_SIZE = self.page_size
+        db.session.rollback()
+
+    def test_extract_tags(self):
+        """Are tags found once each, lowercased, and not inside words?"""
+
+        self.assertEqual(hashtags.extract_tags("#Python and #python, #42 a#b ##c"),
+                         ['python', '42'])
+
+    def test_hashtag_links(self):
+        """Are tags linked and everything else escaped?"""
+
+        self.assertEqual(str(hashtags.hashtag_links("<b>#Hi</b> it's")),
+                         '&lt;b&gt;<a href="/tags/hi">#Hi</a>&lt;/b&gt; it&#39;s')
+
+    def test_tag_page(self):
+        """Does a tag's page list its messages newest first, in pages?"""
+
+        pagination.PAGE_SIZE = 1
+
+        resp = self.client.get('/tags/Warbler')
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('more <a href="/tags/warbler">#warbler</a>', html)
+        self.assertNotIn('Hello', html)
+        self.assertIn('?before=', html)
+
+        cursor = html.split('?before=')[1].split('"')[0]
+        html = self.client.get(f'/tags/warbler?before={cursor}').get_data(as_text=True)
+        self.assertIn('Hello', html)
+        self.assertNotIn('?before=', html)
+
+    def test_deleted_message_untagged(self):
+        """Do a message's tags go when it's deleted?"""
+
+        msg_id = (db.session
+                  .query(Hashtag.message_id)
+                  .filter_by(tag='news')
+                  .order_by(Hashtag.timestamp)
+                  .first()[0])
+
+        self.client.post(f'/messages/{msg_id}/delete')
+
+        self.assertEqual(Hashtag.query.filter_by(tag='news').count(), 1)
+
+    def test_trending(self):
+        """Are recent tags ranked by use, on the home page too?"""
+
+        self.assertEqual(trending.top(), [('news', 2), ('warbler', 2)])
+
+        self.client.post('/messages/new', data={'text': 'big #news'})
+        self.assertEqual(trending.top(1), [('news', 3)])
+
+        html = self.client.get('/').get_data(as_text=True)
+        self.assertIn('Trending now', html)
+        self.assertIn('<a href="/tags/news">#news</a>', html)
+
+    def test_trending_loads_new_rows(self):
+        """Are uses written elsewhere counted once each?"""
+
+        ttl = trending.TRENDING_TTL
+
+        try:
+            self.assertEqual(trending.top(1), [('news', 2)])
+            trending.TRENDING_TTL = -1
+
+            # As if posted through another process
+            msg_id = (db.session
+                      .query(Message.id)
+                      .filter_by(text='Hello #Warbler')
+                      .scalar())
+            db.session.add(Hashtag(tag='news', message_id=msg_id,
+                                   timestamp=datetime.utcnow()))
+            db.session.commit()
+
+            self.assertEqual(trending.top(1), [('news', 3)])
+            self.assertEqual(trending.top(1), [('news', 3)])
+        finally:
+            trending.TRENDING_TTL = ttl
+
+    def test_sliding_window(self):
+        """Do uses older than the window stop counting?"""
+
+        counts = trending.Trending(bucket_seconds=60, window_buckets=3)
+        now = datetime(2020, 1, 1, 12)
+
+        counts.record('old', now - timedelta(minutes=5))
+        counts.record('old', now - timedelta(minutes=5))
+        counts.record('new', now - timedelta(minutes=1))
+        counts.record('new', now)
+        counts.record('other', now - timedelta(minutes=2))
+
+        self.assertEqual(counts.top(10, now), [('new', 2), ('other', 1)])
+        self.assertEqual(counts.top(10, now + timedelta(minutes=2)), [('new', 1)])
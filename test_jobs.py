@@ -0,0 +1,191 @@
+"""Background job tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_jobs.py
+
+
+import json
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Job, User, Message, Likes, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import counters
+import jobs
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+@jobs.handler('test_explode')
+def explode():
+    yield {'started': True}
+    raise RuntimeError("boom")
+
+
+class JobsTestCase(TestCase):
+    """Test queueing and running background jobs."""
+
+    def setUp(self):
+        """Make three users: u1 follows u2 and is followed by u3, and has
+        written three messages, two of them liked by u2."""
+
+        Job.query.delete()
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.client = app.test_client()
+
+        users = [User.signup(username=f"testuser{n}",
+                             email=f"test{n}@test.com",
+                             password="testuser",
+                             image_url=None)
+                 for n in range(1, 4)]
+        db.session.commit()
+
+        self.u1_id, self.u2_id, self.u3_id = [u.id for u in users]
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+            c.post(f'/users/follow/{self.u2_id}')
+
+            for text in ('first', 'second', 'third'):
+                c.post('/messages/new', data={'text': text})
+
+            self.login(c, self.u3_id)
+            c.post(f'/users/follow/{self.u1_id}')
+
+            msg_ids = [id for id, in db.session.query(Message.id)]
+
+            self.login(c, self.u2_id)
+            for msg_id in msg_ids[:2]:
+                c.post(f'/users/add_like/{msg_id}')
+
+        self.reports = []
+        self.batch_size = jobs.BATCH_SIZE
+
+    def tearDown(self):
+        jobs.BATCH_SIZE = self.batch_size
+        db.session.rollback()
+
+    def login(self, c, user_id):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def counter_values(self):
+        return sorted(db.session.query(User.id, User.messages_count,
+                                       User.following_count, User.followers_count,
+                                       User.likes_count))
+
+    def test_delete_user(self):
+        """Is a deleted account hidden at once, then purged in batches?"""
+
+        jobs.BATCH_SIZE = 2
+
+        with self.client as c:
+            self.login(c, self.u1_id)
+            c.post('/users/delete')
+
+            resp = c.get(f'/users/{self.u1_id}')
+            self.assertEqual(resp.status_code, 404)
+
+            # So are its messages and follows, before the purge.
+            self.login(c, self.u2_id)
+
+            html = c.get(f'/users/{self.u2_id}/likes').get_data(as_text=True)
+            self.assertNotIn('first', html)
+
+            html = c.get(f'/users/{self.u2_id}/followers').get_data(as_text=True)
+            self.assertNotIn('@testuser1', html)
+
+            self.login(c, self.u3_id)
+            self.assertEqual(c.get('/api/v1/timeline').get_json()['messages'], [])
+
+        self.assertEqual(jobs.work(burst=True, report=self.reports.append), 1)
+
+        self.assertIsNone(User.query.get(self.u1_id))
+        self.assertEqual(Message.query.count(), 0)
+        self.assertEqual(Likes.query.count(), 0)
+        self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(TimelineEntry.query.count(), 0)
+
+        # The counters were kept right along the way.
+        purged = self.counter_values()
+        counters.reconcile_counters()
+        self.assertEqual(purged, self.counter_values())
+
+        job = Job.query.one()
+        self.assertEqual(job.status, 'done')
+        self.assertEqual(json.loads(job.progress)['messages'], 3)
+
+    def test_failed_job_retried(self):
+        """Is a failing job retried later, then given up on?"""
+
+        jobs.enqueue('test_explode')
+        db.session.commit()
+
+        jobs.work(burst=True, report=self.reports.append)
+
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertEqual(job.last_error, "RuntimeError: boom")
+        self.assertGreater(job.run_after, datetime.utcnow())
+
+        # Not runnable again until the backoff has passed.
+        self.assertEqual(jobs.work(burst=True, report=self.reports.append), 0)
+
+        job.attempts = jobs.MAX_ATTEMPTS - 1
+        job.run_after = datetime.utcnow()
+        db.session.commit()
+
+        jobs.work(burst=True, report=self.reports.append)
+        self.assertEqual(Job.query.one().status, 'failed')
+
+    def test_stale_job_requeued(self):
+        """Is a job whose worker stopped reporting in run again?"""
+
+        job = jobs.enqueue('reconcile_counters')
+        job.status = 'running'
+        job.locked_at = datetime.utcnow() - timedelta(seconds=jobs.JOB_TIMEOUT + 1)
+        db.session.commit()
+
+        self.assertEqual(jobs.work(burst=True, report=self.reports.append), 1)
+        self.assertEqual(Job.query.one().status, 'done')
+
+    def test_reconcile_counters(self):
+        """Does the reconcile job fix drifted counters in batches?"""
+
+        jobs.BATCH_SIZE = 1
+        expected = self.counter_values()
+
+        User.query.update({User.followers_count: 42})
+        db.session.commit()
+
+        jobs.enqueue('reconcile_counters')
+        db.session.commit()
+        jobs.work(burst=True, report=self.reports.append)
+
+        self.assertEqual(self.counter_values(), expected)
@@ -0,0 +1,119 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_loader.py
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from models import db, User, Message, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import loader
+
+USERS_CSV = """\
+email,username,image_url,password,bio,header_image_url,location
+a@test.com,alice,/static/images/default-pic.png,HASHED,,/static/images/warbler-hero.jpg,Here
+b@test.com,bob,/static/images/default-pic.png,HASHED,Hi,/static/images/warbler-hero.jpg,There
+"""
+
+MESSAGES_CSV = """\
+text,timestamp,user_id
+first,2017-01-21 11:04:53.522807,1
+second,2017-01-22 11:04:53,1
+third,2017-01-23 11:04:53.000001,2
+"""
+
+FOLLOWS_CSV = """\
+user_being_followed_id,user_following_id
+1,2
+"""
+
+
+class LoaderTestCase(TestCase):
+    """Test loading CSV files."""
+
+    def setUp(self):
+        """Write a tiny data set to a scratch directory."""
+
+        self.directory = tempfile.mkdtemp()
+
+        for filename, contents in (('users.csv', USERS_CSV),
+                                   ('messages.csv', MESSAGES_CSV),
+                                   ('follows.csv', FOLLOWS_CSV)):
+            with open(os.path.join(self.directory, filename), 'w') as f:
+                f.write(contents)
+
+        self.reports = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        db.session.rollback()
+
+    def test_fresh_load(self):
+        """Are rows numbered, and derived data rebuilt?"""
+
+        loader.load(self.directory, report=self.reports.append)
+
+        alice = User.query.filter_by(username='alice').one()
+        bob = User.query.filter_by(username='bob').one()
+
+        self.assertEqual((alice.id, bob.id), (1, 2))
+        self.assertIsNone(alice.bio)
+        self.assertEqual(alice.messages_count, 2)
+        self.assertEqual(alice.followers_count, 1)
+        self.assertEqual(bob.following_count, 1)
+
+        # bob's timeline has his own message plus alice's two.
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=bob.id).count(), 3)
+        self.assertTrue(any(report.startswith('messages: 3 rows')
+                            for report in self.reports))
+
+        # New rows get ids after the loaded ones.
+        msg = Message(text='fourth', user_id=bob.id)
+        db.session.add(msg)
+        db.session.commit()
+        self.assertEqual(msg.id, 4)
+
+    def test_append_load(self):
+        """Does an append load shift ids past the existing rows?"""
+
+        loader.load(self.directory, report=self.reports.append)
+
+        # Usernames and emails must be unique, so load changed copies.
+        with open(os.path.join(self.directory, 'users.csv'), 'w') as f:
+            f.write(USERS_CSV.replace('@', '2@').replace('alice', 'carol')
+                    .replace('bob', 'dave'))
+
+        # Derived data for the existing rows is left alone, not rebuilt.
+        bob_id = User.query.filter_by(username='bob').one().id
+        TimelineEntry.query.filter_by(user_id=bob_id).delete()
+        db.session.commit()
+
+        loader.load(self.directory, append=True, report=self.reports.append)
+
+        carol = User.query.filter_by(username='carol').one()
+        dave = User.query.filter_by(username='dave').one()
+
+        self.assertEqual((carol.id, dave.id), (3, 4))
+        self.assertEqual(User.query.count(), 4)
+        self.assertEqual(Message.query.filter_by(user_id=carol.id).count(), 2)
+        self.assertEqual(Follows.query.filter_by(user_being_followed_id=carol.id,
+                                                 user_following_id=dave.id).count(), 1)
+        self.assertEqual(carol.followers_count, 1)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=dave.id).count(), 3)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=bob_id).count(), 0)
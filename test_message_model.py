@@ -85,6 +85,21 @@ class MessageModelTestCase(TestCase):
 
         self.assertRaises(db.session.commit())
 
+    def test_inverted_index(self):
+        """Does the fallback search index rank and remove messages?"""
 
+        from message_search import InvertedIndex
 
-   
\ No newline at end of file
+        index = InvertedIndex()
+        index.add(1, "the bird sang")
+        index.add(2, "a bird, another bird and a cat")
+        index.add(3, "just a cat")
+
+        self.assertEqual(index.search("bird"), [2, 1])
+        self.assertEqual(index.search("Bird cat"), [2])
+        self.assertEqual(index.search("dog"), [])
+        self.assertEqual(index.search("the"), [])
+
+        index.remove(2)
+        self.assertEqual(index.search("cat"), [3])
+        self.assertEqual(len(index), 2)
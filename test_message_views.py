@@ -6,9 +6,12 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
 from models import db, connect_db, Message, User
+import counters
+import fragment_cache
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -41,6 +44,7 @@ class MessageViewTestCase(TestCase):
 
         User.query.delete()
         Message.query.delete()
+        fragment_cache.clear()
 
         self.client = app.test_client()
 
@@ -156,3 +160,260 @@ class MessageViewTestCase(TestCase):
             self.testuser = User.query.filter_by(id=self.testuser.id).first()
 
             self.assertEqual(len(self.testuser.likes), 1)
+
+    def test_msg_pagination(self):
+        """Do `before` cursors page through a user's messages?"""
+
+        import pagination
+        from datetime import datetime
+
+        for day in range(1, 4):
+            db.session.add(Message(text=f"day {day}",
+                                   timestamp=datetime(2020, 1, day),
+                                   user_id=self.testuser.id))
+        db.session.commit()
+
+        pagination.PAGE_SIZE = 2
+
+        try:
+            with self.client as c:
+                resp = c.get(f"/users/{self.testuser.id}")
+                html = resp.get_data(as_text=True)
+
+                self.assertIn("hello", html)
+                self.assertIn("day 3", html)
+                self.assertNotIn("day 2", html)
+                self.assertIn("?before=", html)
+
+                cursor = html.split("?before=")[1].split('"')[0]
+                resp = c.get(f"/users/{self.testuser.id}?before={cursor}")
+                html = resp.get_data(as_text=True)
+
+                self.assertIn("day 2", html)
+                self.assertIn("day 1", html)
+                self.assertNotIn("day 3", html)
+                self.assertNotIn("?before=", html)
+
+                resp = c.get(f"/users/{self.testuser.id}?before=garbage")
+                self.assertEqual(resp.status_code, 400)
+        finally:
+            pagination.PAGE_SIZE = 100
+
+    def test_msg_liked_state(self):
+        """Is the like button highlighted only for liked messages?"""
+
+        import likes
+
+        u2 = User.query.filter_by(username='testuser2').one()
+        liked = Message(text="liked", user_id=u2.id)
+        unliked = Message(text="unliked", user_id=u2.id)
+        db.session.add_all([liked, unliked])
+        db.session.commit()
+        liked_id, unliked_id, u2_id = liked.id, unliked.id, u2.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post(f"/users/add_like/{liked_id}")
+
+            self.assertEqual(
+                likes.liked_ids_among(self.testuser.id, [liked_id, unliked_id]),
+                {liked_id})
+
+            resp = c.get(f"/users/{u2_id}")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(html.count("btn-primary\"\n"), 1)
+
+    def test_msg_query_budget(self):
+        """Does the home timeline render in a bounded number of queries?"""
+
+        from instrumentation import count_queries
+
+        authors = [User.signup(username=f"author{i}",
+                               email=f"author{i}@test.com",
+                               password="testuser",
+                               image_url=None)
+                   for i in range(4)]
+        db.session.commit()
+        author_ids = [author.id for author in authors]
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            for author_id in author_ids:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = author_id
+
+                c.post("/messages/new", data={"text": f"from {author_id}"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            for author_id in author_ids:
+                c.post(f"/users/follow/{author_id}")
+
+            with count_queries() as stats:
+                resp = c.get("/")
+
+            self.assertIn(f"from {author_ids[-1]}", resp.get_data(as_text=True))
+            self.assertLessEqual(stats.count, 6)
+            self.assertEqual(stats.repeated, {})
+
+    def test_msg_search(self):
+        """Can messages be found by full-text search?"""
+
+        import message_search
+
+        # setUp recreates messages behind the in-process index's back
+        message_search._index = None
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Warbling about birds"})
+            c.post("/messages/new", data={"text": "Nothing to see here"})
+
+            resp = c.get("/messages/search?q=birds")
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("Warbling about birds", html)
+            self.assertNotIn("Nothing to see here", html)
+
+            msg = Message.query.filter_by(text="Warbling about birds").one()
+            c.post(f"/messages/{msg.id}/delete")
+
+            resp = c.get("/messages/search?q=birds")
+            self.assertIn("no warbles found", resp.get_data(as_text=True))
+
+    def test_msg_search_refreshed(self):
+        """Does search pick up messages written elsewhere, and leave out
+        deleted users' messages?"""
+
+        import message_search
+
+        message_search._index = None
+        ttl = message_search.INDEX_TTL
+
+        try:
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser.id
+
+                c.get("/messages/search?q=birds")
+
+                # As if posted through another process
+                u2_id = User.query.filter_by(username="testuser2").one().id
+                msg = Message(text="More birds", user_id=u2_id)
+                db.session.add(msg)
+                db.session.flush()
+
+                if message_search.uses_tsvector():
+                    message_search.index_message(msg)
+
+                db.session.commit()
+                message_search.INDEX_TTL = 0
+
+                resp = c.get("/messages/search?q=birds")
+                self.assertIn("More birds", resp.get_data(as_text=True))
+
+                User.query.filter_by(id=u2_id).update({'deleted_at': datetime.utcnow()})
+                db.session.commit()
+
+                resp = c.get("/messages/search?q=birds")
+                self.assertNotIn("More birds", resp.get_data(as_text=True))
+        finally:
+            message_search.INDEX_TTL = ttl
+
+    def test_msg_fragment_cache(self):
+        """Are message cards served from cache until invalidated?"""
+
+        msg = Message.query.filter_by(user_id=self.testuser.id).one()
+        msg_id, testuser_id = msg.id, self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            self.assertIn("hello", c.get(f"/users/{testuser_id}").get_data(as_text=True))
+
+            Message.query.filter_by(id=msg_id).update({'text': "edited"})
+            db.session.commit()
+
+            self.assertIn("hello", c.get(f"/users/{testuser_id}").get_data(as_text=True))
+
+            # Counter changes (a new follower, a like) keep cards cached
+            counters.adjust(testuser_id, followers_count=1)
+            db.session.commit()
+
+            self.assertIn("hello", c.get(f"/users/{testuser_id}").get_data(as_text=True))
+
+            fragment_cache.invalidate('message', msg_id)
+            self.assertIn("edited", c.get(f"/users/{testuser_id}").get_data(as_text=True))
+
+    def test_likes_page_fragments(self):
+        """Does each likes page show its own liker, after a cached card?"""
+
+        import likes
+
+        author_id = self.testuser.id
+        msg_id = Message.query.filter_by(user_id=author_id).one().id
+        liker_ids = [u.id for u in User.query.order_by(User.id)]
+
+        for liker_id in liker_ids:
+            likes.toggle_like(liker_id, msg_id)
+
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = liker_ids[0]
+
+            self.assertIn("hello", c.get(f"/users/{author_id}").get_data(as_text=True))
+
+            for liker_id in liker_ids:
+                html = c.get(f"/users/{liker_id}/likes").get_data(as_text=True)
+                card = html.split('class="message-link"/>')[1].split('class="message-area"')[0]
+                self.assertIn(f'href="/users/{liker_id}"', card)
+                self.assertIn("hello", html)
+
+    def test_msg_like_toggle_json(self):
+        """Does toggling a like keep counts right and answer with JSON?"""
+
+        u2 = User.query.filter_by(username='testuser2').one()
+        msg = Message(text="likeable", user_id=u2.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id, testuser_id = msg.id, self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.post(f"/users/add_like/{msg_id}",
+                          headers={'Accept': 'application/json'})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.get_json(),
+                             dict(message_id=msg_id, liked=True, like_count=1))
+            self.assertEqual(User.query.get(testuser_id).likes_count, 1)
+
+            resp = c.put(f"/api/v1/messages/{msg_id}/like")
+            self.assertEqual(resp.get_json()['like_count'], 1)
+
+            resp = c.post(f"/users/add_like/{msg_id}",
+                          headers={'Referer': f'http://localhost/messages/{msg_id}'})
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertTrue(resp.location.endswith(f"/messages/{msg_id}"))
+            self.assertEqual(Message.query.get(msg_id).like_count, 0)
+            self.assertEqual(User.query.get(testuser_id).likes_count, 0)
+
+            resp = c.delete(f"/api/v1/messages/{msg_id}/like")
+            self.assertEqual(resp.get_json(),
+                             dict(message_id=msg_id, liked=False, like_count=0))
+
+            resp = c.post("/users/add_like/999999")
+            self.assertEqual(resp.status_code, 404)
+
@@ -0,0 +1,141 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import inspect
+
+from models import db
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import migrations
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class MigrationsTestCase(TestCase):
+    """Test applying migrations."""
+
+    def setUp(self):
+        """Forget which migrations have run."""
+
+        migrations.metadata.drop_all(db.engine)
+
+    def index_names(self, table):
+        return {index['name'] for index in inspect(db.engine).get_indexes(table)}
+
+    def test_upgrade(self):
+        """Do migrations run once each, even on an up-to-date schema?"""
+
+        reports = []
+        migrations.upgrade(report=reports.append)
+
+        self.assertEqual(len(reports), len(migrations.MIGRATIONS) + 1)
+        self.assertEqual(migrations.pending_migrations(), [])
+
+        migrations.upgrade(report=reports.append)
+        self.assertEqual(reports[-1], "Applied 0 migrations.")
+
+    def test_recreates_dropped_index(self):
+        """Does the index migration restore a missing index?"""
+
+        with db.engine.begin() as connection:
+            migrations.drop_index(connection, 'ix_follows_user_following_id')
+
+        self.assertNotIn('ix_follows_user_following_id', self.index_names('follows'))
+
+        migrations.upgrade(report=lambda line: None)
+
+        self.assertIn('ix_follows_user_following_id', self.index_names('follows'))
+        self.assertIn('ix_messages_user_id_timestamp_id', self.index_names('messages'))
+
+    def test_rekey_likes(self):
+        """Are old-style likes copied into the (user_id, message_id) table?"""
+
+        from models import Likes, Message, User
+
+        Likes.query.delete()
+        Message.query.delete()
+        User.query.delete()
+
+        u1 = User(email="test@test.com", username="testuser", password="HASHED")
+        u2 = User(email="test2@test.com", username="testuser2", password="HASHED")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        msg = Message(text="liked twice", user_id=u1.id)
+        db.session.add(msg)
+        db.session.commit()
+        msg_id, u1_id, u2_id = msg.id, u1.id, u2.id
+        db.session.remove()
+
+        with db.engine.begin() as connection:
+            connection.execute("DROP TABLE likes")
+            connection.execute(
+                "CREATE TABLE likes (id INTEGER PRIMARY KEY, "
+                "user_id INTEGER, message_id INTEGER)")
+            connection.execute(
+                f"INSERT INTO likes (id, user_id, message_id) VALUES "
+                f"(1, {u1_id}, {msg_id}), (2, {u2_id}, {msg_id}), (3, {u2_id}, {msg_id})")
+
+        migrations.upgrade(report=lambda line: None)
+
+        pk = inspect(db.engine).get_pk_constraint('likes')['constrained_columns']
+        self.assertEqual(sorted(pk), ['message_id', 'user_id'])
+        self.assertEqual(Likes.query.count(), 2)
+        self.assertEqual(Message.query.get(msg_id).like_count, 2)
+
+    def test_upgrades_baseline_schema(self):
+        """Are counters, version stamps and timelines added and filled in
+        on a database from before they existed?"""
+
+        from models import Follows, Likes, Message, TimelineEntry, User
+
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        u1 = User(email="test@test.com", username="testuser", password="HASHED")
+        u2 = User(email="test2@test.com", username="testuser2", password="HASHED")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=u1.id, user_following_id=u2.id))
+        db.session.add(Message(text="hello", user_id=u1.id))
+        db.session.commit()
+        u1_id, u2_id = u1.id, u2.id
+        db.session.remove()
+
+        with db.engine.begin() as connection:
+            connection.execute("DROP TABLE timelines")
+
+            for column in ('messages_count', 'followers_count', 'version'):
+                connection.execute(f"ALTER TABLE users DROP COLUMN {column}")
+
+        migrations.upgrade(report=lambda line: None)
+
+        self.assertEqual(User.query.get(u1_id).followers_count, 1)
+        self.assertEqual(User.query.get(u1_id).messages_count, 1)
+        self.assertEqual(User.query.get(u2_id).version, 1)
+        self.assertEqual(TimelineEntry.query.filter_by(user_id=u2_id).count(), 1)
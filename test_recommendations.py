@@ -0,0 +1,118 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_recommendations.py
+
+
+import os
+from unittest import TestCase, skipIf
+
+from models import db, Job, User, Message, Likes, Follows, Recommendation, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import recommendations
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# (follower, followed) by username
+FOLLOWS = [
+    ('alice', 'bob'), ('alice', 'carol'),
+    ('bob', 'dave'), ('bob', 'erin'), ('bob', 'alice'),
+    ('carol', 'dave'),
+]
+
+
+class RecommendationsTestCase(TestCase):
+    """Test computing and showing who-to-follow suggestions."""
+
+    def setUp(self):
+        """Make a small follow graph."""
+
+        Job.query.delete()
+        Recommendation.query.delete()
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.ids = {}
+
+        for name in ('alice', 'bob', 'carol', 'dave', 'erin'):
+            user = User(username=name, email=f"{name}@test.com", password="HASHED")
+            db.session.add(user)
+            db.session.flush()
+            self.ids[name] = user.id
+
+        for follower, followed in FOLLOWS:
+            db.session.add(Follows(user_following_id=self.ids[follower],
+                                   user_being_followed_id=self.ids[followed]))
+
+        db.session.commit()
+
+    def rebuild(self, **options):
+        for _ in recommendations.rebuild(block_size=2, **options):
+            db.session.commit()
+
+    def suggested(self, name):
+        return [(r.recommended_user_id, r.score) for r in (Recommendation
+                                                            .query
+                                                            .filter_by(user_id=self.ids[name])
+                                                            .order_by(Recommendation.rank))]
+
+    def test_friends_of_friends(self):
+        """Are friends of friends ranked by how many friends follow them?"""
+
+        self.rebuild(use_numpy=False)
+
+        ids = self.ids
+        self.assertEqual(self.suggested('alice'), [(ids['dave'], 2), (ids['erin'], 1)])
+        self.assertEqual(self.suggested('bob'), [(ids['carol'], 1)])
+        self.assertEqual(self.suggested('dave'), [])
+
+    @skipIf(recommendations.sparse is None, "needs NumPy and SciPy")
+    def test_numpy_matches_python(self):
+        """Do the sparse matrix and pure-Python scorers agree?"""
+
+        self.rebuild(use_numpy=False)
+        expected = {name: self.suggested(name) for name in self.ids}
+
+        self.rebuild(use_numpy=True)
+        self.assertEqual({name: self.suggested(name) for name in self.ids}, expected)
+
+    def test_home_sidebar(self):
+        """Are suggestions shown on the home page until followed?"""
+
+        self.rebuild()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.ids['alice']
+
+            html = c.get('/').get_data(as_text=True)
+            self.assertIn('Who to follow', html)
+            self.assertIn('@dave', html)
+
+            c.post(f"/users/follow/{self.ids['dave']}")
+
+            self.assertEqual([u.username for u in
+                              recommendations.for_user(self.ids['alice'])], ['erin'])
@@ -0,0 +1,130 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_replicas.py
+
+
+import os
+from unittest import TestCase
+
+from sqlalchemy import create_engine, event
+
+from models import db, User, Message, Likes, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+import replicas
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test which database requests read from."""
+
+    def setUp(self):
+        """Use the test database itself as the "replica"."""
+
+        TimelineEntry.query.delete()
+        Likes.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        u1 = User.signup(username="testuser",
+                         email="test@test.com",
+                         password="testuser",
+                         image_url=None)
+        u2 = User.signup(username="testuser2",
+                         email="test2@test.com",
+                         password="testuser",
+                         image_url=None)
+        db.session.commit()
+
+        self.u1_id, self.u2_id = u1.id, u2.id
+
+        self.replica = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+        self.replica_statements = []
+        event.listen(self.replica, 'before_cursor_execute',
+                     lambda conn, cursor, statement, *args:
+                     self.replica_statements.append(statement))
+
+        self.replica_set = replicas.ReplicaSet([self.replica])
+        app.extensions['replicas'] = self.replica_set
+
+        self.client = app.test_client()
+
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1_id
+
+    def tearDown(self):
+        app.extensions.pop('replicas')
+        self.replica.dispose()
+        db.session.rollback()
+
+    def replica_reads(self, method, path):
+        """Make a request; return how many statements ran on the replica."""
+
+        del self.replica_statements[:]
+        resp = self.client.open(path, method=method)
+        self.assertLess(resp.status_code, 400)
+        return len(self.replica_statements)
+
+    def test_reads_use_replica(self):
+        """Do GETs read from the replica, and POSTs not?"""
+
+        self.assertGreater(self.replica_reads('GET', f'/users/{self.u2_id}'), 0)
+
+        with self.client.session_transaction() as sess:
+            sess.pop(replicas.PIN_KEY, None)
+
+        self.assertEqual(self.replica_reads('POST', f'/users/follow/{self.u2_id}'), 0)
+
+    def test_writers_pinned_to_primary(self):
+        """After writing, are a user's reads kept on the primary for a while?"""
+
+        self.client.post(f'/users/follow/{self.u2_id}')
+
+        self.assertEqual(self.replica_reads('GET', f'/users/{self.u2_id}'), 0)
+
+        with self.client.session_transaction() as sess:
+            sess[replicas.PIN_KEY] = 0
+
+        self.assertGreater(self.replica_reads('GET', f'/users/{self.u2_id}'), 0)
+
+    def test_failed_replica_skipped(self):
+        """Are reads sent to the primary while the only replica is down?"""
+
+        self.replica_set.mark_down(self.replica)
+
+        self.assertEqual(self.replica_reads('GET', f'/users/{self.u2_id}'), 0)
+
+    def test_round_robin(self):
+        """Are healthy replicas taken in turn?"""
+
+        other = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
+        replica_set = replicas.ReplicaSet([self.replica, other])
+
+        self.assertEqual({replica_set.choose(), replica_set.choose()},
+                         {self.replica, other})
+
+        replica_set.mark_down(other)
+        self.assertEqual({replica_set.choose(), replica_set.choose()},
+                         {self.replica})
@@ -0,0 +1,151 @@
+"""Materialized timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_timeline.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Job, User, Message, Follows, TimelineEntry
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app
+import counters
+import follow_graph
+import jobs
+import timeline
+
+# Create our tables (we do this here, so we only create the tables
+# once for all tests --- in each test, we'll delete the data
+# and create fresh new clean test data
+
+db.create_all()
+
+
+class TimelineTestCase(TestCase):
+    """Test fan-out and reading of home timelines."""
+
+    def setUp(self):
+        """Create two users where u2 follows u1."""
+
+        Job.query.delete()
+        TimelineEntry.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        self.u1 = User(email="test@test.com",
+                       username="testuser",
+                       password="HASHED_PASSWORD")
+        self.u2 = User(email="test2@test.com",
+                       username="testuser2",
+                       password="HASHED_PASSWORD")
+
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=self.u1.id,
+                               user_following_id=self.u2.id))
+        db.session.commit()
+
+        counters.reconcile_counters()
+        db.session.commit()
+
+    def tearDown(self):
+        timeline.FANOUT_FOLLOWER_LIMIT = 10000
+        db.session.rollback()
+
+    def post(self, user, text):
+        msg = Message(text=text, user_id=user.id)
+        db.session.add(msg)
+        db.session.flush()
+        timeline.fan_out_message(msg)
+        db.session.commit()
+        return msg
+
+    def test_fan_out(self):
+        """Are messages written to the author's and followers' timelines?"""
+
+        msg = self.post(self.u1, "hello")
+
+        self.assertEqual(timeline.home_timeline(self.u1.id)[0], [msg])
+        self.assertEqual(timeline.home_timeline(self.u2.id)[0], [msg])
+
+        # u1 does not follow u2, so u2's messages stay off u1's timeline
+        msg2 = self.post(self.u2, "hi back")
+        self.assertEqual(timeline.home_timeline(self.u1.id)[0], [msg])
+        self.assertEqual(timeline.home_timeline(self.u2.id)[0], [msg2, msg])
+
+    def test_remove(self):
+        """Are timelines cleaned up on unfollow and message deletion?"""
+
+        msg = self.post(self.u1, "hello")
+        msg2 = self.post(self.u1, "again")
+
+        timeline.remove_message(msg.id)
+        db.session.commit()
+        self.assertEqual(timeline.home_timeline(self.u2.id)[0], [msg2])
+
+        timeline.remove_author(self.u2.id, self.u1.id)
+        db.session.commit()
+        self.assertEqual(timeline.home_timeline(self.u2.id)[0], [])
+        self.assertEqual(timeline.home_timeline(self.u1.id)[0], [msg2])
+
+    def test_high_fanout_merged_on_read(self):
+        """Are high-fanout authors skipped on write but merged on read?"""
+
+        timeline.FANOUT_FOLLOWER_LIMIT = 0
+
+        msg = self.post(self.u1, "hello")
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u2.id).count(), 0)
+
+        msg2 = self.post(self.u2, "hi back")
+        self.assertEqual(timeline.home_timeline(self.u2.id)[0], [msg2, msg])
+
+    def test_backfilled_when_no_longer_high_fanout(self):
+        """Are messages skipped while high-fanout copied in afterwards?"""
+
+        timeline.FANOUT_FOLLOWER_LIMIT = 1
+
+        u3 = User(email="test3@test.com", username="testuser3",
+                  password="HASHED_PASSWORD")
+        db.session.add(u3)
+        db.session.flush()
+        follow_graph.follow(u3.id, self.u1.id)
+        db.session.commit()
+
+        msg = self.post(self.u1, "hello")
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u2.id).count(), 0)
+
+        follow_graph.unfollow(u3.id, self.u1.id)
+        db.session.commit()
+        jobs.work(burst=True, report=lambda line: None)
+
+        self.assertEqual(
+            TimelineEntry.query.filter_by(user_id=self.u2.id).count(), 1)
+        self.assertEqual(timeline.home_timeline(self.u2.id)[0], [msg])
+
+    def test_rebuild(self):
+        """Does rebuilding reproduce the fanned-out timelines?"""
+
+        msg = self.post(self.u1, "hello")
+        TimelineEntry.query.delete()
+        db.session.commit()
+
+        timeline.rebuild_timelines()
+        db.session.commit()
+
+        self.assertEqual(timeline.home_timeline(self.u2.id)[0], [msg])
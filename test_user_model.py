@@ -148,4 +148,95 @@ class UserModelTestCase(TestCase):
         self.assertEqual(User.authenticate('testuser', 'HASHED_PASSWORD'), False)
 
         db.session.delete(u)
-        db.session.commit()
\ No newline at end of file
+        db.session.commit()
+
+    def test_user_counters(self):
+        """Do counters adjust and reconcile against the real tables?"""
+
+        import counters
+
+        u = User(
+            email="test@test.com",
+            username="testuser",
+            password="HASHED_PASSWORD"
+        )
+
+        u2 = User(
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD"
+        )
+
+        db.session.add_all([u, u2])
+        db.session.commit()
+
+        self.assertEqual(u.followers_count, 0)
+
+        counters.adjust(u.id, messages_count=2, likes_count=1)
+        db.session.commit()
+        self.assertEqual(u.messages_count, 2)
+        self.assertEqual(u.likes_count, 1)
+
+        u.followers.append(u2)
+        db.session.add(Message(text="hello", user_id=u.id))
+        db.session.commit()
+
+        counters.reconcile_counters()
+        db.session.commit()
+
+        self.assertEqual(u.messages_count, 1)
+        self.assertEqual(u.likes_count, 0)
+        self.assertEqual(u.followers_count, 1)
+        self.assertEqual(u2.following_count, 1)
+
+    def test_following_ids_among(self):
+        """Does the batch follow lookup match is_following()?"""
+
+        import follow_graph
+
+        users = [User(email=f"test{i}@test.com",
+                      username=f"testuser{i}",
+                      password="HASHED_PASSWORD")
+                 for i in range(4)]
+
+        db.session.add_all(users)
+        db.session.commit()
+
+        u, others = users[0], users[1:]
+        u.following.extend(others[:2])
+        db.session.commit()
+
+        self.assertTrue(u.is_following(others[0]))
+        self.assertFalse(u.is_following(others[2]))
+        self.assertTrue(others[1].is_followed_by(u))
+        self.assertFalse(u.is_followed_by(others[1]))
+
+        self.assertEqual(
+            follow_graph.following_ids_among(u.id, [o.id for o in others]),
+            {others[0].id, others[1].id})
+        self.assertEqual(follow_graph.following_ids_among(u.id, []), set())
+
+    def test_password_rehash(self):
+        """Are hashes with a stale work factor upgraded on login?"""
+
+        import passwords
+
+        u = User.signup("testuser", "test@test.com", "password", None)
+        db.session.commit()
+
+        self.assertTrue(passwords.check_password(u.password, "password"))
+        self.assertFalse(passwords.check_password(u.password, "wrong"))
+        self.assertFalse(passwords.check_password("not a hash", "password"))
+
+        old_rounds = passwords.LOG_ROUNDS
+        passwords.LOG_ROUNDS = old_rounds + 1
+
+        try:
+            self.assertTrue(passwords.needs_rehash(u.password))
+            self.assertEqual(User.authenticate("testuser", "password"), u)
+            db.session.commit()
+            self.assertFalse(passwords.needs_rehash(u.password))
+        finally:
+            passwords.LOG_ROUNDS = old_rounds
+
+        self.assertEqual(passwords.metrics()['pending'], 0)
@@ -235,4 +235,154 @@ class UserViewTestCase(TestCase):
             resp = c.get(f'/users/{self.testuser.id}/likes')
             html = resp.get_data(as_text=True)
 
-            self.assertIn("Messages You've Liked:", html)
\ No newline at end of file
+            self.assertIn("Messages You've Liked:", html)
+
+    def test_users_search(self):
+        """Do search and autocomplete find users by username?"""
+
+        import user_search
+
+        # setUp recreates users behind the in-process trie's back
+        user_search._trie = None
+
+        with self.client as c:
+            resp = c.get('/users?q=user2')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn("@testuser2", html)
+            self.assertNotIn("@testuser<", html)
+
+            resp = c.get('/users/search?q=TESTU')
+            self.assertEqual([u['username'] for u in resp.json['users']],
+                             ['testuser', 'testuser2'])
+
+            resp = c.get('/users/search?q=nobody')
+            self.assertEqual(resp.json['users'], [])
+
+    def test_prefix_trie(self):
+        """Does the fallback trie rank and remove entries correctly?"""
+
+        from user_search import PrefixTrie
+
+        trie = PrefixTrie()
+        for user_id, username in enumerate(['bob', 'Bobby', 'bo', 'alice']):
+            trie.insert(username, user_id)
+
+        self.assertEqual(trie.search('bo'), [('bo', 2), ('bob', 0), ('Bobby', 1)])
+        self.assertEqual(trie.search('b', limit=2), [('bo', 2), ('bob', 0)])
+
+        trie.remove('Bobby')
+        self.assertEqual(trie.search('bobb'), [])
+        self.assertEqual(len(trie), 3)
+
+    def test_identity_cache(self):
+        """Is the cached identity refreshed after the user changes?"""
+
+        import identity
+
+        testuser_id = self.testuser.id
+        u2_id = User.query.filter_by(username='testuser2').one().id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.get('/')
+            self.assertEqual(identity.get_identity(testuser_id).following_count, 0)
+
+            c.post(f'/users/follow/{u2_id}')
+
+            resp = c.get('/')
+            html = resp.get_data(as_text=True)
+
+            self.assertIn(f'/users/{testuser_id}/following">1<', html)
+            self.assertEqual(identity.get_identity(u2_id).followers_count, 1)
+
+    def test_users_show_conditional_get(self):
+        """Does the profile page answer 304 until the user changes?"""
+
+        testuser_id = self.testuser.id
+        u2_id = User.query.filter_by(username='testuser2').one().id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get(f'/users/{u2_id}')
+            etag = resp.headers['ETag']
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('no-cache', resp.headers['Cache-Control'])
+
+            resp = c.get(f'/users/{u2_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.get_data(), b'')
+
+            # Following changes the button the viewer sees.
+            c.post(f'/users/follow/{u2_id}')
+
+            resp = c.get(f'/users/{u2_id}', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_likes_conditional_get(self):
+        """Does the likes page change when a liked message's author does?"""
+
+        import identity
+        import instrumentation
+        import likes
+
+        testuser_id = self.testuser.id
+        u2_id = User.query.filter_by(username='testuser2').one().id
+
+        msg = Message(text="likeable", user_id=u2_id)
+        db.session.add(msg)
+        db.session.flush()
+        likes.toggle_like(testuser_id, msg.id)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            etag = c.get(f'/users/{testuser_id}/likes').headers['ETag']
+
+            with instrumentation.count_queries() as stats:
+                resp = c.get(f'/users/{testuser_id}/likes', headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 304)
+            # Answered without loading the page of messages
+            self.assertFalse(any('messages.text' in shape for shape in stats.shapes))
+
+            User.query.filter_by(id=u2_id).update({'username': 'renamed'})
+            identity.bump_version(u2_id)
+            db.session.commit()
+
+            resp = c.get(f'/users/{testuser_id}/likes', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('@renamed', resp.get_data(as_text=True))
+
+    def test_follow_json_idempotent(self):
+        """Do repeated follows and unfollows leave the counters right?"""
+
+        u2_id = User.query.filter_by(email='test2@test.com').first().id
+        json_headers = {'Accept': 'application/json'}
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            for _ in range(2):
+                resp = c.post(f'/users/follow/{u2_id}', headers=json_headers)
+                self.assertEqual(resp.get_json(),
+                                 {'user_id': u2_id, 'following': True,
+                                  'followers_count': 1})
+
+            for _ in range(2):
+                resp = c.post(f'/users/stop-following/{u2_id}', headers=json_headers)
+                self.assertEqual(resp.get_json()['followers_count'], 0)
+
+            resp = c.post('/users/stop-following/999999')
+            self.assertEqual(resp.status_code, 404)
+
+        self.assertEqual(User.query.get(self.testuser.id).following_count, 0)
@@ -0,0 +1,292 @@
+"""Materialized home timelines for Warbler.
+
+Each user's home timeline is stored as rows in the `timelines` table
+(one row per message that should appear on that user's home page), so
+rendering the home page is a single indexed range read instead of an
+IN-query over everyone they follow.
+
+Messages are fanned out to followers when they are written. Authors with
+very large follower counts (going by the denormalized
+`User.followers_count`) are skipped at write time and merged in when the
+timeline is read, which keeps write amplification bounded. When such an
+author drops back to the limit, the `fan_out_author` job (see jobs.py)
+copies their recent messages into their followers' timelines, since
+reads stop merging them in.
+"""
+
+from heapq import merge
+from itertools import islice
+
+from models import db, Follows, Message, TimelineEntry, User
+import pagination
+from pagination import older_than, page_of
+
+# Authors with more followers than this are not fanned out on write;
+# their messages are merged into followers' timelines at read time.
+FANOUT_FOLLOWER_LIMIT = 10000
+
+# How many of a user's recent messages are copied into a follower's
+# timeline when the follow is created.
+BACKFILL_LIMIT = 100
+
+
+def follower_ids(user_id):
+    """Return a query of ids of users following `user_id`."""
+
+    return (db.session
+            .query(Follows.user_following_id)
+            .filter(Follows.user_being_followed_id == user_id))
+
+
+def is_high_fanout(user_id):
+    """Does `user_id` have too many followers to fan out on write?"""
+
+    count = (db.session
+             .query(User.followers_count)
+             .filter(User.id == user_id)
+             .scalar())
+    return (count or 0) > FANOUT_FOLLOWER_LIMIT
+
+
+def high_fanout_followed_ids(user_id):
+    """Return ids of high-fanout authors that `user_id` follows."""
+
+    rows = (db.session
+            .query(Follows.user_being_followed_id)
+            .join(User, User.id == Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id,
+                    User.followers_count > FANOUT_FOLLOWER_LIMIT)
+            .all())
+    return [user_id for (user_id,) in rows]
+
+
+def dropped_to_fanout_limit(user_ids):
+    """Return which of `user_ids` have exactly FANOUT_FOLLOWER_LIMIT
+    followers. Called after taking followers away, it finds the authors
+    who have just stopped being high-fanout."""
+
+    user_ids = list(user_ids)
+
+    if not user_ids:
+        return []
+
+    rows = (db.session
+            .query(User.id)
+            .filter(User.id.in_(user_ids),
+                    User.followers_count == FANOUT_FOLLOWER_LIMIT)
+            .all())
+    return [user_id for (user_id,) in rows]
+
+
+def fan_out_message(msg):
+    """Add `msg` to the timelines of its author and their followers.
+
+    The message must already be flushed so it has an id; the caller is
+    responsible for committing.
+    """
+
+    recipients = [msg.user_id]
+
+    if not is_high_fanout(msg.user_id):
+        recipients.extend(user_id for (user_id,) in follower_ids(msg.user_id))
+
+    db.session.execute(
+        TimelineEntry.__table__.insert(),
+        [dict(user_id=user_id,
+              message_id=msg.id,
+              author_id=msg.user_id,
+              timestamp=msg.timestamp)
+         for user_id in recipients])
+
+
+def backfill_author(user_id, author_id, limit=BACKFILL_LIMIT):
+    """Copy `author_id`'s most recent messages into `user_id`'s timeline."""
+
+    if is_high_fanout(author_id):
+        return
+
+    recent = (db.session
+              .query(Message.id, Message.timestamp)
+              .filter(Message.user_id == author_id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(limit)
+              .all())
+
+    if recent:
+        db.session.execute(
+            TimelineEntry.__table__.insert(),
+            [dict(user_id=user_id,
+                  message_id=message_id,
+                  author_id=author_id,
+                  timestamp=timestamp)
+             for message_id, timestamp in recent])
+
+
+def backfill_followers(author_id, follower_ids, limit=BACKFILL_LIMIT):
+    """Copy `author_id`'s most recent messages into the timelines of
+    `follower_ids`, skipping any already there."""
+
+    recent = (db.session
+              .query(Message.id, Message.timestamp)
+              .filter(Message.user_id == author_id)
+              .order_by(Message.timestamp.desc(), Message.id.desc())
+              .limit(limit)
+              .all())
+
+    if not recent or not follower_ids:
+        return
+
+    present = set(db.session
+                  .query(TimelineEntry.user_id, TimelineEntry.message_id)
+                  .filter(TimelineEntry.user_id.in_(follower_ids),
+                          TimelineEntry.author_id == author_id))
+
+    rows = [dict(user_id=user_id,
+                 message_id=message_id,
+                 author_id=author_id,
+                 timestamp=timestamp)
+            for user_id in follower_ids
+            for message_id, timestamp in recent
+            if (user_id, message_id) not in present]
+
+    if rows:
+        db.session.execute(TimelineEntry.__table__.insert(), rows)
+
+
+def remove_author(user_id, author_id):
+    """Remove all of `author_id`'s messages from `user_id`'s timeline."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.user_id == user_id,
+             TimelineEntry.author_id == author_id)
+     .delete(synchronize_session=False))
+
+
+def remove_message(message_id):
+    """Remove a message from every timeline it was fanned out to."""
+
+    (TimelineEntry
+     .query
+     .filter(TimelineEntry.message_id == message_id)
+     .delete(synchronize_session=False))
+
+
+def timeline_queries(user_id, query, before=None):
+    """Return the queries whose results make up `user_id`'s home timeline.
+
+    `query` selects from `Message` (whole messages, or just the columns
+    the caller needs, as long as rows have `timestamp` and `id`). Each
+    returned query is ordered newest-first; combine their results with
+    `merge_timeline()`.
+    """
+
+    materialized = (query
+                    .join(TimelineEntry, TimelineEntry.message_id == Message.id)
+                    .filter(TimelineEntry.user_id == user_id))
+
+    if before is not None:
+        materialized = materialized.filter(older_than(
+            TimelineEntry.timestamp, TimelineEntry.message_id, before))
+
+    queries = [materialized.order_by(TimelineEntry.timestamp.desc(),
+                                     TimelineEntry.message_id.desc())]
+
+    high_fanout = high_fanout_followed_ids(user_id)
+
+    if high_fanout:
+        merged_in = query.filter(Message.user_id.in_(high_fanout))
+
+        if before is not None:
+            merged_in = merged_in.filter(
+                older_than(Message.timestamp, Message.id, before))
+
+        queries.append(merged_in.order_by(Message.timestamp.desc(),
+                                          Message.id.desc()))
+
+    return queries
+
+
+def merge_timeline(sources):
+    """Lazily merge newest-first row iterables into one timeline.
+
+    An author may have crossed the fan-out limit after some of their
+    messages were already materialized, so duplicates are skipped.
+    """
+
+    seen = set()
+
+    for row in merge(*sources, key=lambda row: (row.timestamp, row.id),
+                     reverse=True):
+        if row.id not in seen:
+            seen.add(row.id)
+            yield row
+
+
+def home_timeline(user_id, before=None, limit=None):
+    """Return a page of messages for `user_id`'s home page.
+
+    Reads the materialized timeline and merges in messages from any
+    high-fanout authors the user follows. `before` is a decoded cursor
+    (see pagination.py); returns `(messages, next_cursor)`.
+    """
+
+    limit = limit or pagination.PAGE_SIZE
+
+    sources = [query.limit(limit + 1).all()
+               for query in timeline_queries(user_id, Message.query_with_author(), before)]
+
+    return page_of(list(islice(merge_timeline(sources), limit + 1)), limit)
+
+
+def rebuild_timelines(id_range=None):
+    """Rebuild materialized timelines from messages and follows, for
+    messages with ids in `id_range` (low, high) or all messages.
+
+    Useful after bulk loading data (see loader.py), which bypasses the
+    write path that normally populates timelines.
+    """
+
+    entries = TimelineEntry.query
+
+    if id_range is not None:
+        low, high = id_range
+        entries = entries.filter(TimelineEntry.message_id >= low,
+                                 TimelineEntry.message_id < high)
+
+    entries.delete(synchronize_session=False)
+
+    for insert in timeline_inserts(id_range):
+        db.session.execute(insert)
+
+
+def timeline_inserts(id_range=None):
+    """Return the INSERT ... SELECT statements that add messages with
+    ids in `id_range` (low, high), or all messages, to the timelines
+    they belong in."""
+
+    own = db.session.query(
+        Message.user_id, Message.id,
+        Message.user_id.label('author_id'), Message.timestamp)
+
+    high_fanout = (db.session
+                   .query(User.id)
+                   .filter(User.followers_count > FANOUT_FOLLOWER_LIMIT)
+                   .subquery())
+
+    followed = (db.session
+                .query(Follows.user_following_id, Message.id,
+                       Message.user_id, Message.timestamp)
+                .join(Follows,
+                      Follows.user_being_followed_id == Message.user_id)
+                .filter(Message.user_id.notin_(high_fanout)))
+
+    if id_range is not None:
+        low, high = id_range
+        own = own.filter(Message.id >= low, Message.id < high)
+        followed = followed.filter(Message.id >= low, Message.id < high)
+
+    columns = ['user_id', 'message_id', 'author_id', 'timestamp']
+
+    return [TimelineEntry.__table__.insert().from_select(columns, query.statement)
+            for query in (own, followed)]
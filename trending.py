@@ -0,0 +1,320 @@
+"""Trending hashtags.
+
+Keeps approximate counts of recent tag uses in memory, so "trending
+now" never needs a GROUP BY over messages or hashtags. Time is cut into
+BUCKET_SECONDS buckets, and the last WINDOW_BUCKETS of them make up the
+window. Each bucket holds:
+
+- a count-min sketch: DEPTH rows of WIDTH counters, each tag hashed to
+  one counter per row. A tag's count is the smallest of its counters,
+  which can only overestimate (when other tags collide with it in every
+  row), and memory stays fixed however many tags there are.
+- the CANDIDATES tags with the highest estimates in the bucket, kept in
+  a min-heap so the weakest can be replaced cheaply.
+
+`top()` sums each candidate's estimates across the window's buckets and
+returns the best. Old buckets are simply dropped as time moves on.
+
+Counts start from the `hashtags` rows inside the window (an indexed
+range scan). Every TRENDING_TTL seconds after that, only rows newer than
+the newest use already counted are read, which picks up tags written
+through other processes; tags written through this process are counted
+right away (see `record()`).
+
+Loads skip uses by deleted accounts. Deleting an account resets the
+counts of the process that handled it; other processes keep counting
+uses they had already loaded until those leave the window.
+"""
+
+import heapq
+import threading
+import time
+from array import array
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from hashlib import blake2b
+
+from models import db, Hashtag, Message, User
+
+BUCKET_SECONDS = 300
+WINDOW_BUCKETS = 12
+
+WIDTH = 2048
+DEPTH = 4
+CANDIDATES = 50
+
+TRENDING_SIZE = 10
+TRENDING_TTL = 60
+
+# Each load re-reads uses this far back from the newest one counted, to
+# catch uses committed a little out of timestamp order.
+LOAD_OVERLAP = timedelta(seconds=30)
+
+
+class CountMinSketch:
+    """Approximate counts of items in fixed memory."""
+
+    def __init__(self, width=WIDTH, depth=DEPTH):
+        self.width = width
+        self.rows = [array('l', bytes(array('l').itemsize * width))
+                     for _ in range(depth)]
+
+    def columns(self, item):
+        """Return the counter `item` maps to in each row."""
+
+        digest = blake2b(item.encode('utf-8'), digest_size=4 * len(self.rows)).digest()
+        return [int.from_bytes(digest[4 * row:4 * row + 4], 'little') % self.width
+                for row in range(len(self.rows))]
+
+    def add(self, item, count=1):
+        """Count `item`; return its new estimated count."""
+
+        for row, column in zip(self.rows, self.columns(item)):
+            row[column] += count
+
+        return self.estimate(item)
+
+    def estimate(self, item, columns=None):
+        """Return the estimated count of `item`. Sketches of the same
+        shape map items alike, so `columns` can be reused across them."""
+
+        columns = columns or self.columns(item)
+        return min(row[column] for row, column in zip(self.rows, columns))
+
+
+class TopK:
+    """The `size` items with the highest counts seen, in a min-heap.
+
+    The heap may hold outdated (count, item) entries; they're skipped
+    when the weakest item is looked for.
+    """
+
+    def __init__(self, size=CANDIDATES):
+        self.size = size
+        self.counts = {}
+        self.heap = []
+
+    def update(self, item, count):
+        if item not in self.counts and len(self.counts) >= self.size:
+            weakest_count, weakest = self._weakest()
+
+            if count <= weakest_count:
+                return
+
+            heapq.heappop(self.heap)
+            del self.counts[weakest]
+
+        self.counts[item] = count
+        heapq.heappush(self.heap, (count, item))
+
+        if len(self.heap) > 4 * self.size:
+            self.heap = [(count, item) for item, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def _weakest(self):
+        while self.heap[0][0] != self.counts.get(self.heap[0][1]):
+            heapq.heappop(self.heap)
+
+        return self.heap[0]
+
+
+class Bucket:
+    def __init__(self, number):
+        self.number = number
+        self.sketch = CountMinSketch()
+        self.top = TopK()
+
+    def add(self, tag):
+        self.top.update(tag, self.sketch.add(tag))
+
+
+class Trending:
+    """Windowed approximate tag counts."""
+
+    def __init__(self, bucket_seconds=BUCKET_SECONDS, window_buckets=WINDOW_BUCKETS):
+        self.bucket_seconds = bucket_seconds
+        self.window_buckets = window_buckets
+        self.buckets = deque()
+
+    def bucket_number(self, when):
+        seconds = when.replace(tzinfo=timezone.utc).timestamp()
+        return int(seconds // self.bucket_seconds)
+
+    def window_start(self, now):
+        """Return the earliest time counted in the window ending at `now`."""
+
+        first = self.bucket_number(now) - self.window_buckets + 1
+        return datetime.utcfromtimestamp(first * self.bucket_seconds)
+
+    def _expire(self, now):
+        first = self.bucket_number(now) - self.window_buckets + 1
+
+        while self.buckets and self.buckets[0].number < first:
+            self.buckets.popleft()
+
+    def record(self, tag, when):
+        """Count one use of `tag` at `when` (a naive UTC datetime)."""
+
+        number = self.bucket_number(when)
+
+        if self.buckets and number <= self.buckets[-1].number - self.window_buckets:
+            return
+
+        if not self.buckets or number > self.buckets[-1].number:
+            self.buckets.append(Bucket(number))
+            self._expire(when)
+
+        # Uses arrive in roughly time order, so look from the newest end.
+        for position in range(len(self.buckets) - 1, -1, -1):
+            bucket = self.buckets[position]
+
+            if bucket.number == number:
+                bucket.add(tag)
+                return
+
+            if bucket.number < number:
+                break
+        else:
+            position = -1
+
+        # Older than the newest bucket, with no bucket of its own yet.
+        bucket = Bucket(number)
+        self.buckets.insert(position + 1, bucket)
+        bucket.add(tag)
+
+    def top(self, k, now):
+        """Return up to `k` (tag, estimated count) pairs, highest first."""
+
+        self._expire(now)
+
+        candidates = set()
+
+        for bucket in self.buckets:
+            candidates.update(bucket.top.counts)
+
+        def total(tag):
+            columns = self.buckets[0].sketch.columns(tag)
+            return sum(bucket.sketch.estimate(tag, columns) for bucket in self.buckets)
+
+        totals = ((tag, total(tag)) for tag in candidates)
+
+        return heapq.nsmallest(k, totals, key=lambda pair: (-pair[1], pair[0]))
+
+
+class Counts:
+    """A process's trending counts, kept current by incremental loads.
+
+    Remembers which (tag, message id) uses it has counted within
+    LOAD_OVERLAP of the newest one, so uses seen both through `record()`
+    and in a load, or in two overlapping loads, count once.
+    """
+
+    def __init__(self):
+        self.trending = Trending()
+        self.counted = {}
+        self.newest = None
+        self.loaded_at = None
+
+    def add(self, tag, message_id, when):
+        """Count one use of `tag`, unless it's been counted already."""
+
+        key = (tag, message_id)
+
+        if key in self.counted:
+            return
+
+        self.counted[key] = when
+        self.trending.record(tag, when)
+
+        if self.newest is None or when > self.newest:
+            self.newest = when
+
+    def is_stale(self):
+        return (self.loaded_at is None or
+                time.monotonic() - self.loaded_at > TRENDING_TTL)
+
+    def load_from(self, now):
+        """Return the earliest timestamp the next load must read."""
+
+        start = self.trending.window_start(now)
+
+        if self.newest is None:
+            return start
+
+        return max(start, self.newest - LOAD_OVERLAP)
+
+    def loaded(self, rows):
+        """Count loaded (tag, message id, timestamp) rows, then forget
+        uses too old to be loaded again."""
+
+        for tag, message_id, timestamp in rows:
+            self.add(tag, message_id, timestamp)
+
+        if self.newest is not None:
+            start = self.newest - LOAD_OVERLAP
+            self.counted = {key: when for key, when in self.counted.items()
+                            if when >= start}
+
+        self.loaded_at = time.monotonic()
+
+
+_counts = None
+_lock = threading.Lock()
+
+
+def rows_since(start):
+    """Return (tag, message id, timestamp) for uses from `start` on, in
+    messages by users who haven't deleted their accounts."""
+
+    return (db.session
+            .query(Hashtag.tag, Hashtag.message_id, Hashtag.timestamp)
+            .join(Message, Message.id == Hashtag.message_id)
+            .join(User, User.id == Message.user_id)
+            .filter(Hashtag.timestamp >= start, User.deleted_at.is_(None))
+            .order_by(Hashtag.timestamp)
+            .all())
+
+
+def record(tags, message_id, when):
+    """Count new uses of `tags` in a message at `when`, if counts are
+    loaded."""
+
+    with _lock:
+        if _counts is not None:
+            for tag in tags:
+                _counts.add(tag, message_id, when)
+
+
+def top(k=TRENDING_SIZE):
+    """Return up to `k` (tag, approximate recent uses) pairs, most used
+    first."""
+
+    global _counts
+
+    now = datetime.utcnow()
+
+    with _lock:
+        if _counts is None:
+            _counts = Counts()
+
+        counts = _counts
+        start = counts.load_from(now) if counts.is_stale() else None
+
+    if start is not None:
+        # Read outside the lock; overlapping loads are deduplicated.
+        rows = rows_since(start)
+
+        with _lock:
+            counts.loaded(rows)
+
+    with _lock:
+        return counts.trending.top(k, now)
+
+
+def reset():
+    """Forget the in-memory counts; they're reloaded on next use."""
+
+    global _counts
+
+    with _lock:
+        _counts = None
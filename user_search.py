@@ -0,0 +1,196 @@
+"""Username search and autocomplete.
+
+On Postgres, username searches are answered by a trigram GIN index on
+`lower(users.username)` (created alongside the table; see models.py),
+which serves both substring (`LIKE '%q%'`) and prefix (`LIKE 'q%'`)
+matches.
+
+Other backends (SQLite in development and tests) have no such index, so
+autocomplete is served from an in-process prefix trie of usernames,
+loaded from the database on first use and refreshed every TRIE_TTL
+seconds. The write paths in app.py keep it current in between. Requests
+change and search the trie from several threads, so every access holds
+`_lock`.
+"""
+
+import threading
+import time
+from collections import deque
+
+from sqlalchemy import case, func
+
+from models import db, User
+
+# Most results returned by a search or autocomplete request.
+SEARCH_LIMIT = 50
+AUTOCOMPLETE_LIMIT = 10
+
+# Seconds before the in-process trie is reloaded from the database, to
+# pick up changes made by other processes.
+TRIE_TTL = 300
+
+
+class PrefixTrie:
+    """Case-insensitive map from usernames to user ids, by prefix."""
+
+    def __init__(self):
+        self.root = {}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, username, user_id):
+        node = self.root
+
+        for char in username.lower():
+            node = node.setdefault(char, {})
+
+        if None not in node:
+            self.size += 1
+
+        node[None] = (username, user_id)
+
+    def remove(self, username):
+        key = username.lower()
+        path = [self.root]
+
+        for char in key:
+            if char not in path[-1]:
+                return
+            path.append(path[-1][char])
+
+        if path[-1].pop(None, None) is None:
+            return
+
+        self.size -= 1
+
+        # Prune branches left empty by the removal.
+        for depth in range(len(key), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][key[depth - 1]]
+
+    def search(self, prefix, limit=AUTOCOMPLETE_LIMIT):
+        """Return up to `limit` (username, id) pairs starting with `prefix`.
+
+        Shorter usernames come first (an exact match is always first),
+        then alphabetical.
+        """
+
+        node = self.root
+
+        for char in prefix.lower():
+            if char not in node:
+                return []
+            node = node[char]
+
+        # Breadth-first, so results come out shortest first.
+        results = []
+        queue = deque([node])
+
+        while queue and len(results) < limit:
+            node = queue.popleft()
+
+            if None in node:
+                results.append(node[None])
+
+            children = sorted(char for char in node if char is not None)
+            queue.extend(node[char] for char in children)
+
+        return results[:limit]
+
+
+_trie = None
+_trie_loaded_at = 0
+_lock = threading.Lock()
+
+
+def get_trie():
+    """Return the process-wide trie, (re)loading it if stale."""
+
+    global _trie, _trie_loaded_at
+
+    if _trie is None or time.monotonic() - _trie_loaded_at > TRIE_TTL:
+        trie = PrefixTrie()
+
+        users = (db.session
+                 .query(User.id, User.username)
+                 .filter(User.deleted_at.is_(None))
+                 .yield_per(1000))
+
+        for user_id, username in users:
+            trie.insert(username, user_id)
+
+        with _lock:
+            _trie, _trie_loaded_at = trie, time.monotonic()
+
+    return _trie
+
+
+def remember(user):
+    """Add a new or renamed user to the in-process trie, if loaded."""
+
+    with _lock:
+        if _trie is not None:
+            _trie.insert(user.username, user.id)
+
+
+def forget(username):
+    """Remove a deleted or renamed user from the in-process trie."""
+
+    with _lock:
+        if _trie is not None:
+            _trie.remove(username)
+
+
+def uses_trigram_index():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def escape_like(text):
+    """Escape LIKE wildcards so `text` matches literally."""
+
+    return (text
+            .replace('\\', '\\\\')
+            .replace('%', '\\%')
+            .replace('_', '\\_'))
+
+
+def search_users(q, limit=SEARCH_LIMIT):
+    """Return up to `limit` users whose username contains `q`.
+
+    Prefix matches rank above other matches, then shorter usernames.
+    """
+
+    pattern = escape_like(q.lower())
+    username = func.lower(User.username)
+
+    return (User
+            .active()
+            .filter(username.like(f"%{pattern}%", escape='\\'))
+            .order_by(case([(username.like(f"{pattern}%", escape='\\'), 0)], else_=1),
+                      func.length(User.username),
+                      User.username)
+            .limit(limit)
+            .all())
+
+
+def autocomplete(q, limit=AUTOCOMPLETE_LIMIT):
+    """Return up to `limit` (username, id) pairs starting with `q`."""
+
+    if not uses_trigram_index():
+        trie = get_trie()
+
+        with _lock:
+            return trie.search(q, limit)
+
+    pattern = escape_like(q.lower())
+
+    return (db.session
+            .query(User.username, User.id)
+            .filter(func.lower(User.username).like(f"{pattern}%", escape='\\'),
+                    User.deleted_at.is_(None))
+            .order_by(func.length(User.username), User.username)
+            .limit(limit)
+            .all())